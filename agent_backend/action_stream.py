@@ -0,0 +1,93 @@
+"""
+Structured extraction of {{NAVIGATE:...}} / {{ACTION:...}} markers.
+
+MarkerStreamParser consumes model output chunk by chunk and reports each marker the
+moment its closing braces arrive, so the dashboard can navigate or start loading data
+while the rest of the answer is still generating. Marker text is never emitted as
+display text; a partial "{{..." is held back only while it can still become a marker.
+"""
+import re
+
+MARKER_RE = re.compile(r"\{\{\s*(NAVIGATE|ACTION)\s*:\s*([^}]+?)\s*\}\}", re.IGNORECASE)
+_MARKER_KINDS = ("NAVIGATE", "ACTION")
+_MAX_MARKER_LEN = 80
+
+
+def _marker(match):
+    return {"type": match.group(1).lower(), "target": match.group(2).strip()}
+
+
+def extract_markers(text):
+    """All markers in a complete response, in order."""
+    return [_marker(m) for m in MARKER_RE.finditer(text or "")]
+
+
+def strip_markers(text):
+    return MARKER_RE.sub("", text or "")
+
+
+def _could_become_marker(buffer):
+    """True if `buffer` (starting with "{{") is an incomplete but still valid marker."""
+    if len(buffer) > _MAX_MARKER_LEN or "}}" in buffer:
+        return False
+    body = buffer[2:].lstrip().upper()
+    for kind in _MARKER_KINDS:
+        if kind.startswith(body):
+            return True
+        if body.startswith(kind):
+            rest = body[len(kind):].lstrip()
+            return rest == "" or (rest.startswith(":") and "}" not in rest[:-1])
+    return False
+
+
+class MarkerStreamParser:
+    """Splits streamed model output into ("text", str) and ("marker", dict) events."""
+
+    def __init__(self):
+        self._buffer = ""
+        self.markers = []
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        events = []
+        text = []
+        while self._buffer:
+            start = self._buffer.find("{")
+            if start == -1:
+                text.append(self._buffer)
+                self._buffer = ""
+                break
+            if start:
+                text.append(self._buffer[:start])
+                self._buffer = self._buffer[start:]
+
+            if self._buffer == "{":
+                break  # might be the first half of "{{"
+            if not self._buffer.startswith("{{"):
+                text.append("{")
+                self._buffer = self._buffer[1:]
+                continue
+
+            match = MARKER_RE.match(self._buffer)
+            if match:
+                if text:
+                    events.append(("text", "".join(text)))
+                    text = []
+                marker = _marker(match)
+                self.markers.append(marker)
+                events.append(("marker", marker))
+                self._buffer = self._buffer[match.end():]
+            elif _could_become_marker(self._buffer):
+                break  # wait for more output
+            else:
+                text.append("{")
+                self._buffer = self._buffer[1:]
+
+        if text:
+            events.append(("text", "".join(text)))
+        return events
+
+    def flush(self):
+        """Emits whatever is still held back once the stream has ended."""
+        rest, self._buffer = self._buffer, ""
+        return [("text", rest)] if rest else []
@@ -0,0 +1,365 @@
+"""
+Incrementally maintained usage rollups and token accounting.
+
+Every recorded exchange bumps in-memory counters for its (day, role), (day, user)
+and (day, model): messages, response characters, prompt and completion tokens, LLM
+latency, errors, timeouts and answer source. A background task flushes them every
+ANALYTICS_FLUSH_SECONDS as $inc upserts into the `usage_rollups` collection, so
+dashboards read a handful of rollup documents instead of scanning `chats`.
+
+Token counts come from the provider's usage metadata; for providers that report
+none they are estimated from text length (and counted as estimated). TOKEN_BUDGETS
+sets a daily token budget per user by role: past TOKEN_BUDGET_DOWNGRADE_AT of it
+answers move to the small tier with a shorter output cap, and at 100% requests are
+refused until the next UTC day. TOKEN_PRICES (USD per 1K prompt/completion tokens
+per model) turns the model rollups into a cost estimate.
+"""
+import os
+import datetime
+import collections
+
+from pymongo import UpdateOne
+
+ANALYTICS_FLUSH_SECONDS = int(os.getenv("ANALYTICS_FLUSH_SECONDS", "30"))
+TOKEN_BUDGETS = os.getenv("TOKEN_BUDGETS", "")  # "student:60000,faculty:250000"; empty disables budgets
+TOKEN_BUDGET_DOWNGRADE_AT = float(os.getenv("TOKEN_BUDGET_DOWNGRADE_AT", "0.8"))
+TOKEN_PRICES = os.getenv("TOKEN_PRICES", "")  # "gpt-4o:0.0025:0.01,..." USD per 1K prompt:completion tokens
+CHARS_PER_TOKEN = 4  # estimate for providers that report no usage
+
+ROLE = "role"
+USER = "user"
+MODEL = "model"
+OUTCOMES = ("ok", "error", "timeout")
+
+OK = "ok"
+DOWNGRADE = "downgrade"
+THROTTLE = "throttle"
+
+
+def day_key(ts=None):
+    return (ts or datetime.datetime.now(datetime.timezone.utc)).strftime("%Y-%m-%d")
+
+
+def estimate_tokens(text):
+    return max(1, round(len(text) / CHARS_PER_TOKEN)) if text else 0
+
+
+def _content(message):
+    content = getattr(message, "content", message)
+    return content if isinstance(content, str) else str(content or "")
+
+
+def provider_usage(usage):
+    """
+    (prompt tokens, completion tokens, cached prompt tokens) reported by the provider,
+    or None. `usage` is an AIMessage (chunk) or a usage_metadata dict; the response
+    metadata shapes of OpenAI-compatible, Anthropic and Gemini responses are read
+    when LangChain's usage_metadata is missing.
+    """
+    if usage is None:
+        return None
+    meta = {}
+    if not isinstance(usage, dict):
+        meta = getattr(usage, "response_metadata", None) or {}
+        usage = getattr(usage, "usage_metadata", None)
+    if usage and usage.get("input_tokens") is not None:
+        details = usage.get("input_token_details") or {}
+        return usage["input_tokens"], usage.get("output_tokens") or 0, details.get("cache_read") or 0
+    if meta.get("token_usage"):  # OpenAI-compatible
+        u = meta["token_usage"]
+        details = u.get("prompt_tokens_details") or {}
+        return u.get("prompt_tokens") or 0, u.get("completion_tokens") or 0, details.get("cached_tokens") or 0
+    if meta.get("usage"):  # Anthropic
+        u = meta["usage"]
+        return u.get("input_tokens") or 0, u.get("output_tokens") or 0, u.get("cache_read_input_tokens") or 0
+    if meta.get("usage_metadata"):  # Gemini
+        u = meta["usage_metadata"]
+        return (u.get("prompt_token_count") or 0, u.get("candidates_token_count") or 0,
+                u.get("cached_content_token_count") or 0)
+    return None
+
+
+def token_counts(usage=None, messages=(), response_text=""):
+    """
+    (prompt tokens, completion tokens, estimated) for one LLM call. `usage` is as for
+    provider_usage; without usable counts both sides are estimated from the messages
+    and response text.
+    """
+    reported = provider_usage(usage)
+    if reported is not None:
+        return reported[0], reported[1], False
+    return sum(estimate_tokens(_content(m)) for m in messages or ()), estimate_tokens(response_text), True
+
+
+def parse_token_limits(spec):
+    """{key: number} from "key:number,..." (per-role budgets)."""
+    limits = {}
+    for item in (spec or "").split(","):
+        key, _, value = item.strip().partition(":")
+        if key and value:
+            limits[key.lower()] = int(float(value))
+    return limits
+
+
+def parse_token_prices(spec):
+    """{model: (prompt, completion) USD per 1K tokens} from "model:prompt:completion,..."."""
+    prices = {}
+    for item in (spec or "").split(","):
+        parts = item.strip().rsplit(":", 2)
+        if len(parts) == 3:
+            prices[parts[0]] = (float(parts[1]), float(parts[2]))
+    return prices
+
+
+def _new_counters():
+    return collections.Counter()
+
+
+class UsageRollups:
+    def __init__(self):
+        self._pending = collections.defaultdict(_new_counters)  # (scope, key, day) -> counters
+        self._latency_max = {}  # (scope, key, day) -> max LLM latency in ms
+        self.flushes = 0
+        self.flush_errors = 0
+
+    def record(self, role, user_id, response_chars, latency_ms=None, outcome="ok", source="llm", day=None,
+               prompt_tokens=0, completion_tokens=0, model=None, tokens_estimated=False):
+        """Counts one exchange. Cheap enough to call on every request."""
+        day = day or day_key()
+        outcome = outcome if outcome in OUTCOMES else "error"
+        scopes = [(ROLE, (role or "unknown").lower()), (USER, str(user_id))]
+        if model:
+            scopes.append((MODEL, str(model)))
+        for scope, key in scopes:
+            slot = (scope, key, day)
+            counters = self._pending[slot]
+            counters["messages"] += 1
+            counters["response_chars"] += response_chars
+            counters[outcome] += 1
+            counters[f"source_{source}"] += 1
+            if prompt_tokens or completion_tokens:
+                counters["prompt_tokens"] += prompt_tokens
+                counters["completion_tokens"] += completion_tokens
+                if tokens_estimated:
+                    counters["tokens_estimated"] += 1
+            if latency_ms is not None:
+                counters["llm_calls"] += 1
+                counters["latency_ms_total"] += int(latency_ms)
+                if latency_ms > self._latency_max.get(slot, 0):
+                    self._latency_max[slot] = int(latency_ms)
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    async def flush(self, collection):
+        """Writes pending counters as $inc upserts. Returns the number of rollup documents touched."""
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, collections.defaultdict(_new_counters)
+        latency_max, self._latency_max = self._latency_max, {}
+        ops = []
+        for (scope, key, day), counters in pending.items():
+            update = {
+                "$inc": dict(counters),
+                "$setOnInsert": {"scope": scope, "key": key, "day": day},
+            }
+            if (scope, key, day) in latency_max:
+                update["$max"] = {"latency_ms_max": latency_max[(scope, key, day)]}
+            ops.append(UpdateOne({"_id": f"{day}|{scope}|{key}"}, update, upsert=True))
+        try:
+            await collection.bulk_write(ops, ordered=False)
+        except Exception:
+            # Put the counters back so the next flush retries them
+            self.flush_errors += 1
+            for slot, counters in pending.items():
+                self._pending[slot].update(counters)
+            for slot, value in latency_max.items():
+                self._latency_max[slot] = max(value, self._latency_max.get(slot, 0))
+            raise
+        self.flushes += 1
+        return len(ops)
+
+
+async def ensure_indexes(collection):
+    await collection.create_index([("scope", 1), ("day", -1), ("messages", -1)])
+
+
+def _summarize(docs):
+    totals = collections.Counter()
+    latency_max = 0
+    for d in docs:
+        for field, value in d.items():
+            if isinstance(value, int) and field != "latency_ms_max":
+                totals[field] += value
+        latency_max = max(latency_max, d.get("latency_ms_max", 0))
+    messages = totals["messages"]
+    llm_calls = totals["llm_calls"]
+    return {
+        "messages": messages,
+        "avg_response_chars": round(totals["response_chars"] / messages, 1) if messages else 0,
+        "llm_calls": llm_calls,
+        "avg_llm_latency_ms": round(totals["latency_ms_total"] / llm_calls, 1) if llm_calls else None,
+        "max_llm_latency_ms": latency_max or None,
+        "errors": totals["error"],
+        "timeouts": totals["timeout"],
+        "sources": {f[len("source_"):]: n for f, n in totals.items() if f.startswith("source_")},
+        "prompt_tokens": totals["prompt_tokens"],
+        "completion_tokens": totals["completion_tokens"],
+        "estimated_token_messages": totals["tokens_estimated"],
+    }
+
+
+async def usage_report(collection, days=7, top_users=10):
+    """Per-day and per-role usage for the last `days` days plus the most active users, from rollups only."""
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    day_keys = [(today - datetime.timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days)]
+
+    role_docs = await collection.find({"scope": ROLE, "day": {"$in": day_keys}}).to_list(length=None)
+    by_day = collections.defaultdict(list)
+    by_role = collections.defaultdict(list)
+    for d in role_docs:
+        by_day[d["day"]].append(d)
+        by_role[d["key"]].append(d)
+
+    top = await collection.aggregate([
+        {"$match": {"scope": USER, "day": {"$in": day_keys}}},
+        {"$group": {"_id": "$key", "messages": {"$sum": "$messages"}, "errors": {"$sum": "$error"},
+                    "timeouts": {"$sum": "$timeout"}}},
+        {"$sort": {"messages": -1}},
+        {"$limit": top_users},
+    ]).to_list(length=top_users)
+
+    return {
+        "days": days,
+        "totals": _summarize(role_docs),
+        "by_role": {role: _summarize(docs) for role, docs in sorted(by_role.items())},
+        "by_day": {day: _summarize(by_day.get(day, [])) for day in reversed(day_keys)},
+        "top_users": [{"user_id": t["_id"], "messages": t["messages"], "errors": t["errors"],
+                       "timeouts": t["timeouts"]} for t in top],
+    }
+
+
+async def token_report(collection, days=7, top_users=20, prices=None):
+    """Prompt/completion tokens per role and model (with cost where priced) and the heaviest users, from rollups."""
+    prices = parse_token_prices(TOKEN_PRICES) if prices is None else prices
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    day_keys = [(today - datetime.timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days)]
+
+    grouped = await collection.aggregate([
+        {"$match": {"scope": {"$in": [ROLE, MODEL]}, "day": {"$in": day_keys}}},
+        {"$group": {"_id": {"scope": "$scope", "key": "$key"}, "messages": {"$sum": "$messages"},
+                    "prompt_tokens": {"$sum": "$prompt_tokens"}, "completion_tokens": {"$sum": "$completion_tokens"},
+                    "estimated": {"$sum": "$tokens_estimated"}}},
+    ]).to_list(length=None)
+    by_role, by_model = {}, {}
+    for g in grouped:
+        row = {k: g[k] for k in ("messages", "prompt_tokens", "completion_tokens", "estimated")}
+        row["tokens_per_message"] = round((row["prompt_tokens"] + row["completion_tokens"]) / row["messages"], 1) \
+            if row["messages"] else 0
+        if g["_id"]["scope"] == MODEL:
+            price = prices.get(g["_id"]["key"])
+            if price:
+                row["cost_usd"] = round(row["prompt_tokens"] / 1000 * price[0] + row["completion_tokens"] / 1000 * price[1], 4)
+            by_model[g["_id"]["key"]] = row
+        else:
+            by_role[g["_id"]["key"]] = row
+
+    top = await collection.aggregate([
+        {"$match": {"scope": USER, "day": {"$in": day_keys}}},
+        {"$group": {"_id": "$key", "messages": {"$sum": "$messages"},
+                    "prompt_tokens": {"$sum": "$prompt_tokens"}, "completion_tokens": {"$sum": "$completion_tokens"}}},
+        {"$addFields": {"tokens": {"$add": ["$prompt_tokens", "$completion_tokens"]}}},
+        {"$sort": {"tokens": -1}},
+        {"$limit": top_users},
+    ]).to_list(length=top_users)
+
+    return {
+        "days": days,
+        "prompt_tokens": sum(r["prompt_tokens"] for r in by_role.values()),
+        "completion_tokens": sum(r["completion_tokens"] for r in by_role.values()),
+        "cost_usd": round(sum(r.get("cost_usd", 0) for r in by_model.values()), 4) if prices else None,
+        "by_role": dict(sorted(by_role.items())),
+        "by_model": dict(sorted(by_model.items())),
+        "top_users": [{"user_id": t["_id"], "messages": t["messages"], "prompt_tokens": t["prompt_tokens"],
+                       "completion_tokens": t["completion_tokens"]} for t in top],
+    }
+
+
+class TokenBudgets:
+    """
+    Daily per-user token budgets by role. Each worker seeds a user's usage from the
+    flushed rollup the first time it sees them each day and adds its own spend, so
+    enforcement is approximate across workers (off by at most one flush interval).
+    """
+
+    def __init__(self, limits=None, downgrade_at=TOKEN_BUDGET_DOWNGRADE_AT):
+        self.limits = parse_token_limits(TOKEN_BUDGETS) if limits is None else limits
+        self.downgrade_at = downgrade_at
+        self._day = None
+        self._used = {}  # user_id -> tokens today
+        self.throttled = 0
+
+    def limit(self, role):
+        return self.limits.get((role or "").lower(), self.limits.get("default"))
+
+    def _roll(self):
+        day = day_key()
+        if day != self._day:
+            self._day = day
+            self._used.clear()
+        return day
+
+    async def check(self, collection, user_id, role):
+        """OK, DOWNGRADE or THROTTLE for the user's next request."""
+        limit = self.limit(role)
+        if not limit:
+            return OK
+        day = self._roll()
+        user_id = str(user_id)
+        if user_id not in self._used:
+            used = 0
+            try:
+                doc = await collection.find_one({"_id": f"{day}|{USER}|{user_id}"},
+                                                {"prompt_tokens": 1, "completion_tokens": 1})
+                if doc:
+                    used = doc.get("prompt_tokens", 0) + doc.get("completion_tokens", 0)
+            except Exception:
+                pass  # fail open: count from zero on this worker
+            self._used.setdefault(user_id, used)
+        state = self.state(user_id, role)
+        if state == THROTTLE:
+            self.throttled += 1
+        return state
+
+    def state(self, user_id, role):
+        """Budget state from the counts already loaded (no I/O)."""
+        limit = self.limit(role)
+        if not limit:
+            return OK
+        used = self._used.get(str(user_id), 0)
+        if used >= limit:
+            return THROTTLE
+        if used >= limit * self.downgrade_at:
+            return DOWNGRADE
+        return OK
+
+    def spend(self, user_id, tokens):
+        """Adds tokens for a user already loaded by check() today."""
+        user_id = str(user_id)
+        if tokens and user_id in self._used and self._day == day_key():
+            self._used[user_id] += tokens
+
+    @staticmethod
+    def seconds_until_reset():
+        now = datetime.datetime.now(datetime.timezone.utc)
+        tomorrow = (now + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        return max(1, int((tomorrow - now).total_seconds()))
+
+    def stats(self):
+        return {
+            "limits": self.limits,
+            "downgrade_at": self.downgrade_at,
+            "users_tracked_today": len(self._used),
+            "throttled": self.throttled,
+        }
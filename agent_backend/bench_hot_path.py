@@ -0,0 +1,352 @@
+"""
+In-process microbenchmarks for the /chat hot path.
+
+Each stage runs in isolation against an in-memory Mongo stand-in and the fake LLM
+(fixed latency), and reports per-call time and allocations. Compare against a stored
+baseline to catch regressions:
+
+    python bench_hot_path.py --save-baseline      # record bench_baseline.json
+    python bench_hot_path.py                      # exits 1 if a stage regressed
+    python bench_hot_path.py --stages jwt_decode,get_role_prompt --tolerance 0.5
+    python bench_hot_path.py --history-memory     # bytes per cached user, messages vs Turn tuples
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+import tracemalloc
+
+# Configure main.py for offline use before it is imported
+os.environ["LLM_PROVIDER"] = "fake"
+os.environ.setdefault("FAKE_LLM_LATENCY_MS", "50")
+os.environ.pop("KNOWLEDGE_SNAPSHOT", None)
+
+import main  # noqa: E402
+from deadline import Deadline  # noqa: E402
+import history_store  # noqa: E402
+from langchain_core.messages import HumanMessage, AIMessage  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+
+# --- MONGO STAND-IN ---
+
+def _matches(doc, query):
+    for key, cond in (query or {}).items():
+        if key == "$or":
+            if not any(_matches(doc, sub) for sub in cond):
+                return False
+            continue
+        value = doc.get(key)
+        if isinstance(cond, dict):
+            if "$regex" in cond:
+                flags = re.I if "i" in cond.get("$options", "") else 0
+                if not isinstance(value, str) or not re.search(cond["$regex"], value, flags):
+                    return False
+            if "$in" in cond:
+                values = value if isinstance(value, list) else [value]
+                if not any(v in cond["$in"] for v in values):
+                    return False
+        elif value != cond:
+            return False
+    return True
+
+
+class _Cursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def sort(self, key, direction=1):
+        self._docs.sort(key=lambda d: d.get(key), reverse=direction == -1)
+        return self
+
+    def limit(self, n):
+        self._docs = self._docs[:n]
+        return self
+
+    async def to_list(self, length=None):
+        return list(self._docs[:length] if length else self._docs)
+
+
+class MemoryCollection:
+    """Just enough of the motor collection API for the chat path."""
+
+    def __init__(self, docs=None):
+        self.docs = list(docs or [])
+
+    def find(self, query=None, *args, **kwargs):
+        return _Cursor([d for d in self.docs if _matches(d, query)])
+
+    async def find_one(self, query=None):
+        return next((d for d in self.docs if _matches(d, query)), None)
+
+    async def insert_one(self, doc):
+        self.docs.append(doc)
+
+    async def insert_many(self, docs, ordered=True):
+        self.docs.extend(docs)
+
+
+class MemoryDB:
+    def __init__(self, collections):
+        self._collections = collections
+
+    def __getattr__(self, name):
+        return self._collections.setdefault(name, MemoryCollection())
+
+
+KNOWLEDGE_FIXTURES = {
+    "student_knowledges": [
+        {"subject": "Data Structures", "topic": "Stacks & Queues", "content": "Stack: LIFO. Queue: FIFO.",
+         "codeExamples": ["stack = []\nstack.append(1)\nstack.pop()"], "tags": ["dsa", "stack", "queue"]},
+        {"subject": "Operating Systems", "topic": "Process Scheduling", "content": "FCFS, SJF, Round Robin.",
+         "tags": ["os", "scheduling"]},
+        {"subject": "DBMS", "topic": "SQL vs NoSQL", "content": "Relational tables vs flexible documents.",
+         "tags": ["dbms", "sql", "database"]},
+    ] * 10,
+    "faculty_knowledges": [
+        {"subject": "Attendance", "topic": "Marking Attendance", "content": "Use the Attendance Dashboard.",
+         "tags": ["attendance"]},
+    ],
+    "admin_knowledges": [
+        {"module": "Fees", "topic": "Fee Control", "content": "Defaulters are highlighted in red.",
+         "tips": ["Check daily collection reports at 5 PM"], "tags": ["fees"]},
+    ],
+}
+
+
+def install_fixtures(history_users=50):
+    """Points main.py at seeded in-memory collections."""
+    collections = {name: MemoryCollection(docs) for name, docs in KNOWLEDGE_FIXTURES.items()}
+    chats = []
+    for u in range(history_users):
+        for i in range(10):
+            chats.append({
+                "user_id": f"user{u}",
+                "role": "student",
+                "message": f"Question {i} about data structures and stacks?",
+                "response": "Stacks are LIFO. " * 40,
+                "timestamp": i,
+            })
+    collections["chats"] = MemoryCollection(chats)
+    collections["users"] = MemoryCollection([{
+        "username": "bench_user",
+        "password_hash": main.get_password_hash("bench-password"),
+        "role": "student",
+    }])
+
+    main.db = MemoryDB(collections)
+    main.chat_collection = collections["chats"]
+    main.users_collection = collections["users"]
+    main.knowledge_snapshot = None
+
+
+# --- STAGES ---
+
+def build_stages():
+    token = main.create_access_token({"sub": "bench_user", "role": "student", "user_id": "1"})
+    request = main.ChatRequest(user_id="user1", message="Explain stacks and queues", role="student", user_name="Bench")
+    login = main.UserLogin(username="bench_user", password="bench-password")
+    counter = {"n": 0}
+
+    async def knowledge():
+        await main.load_knowledge_from_db("student", "explain stacks and queues")
+
+    async def role_prompt():
+        await main.get_role_prompt("student", "Bench", {"page": "home"}, "explain stacks and queues")
+
+    async def history_miss():
+        counter["n"] += 1
+        main.chat_history_cache.pop(f"user{counter['n'] % 50}", None)
+        await main.load_history_messages(f"user{counter['n'] % 50}")
+
+    async def history_hit():
+        await main.load_history_messages("user1")
+
+    async def cache_update():
+        main.update_history_cache("user1", "Explain stacks and queues", "Stacks are LIFO. " * 40)
+
+    async def bcrypt_login():
+        await main.login(login)
+
+    async def jwt_decode():
+        main.get_current_user(token)
+
+    async def chat_end_to_end():
+        await main.handle_chat(request, main.Response(), Deadline(60))
+
+    # name -> (coroutine function, default iterations)
+    return {
+        "load_knowledge_from_db": (knowledge, 300),
+        "get_role_prompt": (role_prompt, 300),
+        "history_assembly_miss": (history_miss, 300),
+        "history_assembly_hit": (history_hit, 1000),
+        "cache_update": (cache_update, 2000),
+        "bcrypt_login": (bcrypt_login, 10),
+        "jwt_decode": (jwt_decode, 2000),
+        "chat_end_to_end": (chat_end_to_end, 20),
+    }
+
+
+async def measure(fn, iterations):
+    for _ in range(min(10, iterations)):
+        await fn()  # warm-up
+
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter_ns()
+        await fn()
+        timings.append(time.perf_counter_ns() - start)
+
+    # Allocation pass, separate so tracing overhead doesn't skew the timings
+    samples = max(1, min(50, iterations))
+    tracemalloc.start()
+    before_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    for _ in range(samples):
+        await fn()
+    _, peak = tracemalloc.get_traced_memory()
+    after_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    tracemalloc.stop()
+
+    timings.sort()
+    return {
+        "iterations": iterations,
+        "median_us": round(statistics.median(timings) / 1000, 2),
+        "p95_us": round(timings[int(len(timings) * 0.95) - 1] / 1000, 2),
+        "peak_alloc_kb": round((peak - base) / 1024, 2),
+        "retained_blocks_per_call": round((after_blocks - before_blocks) / samples, 2),
+    }
+
+
+def check_regressions(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        limit = base["median_us"] * (1 + tolerance)
+        if result["median_us"] > limit:
+            regressions.append(f"{name}: {base['median_us']}us -> {result['median_us']}us (limit {limit:.2f}us)")
+    return regressions
+
+
+async def run(args):
+    install_fixtures()
+    stages = build_stages()
+    selected = args.stages.split(",") if args.stages else list(stages)
+
+    results = {}
+    print(f"{'stage':<26}{'median us':>12}{'p95 us':>12}{'peak KB':>10}{'blocks':>9}")
+    for name in selected:
+        fn, iterations = stages[name]
+        if args.scale != 1.0:
+            iterations = max(1, int(iterations * args.scale))
+        r = await measure(fn, iterations)
+        results[name] = r
+        print(f"{name:<26}{r['median_us']:>12}{r['p95_us']:>12}{r['peak_alloc_kb']:>10}{r['retained_blocks_per_call']:>9}")
+    return results
+
+
+# --- HISTORY CACHE MEMORY ---
+
+def _cache_bytes(build, users):
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    cache = {f"user{i}": build(i) for i in range(users)}
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del cache
+    return (used - base) / users
+
+
+def history_memory_report(users=2000):
+    """
+    Bytes per cached user (4 full exchanges) for the old list-of-LangChain-messages
+    cache and the compact Turn tuples. Texts are built per user so string storage
+    is counted on both sides.
+    """
+    def texts(i):
+        return [(f"question {i}-{n} " + "about stacks " * 8, f"answer {i}-{n} " + "Stacks are LIFO. " * 30) for n in range(4)]
+
+    def as_messages(i):
+        messages = []
+        for q, a in texts(i):
+            messages.extend([HumanMessage(content=q), AIMessage(content=a)])
+        return messages
+
+    def as_turns(i):
+        turns = ()
+        for q, a in texts(i):
+            turns = history_store.append_exchange(turns, q, a)
+        return turns
+
+    def text_only(i):
+        return texts(i)
+
+    text_bytes = _cache_bytes(text_only, users)
+    results = {}
+    for name, build in (("langchain_messages", as_messages), ("turn_tuples", as_turns)):
+        per_user = _cache_bytes(build, users)
+        results[name] = {"bytes_per_user": round(per_user), "overhead_bytes_per_user": round(per_user - text_bytes)}
+
+    print(f"{'representation':<22}{'bytes/user':>12}{'overhead':>12}")
+    for name, r in results.items():
+        print(f"{name:<22}{r['bytes_per_user']:>12}{r['overhead_bytes_per_user']:>12}")
+    saved = results["langchain_messages"]["bytes_per_user"] - results["turn_tuples"]["bytes_per_user"]
+    print(f"[OK] Compact history saves {saved} bytes per cached user ({users} users sampled)")
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Microbenchmark the chat hot path.")
+    parser.add_argument("--stages", help="Comma-separated stage names (default: all)")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply iteration counts")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed median slowdown vs baseline (0.25 = 25%%)")
+    parser.add_argument("--json", help="Also write results to this file")
+    parser.add_argument("--history-memory", action="store_true", help="Only report history cache bytes per user")
+    args = parser.parse_args()
+
+    if args.history_memory:
+        results = history_memory_report()
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+        return
+
+    results = asyncio.run(run(args))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"[OK] Baseline saved to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"[!] No baseline at {args.baseline}; run with --save-baseline to create one.")
+        return
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = check_regressions(results, baseline, args.tolerance)
+    if regressions:
+        print("[X] Regressions detected:")
+        for r in regressions:
+            print(f"   {r}")
+        sys.exit(1)
+    print(f"[OK] No stage regressed more than {args.tolerance:.0%} against the baseline")
+
+
+if __name__ == "__main__":
+    main_cli()
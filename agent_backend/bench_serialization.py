@@ -0,0 +1,108 @@
+"""
+Serialization benchmark for the heavy read endpoints (/admin/data, /history).
+
+Builds a synthetic /admin/data payload (Mongo-shaped chat documents with ObjectIds,
+datetimes and multi-KB responses) and compares FastAPI's default path
+(jsonable_encoder + json.dumps) with fast_response.dumps, then the size and cost
+of each compression option:
+
+    python bench_serialization.py
+    python bench_serialization.py --chats 500 --users 100 --json bench_results/serialization.json
+"""
+import json
+import time
+import random
+import argparse
+import datetime
+import statistics
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+
+import fast_response
+
+WORDS = ("stack queue process thread memory index fee attendance exam syllabus tree graph "
+         "pointer array function recursion schedule semester module report").split()
+
+
+def make_payload(chats=500, users=100, seed=7):
+    rng = random.Random(seed)
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    def text(n):
+        return " ".join(rng.choice(WORDS) for _ in range(n))
+
+    user_docs = [
+        {"_id": ObjectId(), "username": f"user{i}", "role": rng.choice(["student", "faculty", "admin"]),
+         "password_hash": "$2b$12$" + "x" * 53, "created_at": now - datetime.timedelta(days=i)}
+        for i in range(users)
+    ]
+    chat_docs = [
+        {"_id": ObjectId(), "user_id": f"user{rng.randrange(users)}", "role": "student",
+         "message": text(rng.randint(5, 40)), "response": text(rng.randint(150, 600)),
+         "timestamp": now - datetime.timedelta(minutes=i)}
+        for i in range(chats)
+    ]
+    return {"total_users": users, "total_chats": chats, "users": user_docs, "chats": chat_docs}
+
+
+def default_path(payload):
+    # What FastAPI does for a returned dict (ObjectId needs the custom encoder)
+    return json.dumps(jsonable_encoder(payload, custom_encoder={ObjectId: str})).encode("utf-8")
+
+
+def timed(fn, repeat):
+    runs = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        runs.append(time.perf_counter() - start)
+    return result, round(statistics.median(runs) * 1000, 3)
+
+
+def run(chats, users, repeat):
+    payload = make_payload(chats, users)
+    results = {"chats": chats, "users": users, "orjson": fast_response.orjson is not None}
+
+    raw_default, results["default_ms"] = timed(lambda: default_path(payload), repeat)
+    raw_fast, results["fast_ms"] = timed(lambda: fast_response.dumps(payload), repeat)
+    results["raw_bytes"] = len(raw_fast)
+    results["default_raw_bytes"] = len(raw_default)
+
+    encodings = ["gzip"] + (["br"] if fast_response.brotli is not None else [])
+    for encoding in encodings:
+        body, ms = timed(lambda: fast_response.compress(raw_fast, encoding), repeat)
+        results[f"{encoding}_bytes"] = len(body)
+        results[f"{encoding}_ms"] = ms
+
+    print(f"Payload: {chats} chats, {users} users")
+    print(f"{'path':<28}{'ms':>10}{'bytes':>12}")
+    print(f"{'jsonable_encoder + json':<28}{results['default_ms']:>10}{results['default_raw_bytes']:>12}")
+    print(f"{'orjson' if results['orjson'] else 'json (no orjson)':<28}{results['fast_ms']:>10}{results['raw_bytes']:>12}")
+    for encoding in encodings:
+        label = f"  + {encoding}"
+        print(f"{label:<28}{results[encoding + '_ms']:>10}{results[encoding + '_bytes']:>12}")
+    if fast_response.brotli is None:
+        print("[!] brotli not installed; only gzip measured (pip install brotli)")
+    print(f"[OK] Serialization {results['default_ms'] / max(results['fast_ms'], 1e-6):.1f}x faster, "
+          f"gzip wire size {results['gzip_bytes'] / results['raw_bytes']:.1%} of raw")
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark response serialization and compression.")
+    parser.add_argument("--chats", type=int, default=500)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--json", help="Also write results to this file")
+    args = parser.parse_args()
+
+    results = run(args.chats, args.users, args.repeat)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
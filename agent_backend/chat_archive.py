@@ -0,0 +1,285 @@
+"""
+Hot/cold archival of old chats.
+
+A background job moves exchanges older than ARCHIVE_AFTER_DAYS out of the hot chat
+storage (`chats`, or `chat_buckets` with CHAT_STORAGE=buckets) into `chat_archive`:
+one document per user per chunk of up to ARCHIVE_CHUNK_EXCHANGES exchanges, holding
+them as compressed NDJSON (gzip, or zstd with ARCHIVE_CODEC=zstd and the optional
+zstandard package) plus the user id, time range and count. The (user_id, last_ts) index over those
+chunks is the per-user archive index; /history reads chunks only when a page
+reaches past the hot data.
+
+Only one worker archives at a time (a lease in chat_archive_meta). Chunks are
+written before the hot copies are deleted, so a crash in between never leaves gaps.
+A chunk's _id is derived from its rows, so re-archiving the same rows after such a
+crash is a no-op insert, and readers drop rows they have already seen (by chat _id,
+or timestamp and message for bucket exchanges) in case the batch came out different.
+
+    python chat_archive.py run [--days 180]
+    python chat_archive.py stats
+"""
+import os
+import gzip
+import json
+import hashlib
+import asyncio
+import argparse
+import datetime
+
+from bson import Binary
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "180"))  # 0 disables the job
+ARCHIVE_INTERVAL_HOURS = float(os.getenv("ARCHIVE_INTERVAL_HOURS", "6"))
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "5000"))  # exchanges (or buckets) per pass
+ARCHIVE_CHUNK_EXCHANGES = int(os.getenv("ARCHIVE_CHUNK_EXCHANGES", "200"))
+ARCHIVE_CODEC = os.getenv("ARCHIVE_CODEC", "gzip")  # gzip or zstd
+LEASE_SECONDS = 600
+DUPLICATE_KEY = 11000
+
+if ARCHIVE_CODEC not in ("gzip", "zstd"):
+    raise RuntimeError(f"Unknown ARCHIVE_CODEC {ARCHIVE_CODEC!r}; use gzip or zstd")
+if ARCHIVE_CODEC == "zstd" and zstandard is None:
+    raise RuntimeError("ARCHIVE_CODEC=zstd needs the zstandard package (pip install zstandard)")
+
+
+def _utc(ts):
+    if ts is None:
+        return None
+    return ts.replace(tzinfo=datetime.timezone.utc) if ts.tzinfo is None else ts
+
+
+def _encode(rows, codec):
+    raw = "\n".join(json.dumps(r, default=str, ensure_ascii=False) for r in rows).encode("utf-8")
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=6).compress(raw)
+    return gzip.compress(raw, compresslevel=6)
+
+
+def _decode(data, codec):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Archive chunk is zstd-compressed but the zstandard package is not installed")
+        raw = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        raw = gzip.decompress(data)
+    rows = []
+    for line in raw.decode("utf-8").splitlines():
+        if line:
+            row = json.loads(line)
+            row["timestamp"] = datetime.datetime.fromisoformat(row["timestamp"])
+            rows.append(row)
+    return rows
+
+
+def _row(doc):
+    """Archive row for a chat document or bucket exchange."""
+    row = {k: v for k, v in doc.items() if k != "user_id"}
+    if "_id" in row:
+        row["_id"] = str(row["_id"])
+    row["timestamp"] = _utc(row.get("timestamp") or datetime.datetime.now(datetime.timezone.utc)).isoformat()
+    return row
+
+
+def row_key(row):
+    """Identity of an exchange in hot storage or the archive: its chat _id, else timestamp and message."""
+    if row.get("_id") is not None:
+        return str(row["_id"])
+    ts = row.get("timestamp")
+    if isinstance(ts, datetime.datetime):
+        ts = _utc(ts).isoformat()
+    return f"{ts}|{row.get('message', '')}"
+
+
+def _chunk_id(user_id, rows):
+    digest = hashlib.sha1("\n".join(row_key(r) for r in rows).encode("utf-8")).hexdigest()[:20]
+    return f"{user_id}:{rows[0]['timestamp']}:{digest}"
+
+
+def build_chunks(user_id, docs, codec=ARCHIVE_CODEC):
+    """Archive documents for one user's exchanges (chronological)."""
+    chunks = []
+    for start in range(0, len(docs), ARCHIVE_CHUNK_EXCHANGES):
+        rows = [_row(d) for d in docs[start:start + ARCHIVE_CHUNK_EXCHANGES]]
+        chunks.append({
+            "_id": _chunk_id(user_id, rows),
+            "user_id": user_id,
+            "first_ts": datetime.datetime.fromisoformat(rows[0]["timestamp"]),
+            "last_ts": datetime.datetime.fromisoformat(rows[-1]["timestamp"]),
+            "count": len(rows),
+            "codec": codec,
+            "data": Binary(_encode(rows, codec)),
+            "archived_at": datetime.datetime.now(datetime.timezone.utc),
+        })
+    return chunks
+
+
+async def ensure_indexes(archive_collection, chat_collection=None):
+    await archive_collection.create_index([("user_id", 1), ("last_ts", -1)])
+    if chat_collection is not None:
+        await chat_collection.create_index([("timestamp", 1)])
+
+
+async def acquire_lease(meta_collection, owner, seconds=LEASE_SECONDS):
+    """True if this worker holds the archiver lease for the next `seconds`."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    try:
+        await meta_collection.update_one(
+            {"_id": "archiver", "$or": [{"locked_until": {"$lt": now}}, {"owner": owner}]},
+            {"$set": {"owner": owner, "locked_until": now + datetime.timedelta(seconds=seconds)}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        return False  # held by another worker, so the upsert collided with its document
+    return True
+
+
+async def _archive_pass(source, archive_collection, cutoff, buckets):
+    """Archives one batch; returns the number of exchanges moved."""
+    if buckets:
+        cursor = source.find({"end": {"$lt": cutoff}}).sort([("user_id", 1), ("start", 1)]).limit(ARCHIVE_BATCH)
+    else:
+        cursor = (
+            source.find({"timestamp": {"$lt": cutoff}}, allow_disk_use=True)
+            .sort([("user_id", 1), ("timestamp", 1)])
+            .limit(ARCHIVE_BATCH)
+        )
+
+    per_user = {}
+    source_ids = []
+    async for doc in cursor:
+        source_ids.append(doc["_id"])
+        if buckets:
+            per_user.setdefault(doc.get("user_id"), []).extend(doc.get("exchanges") or [])
+        else:
+            per_user.setdefault(doc.get("user_id"), []).append(doc)
+    if not source_ids:
+        return 0
+
+    chunks = []
+    moved = 0
+    for user_id, docs in per_user.items():
+        docs.sort(key=lambda d: _utc(d.get("timestamp")) or cutoff)
+        chunks.extend(build_chunks(user_id, docs))
+        moved += len(docs)
+
+    try:
+        await archive_collection.insert_many(chunks, ordered=False)
+    except BulkWriteError as e:
+        # chunks already written by a pass that crashed before deleting its source
+        if any(err.get("code") != DUPLICATE_KEY for err in e.details.get("writeErrors", [])):
+            raise
+    for start in range(0, len(source_ids), 1000):
+        await source.delete_many({"_id": {"$in": source_ids[start:start + 1000]}})
+    return moved
+
+
+async def archive_old_chats(source, archive_collection, meta_collection, days=ARCHIVE_AFTER_DAYS,
+                            buckets=False, owner="worker", max_passes=100):
+    """Moves exchanges older than `days` into the archive. Returns the number moved."""
+    if not await acquire_lease(meta_collection, owner):
+        return 0
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)
+    moved = 0
+    for _ in range(max_passes):
+        n = await _archive_pass(source, archive_collection, cutoff, buckets)
+        moved += n
+        if n == 0:
+            break
+        await acquire_lease(meta_collection, owner)  # extend while work remains
+    await meta_collection.update_one(
+        {"_id": "archiver"},
+        {"$set": {"last_run": datetime.datetime.now(datetime.timezone.utc), "last_moved": moved}},
+    )
+    return moved
+
+
+async def read_archived(archive_collection, user_id, before=None, limit=100, skip_keys=()):
+    """
+    The user's newest `limit` archived exchanges older than `before`, in chronological
+    order, with timestamps as aware datetimes. Rows whose row_key is in `skip_keys`
+    (already returned from hot storage) or repeated across chunks are dropped. Only
+    the chunks needed are decompressed.
+    """
+    query = {"user_id": user_id}
+    if before is not None:
+        query["first_ts"] = {"$lt": before}
+    seen = set(skip_keys)
+    collected = []
+    async for chunk in archive_collection.find(query).sort("last_ts", -1):
+        rows = await asyncio.to_thread(_decode, chunk["data"], chunk.get("codec", "gzip"))
+        fresh = []
+        for r in reversed(rows):
+            key = row_key(r)
+            if (before is None or r["timestamp"] < before) and key not in seen:
+                seen.add(key)
+                fresh.append(r)
+        fresh.reverse()
+        collected = fresh + collected
+        if len(collected) >= limit:
+            break
+    collected.sort(key=lambda r: r["timestamp"])
+    return [{"user_id": user_id, **r} for r in collected[-limit:]]
+
+
+async def iter_archived(archive_collection, query=None):
+    """Every archived exchange matching the chunk `query` (e.g. {"user_id": ...}), deduplicated."""
+    user_id, seen = None, set()
+    async for chunk in archive_collection.find(query or {}).sort([("user_id", 1), ("first_ts", 1)]):
+        if chunk.get("user_id") != user_id:
+            user_id, seen = chunk.get("user_id"), set()
+        for r in await asyncio.to_thread(_decode, chunk["data"], chunk.get("codec", "gzip")):
+            key = row_key(r)
+            if key not in seen:
+                seen.add(key)
+                yield {"user_id": user_id, **r}
+
+
+async def archive_stats(archive_collection, meta_collection):
+    totals = await archive_collection.aggregate([
+        {"$group": {"_id": "$user_id", "chunks": {"$sum": 1}, "exchanges": {"$sum": "$count"},
+                    "bytes": {"$sum": {"$binarySize": "$data"}}}},
+        {"$group": {"_id": None, "users": {"$sum": 1}, "chunks": {"$sum": "$chunks"},
+                    "exchanges": {"$sum": "$exchanges"}, "bytes": {"$sum": "$bytes"}}},
+        {"$project": {"_id": 0}},
+    ], allowDiskUse=True).to_list(length=1)
+    meta = await meta_collection.find_one({"_id": "archiver"}) or {}
+    stats = totals[0] if totals else {"chunks": 0, "exchanges": 0, "bytes": 0, "users": 0}
+    stats.update({
+        "codec": ARCHIVE_CODEC,
+        "archive_after_days": ARCHIVE_AFTER_DAYS,
+        "last_run": meta.get("last_run"),
+        "last_moved": meta.get("last_moved"),
+    })
+    return stats
+
+
+async def _run_cli(args):
+    import main
+
+    buckets = main.CHAT_STORAGE == "buckets"
+    source = main.chat_bucket_collection if buckets else main.chat_collection
+    if args.command == "run":
+        await ensure_indexes(main.db.chat_archive, None if buckets else main.chat_collection)
+        moved = await archive_old_chats(source, main.db.chat_archive, main.db.chat_archive_meta,
+                                        days=args.days, buckets=buckets, owner="cli")
+        print(f"[OK] Archived {moved} exchanges older than {args.days:g} days")
+    print(json.dumps(await archive_stats(main.db.chat_archive, main.db.chat_archive_meta), default=str, indent=2))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Archive old chats into compressed chunks.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run_p = sub.add_parser("run", help="Archive exchanges older than --days now")
+    run_p.add_argument("--days", type=float, default=ARCHIVE_AFTER_DAYS or 180)
+    sub.add_parser("stats", help="Archive size and last run")
+    asyncio.run(_run_cli(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,327 @@
+"""
+Bucketed chat storage (CHAT_STORAGE=buckets).
+
+Instead of one `chats` document per exchange, each user gets one `chat_buckets`
+document per period (BUCKET_PERIOD: month or day) holding an array of exchanges.
+New exchanges are appended with $push to the user's open bucket for the period,
+identified by its `seq` number; (user_id, period, seq) is unique. A bucket that
+reaches BUCKET_MAX_EXCHANGES stops matching the upsert filter, so the upsert collides
+with it on the unique index and the writer moves on to seq + 1. Concurrent first
+appends collide the same way and the loser retries into the winner's bucket, so a
+period never gets two open buckets. $slice bounds the array regardless.
+
+Recent history is one indexed read of the newest bucket(s) with a $slice projection,
+and the (user_id, start) index has one entry per bucket instead of one per exchange.
+
+Migrate existing chats with:
+
+    python chat_buckets.py migrate [--drop]
+    python chat_buckets.py stats
+"""
+import os
+import asyncio
+import argparse
+import datetime
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+BUCKET_PERIOD = os.getenv("BUCKET_PERIOD", "month")
+BUCKET_MAX_EXCHANGES = int(os.getenv("BUCKET_MAX_EXCHANGES", "200"))
+MAX_APPEND_ATTEMPTS = 10
+DUPLICATE_KEY = 11000
+
+_PERIOD_FORMATS = {"month": "%Y-%m", "day": "%Y-%m-%d"}
+
+
+def period_key(ts):
+    return ts.strftime(_PERIOD_FORMATS.get(BUCKET_PERIOD, "%Y-%m"))
+
+
+# (user_id, period) -> seq of the bucket this worker last appended to
+_open_seq = {}
+
+
+async def ensure_indexes(bucket_collection):
+    await bucket_collection.create_index([("user_id", 1), ("start", -1)])
+    # buckets written before seq existed are left out of the unique index
+    await bucket_collection.create_index(
+        [("user_id", 1), ("period", 1), ("seq", 1)], unique=True,
+        partialFilterExpression={"seq": {"$exists": True}},
+    )
+
+
+async def _open_bucket_seq(bucket_collection, user_id, period):
+    """seq of the user's newest bucket for `period` if it has room, else the next one."""
+    newest = await bucket_collection.find_one(
+        {"user_id": user_id, "period": period, "seq": {"$exists": True}},
+        {"seq": 1, "count": 1}, sort=[("seq", -1)],
+    )
+    if newest is None:
+        seq = 0
+    else:
+        seq = newest["seq"] + (1 if newest.get("count", 0) >= BUCKET_MAX_EXCHANGES else 0)
+    if len(_open_seq) > 50000:
+        _open_seq.clear()
+    _open_seq[(user_id, period)] = seq
+    return seq
+
+
+def _append_update(user_id, exchange, seq=None):
+    """(filter, update) that pushes `exchange` onto bucket `seq` of its period, opening it if missing."""
+    ts = exchange["timestamp"]
+    period = period_key(ts)
+    if seq is None:
+        seq = _open_seq.get((user_id, period), 0)
+    return (
+        {"user_id": user_id, "period": period, "seq": seq, "count": {"$lt": BUCKET_MAX_EXCHANGES}},
+        {
+            "$push": {"exchanges": {"$each": [exchange], "$slice": -BUCKET_MAX_EXCHANGES}},
+            "$inc": {"count": 1},
+            "$max": {"end": ts},
+            "$setOnInsert": {"start": ts},
+        },
+    )
+
+
+def _exchange(doc):
+    """Exchange entry as stored inside a bucket (user_id lives on the bucket)."""
+    return {k: v for k, v in doc.items() if k not in ("_id", "user_id")}
+
+
+async def append_exchange(bucket_collection, user_id, exchange):
+    """Appends one exchange ({role, message, response, timestamp, ...}) to the user's current bucket."""
+    exchange = _exchange(exchange)
+    seq = None
+    for _ in range(MAX_APPEND_ATTEMPTS):
+        query, update = _append_update(user_id, exchange, seq)
+        try:
+            await bucket_collection.update_one(query, update, upsert=True)
+            return
+        except DuplicateKeyError:
+            # that bucket is full, or another writer just opened it
+            seq = await _open_bucket_seq(bucket_collection, user_id, query["period"])
+    raise RuntimeError(f"Could not find an open chat bucket for {user_id}")
+
+
+async def append_many(bucket_collection, chat_docs):
+    """Appends chat documents (with user_id) in ordered bulk writes, resuming after bucket collisions."""
+    pending = [(doc["user_id"], _exchange(doc)) for doc in chat_docs]
+    attempts_left = MAX_APPEND_ATTEMPTS + len(pending)  # each exchange may roll over to a new bucket once
+    while pending:
+        ops = [UpdateOne(*_append_update(user_id, exchange), upsert=True) for user_id, exchange in pending]
+        try:
+            await bucket_collection.bulk_write(ops, ordered=True)
+            return
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors") or []
+            attempts_left -= 1
+            if not errors or errors[0].get("code") != DUPLICATE_KEY or attempts_left <= 0:
+                raise
+            # ops before the failed one were applied; find the open bucket and resume from it
+            pending = pending[errors[0]["index"]:]
+            user_id, exchange = pending[0]
+            await _open_bucket_seq(bucket_collection, user_id, period_key(exchange["timestamp"]))
+
+
+def _flatten(bucket):
+    user_id = bucket.get("user_id")
+    return [{"user_id": user_id, **ex} for ex in bucket.get("exchanges") or []]
+
+
+async def recent_exchanges(bucket_collection, user_id, limit=3):
+    """The user's last `limit` exchanges in chronological order, from at most two buckets."""
+    cursor = (
+        bucket_collection.find({"user_id": user_id}, {"user_id": 1, "exchanges": {"$slice": -limit}})
+        .sort("start", -1)
+        .limit(2)
+    )
+    exchanges = []
+    for bucket in reversed(await cursor.to_list(length=2)):
+        exchanges.extend(_flatten(bucket))
+    return exchanges[-limit:]
+
+
+async def exchanges_before(bucket_collection, user_id, before=None, limit=100):
+    """The user's newest `limit` exchanges older than `before`, in chronological order."""
+    query = {"user_id": user_id}
+    if before is not None:
+        query["start"] = {"$lt": before}
+    exchanges = []
+    async for bucket in bucket_collection.find(query).sort("start", -1):
+        rows = _flatten(bucket)
+        if before is not None:
+            rows = [r for r in rows if _aware(r.get("timestamp")) < before]
+        exchanges = rows + exchanges
+        if len(exchanges) >= limit:
+            break
+    return exchanges[-limit:]
+
+
+def _aware(ts):
+    return ts.replace(tzinfo=datetime.timezone.utc) if ts is not None and ts.tzinfo is None else ts
+
+
+class ExchangeView:
+    """
+    Read-only, chats-shaped view over the buckets for tools that scan `chats`
+    (FAQ mining, exports). Supports find(query, projection) with an optional
+    timestamp condition, iterated with `async for` or to_list().
+    """
+
+    def __init__(self, bucket_collection):
+        self.bucket_collection = bucket_collection
+
+    def find(self, query=None, projection=None, sort=None, limit=None):
+        query = dict(query or {})
+        bucket_match = {}
+        if "user_id" in query:
+            bucket_match["user_id"] = query["user_id"]
+        since = (query.get("timestamp") or {}).get("$gt") if isinstance(query.get("timestamp"), dict) else None
+        if since is not None:
+            bucket_match["end"] = {"$gt": since}  # skip buckets with nothing new
+
+        pipeline = [
+            {"$match": bucket_match},
+            {"$unwind": "$exchanges"},
+            {"$replaceRoot": {"newRoot": {"$mergeObjects": [{"user_id": "$user_id"}, "$exchanges"]}}},
+        ]
+        if query:
+            pipeline.append({"$match": query})
+        if sort:
+            pipeline.append({"$sort": dict(sort)})
+        if limit:
+            pipeline.append({"$limit": limit})
+        if projection:
+            pipeline.append({"$project": projection})
+        return self.bucket_collection.aggregate(pipeline, allowDiskUse=True)
+
+
+async def latest_exchanges(bucket_collection, limit=500):
+    """Most recent exchanges across all users, newest first (admin view)."""
+    return await ExchangeView(bucket_collection).find(sort=[("timestamp", -1)], limit=limit).to_list(length=limit)
+
+
+def recent_history_pipeline(since, per_user=3, max_users=2000):
+    """
+    Bucket counterpart of history_store.recent_history_pipeline: the last
+    `per_user` exchanges of users active since `since`, newest first.
+    """
+    return [
+        {"$match": {"end": {"$gte": since}}},
+        {"$group": {
+            "_id": "$user_id",
+            "last_active": {"$max": "$end"},
+            # the two newest buckets' tails are enough for `per_user` exchanges
+            "buckets": {"$topN": {"n": 2, "sortBy": {"start": -1}, "output": {"$slice": ["$exchanges", -per_user]}}},
+        }},
+        {"$sort": {"last_active": -1}},
+        {"$limit": max_users},
+        # newest bucket first; reverse each so the flattened list runs newest to oldest
+        {"$project": {"chats": {"$slice": [
+            {"$reduce": {
+                "input": "$buckets",
+                "initialValue": [],
+                "in": {"$concatArrays": ["$$value", {"$reverseArray": "$$this"}]},
+            }},
+            per_user,
+        ]}}},
+    ]
+
+
+# --- MIGRATION ---
+
+def build_buckets(user_id, chat_docs):
+    """Bucket documents for one user's chats (chronological), split by period and size."""
+    buckets = []
+    current = None
+    seqs = {}
+    for doc in chat_docs:
+        ts = doc.get("timestamp") or datetime.datetime.now(datetime.timezone.utc)
+        key = period_key(ts)
+        if current is None or current["period"] != key or current["count"] >= BUCKET_MAX_EXCHANGES:
+            seq = seqs[key] = seqs.get(key, -1) + 1
+            current = {"user_id": user_id, "period": key, "seq": seq, "start": ts, "end": ts, "count": 0,
+                       "exchanges": []}
+            buckets.append(current)
+        current["exchanges"].append(_exchange({**doc, "timestamp": ts}))
+        current["count"] += 1
+        current["end"] = max(current["end"], ts)
+    return buckets
+
+
+async def migrate(chat_collection, bucket_collection, drop=False, batch_size=500):
+    """Copies every `chats` document into buckets. Returns (chats read, buckets written)."""
+    if drop:
+        await bucket_collection.drop()
+    elif await bucket_collection.estimated_document_count():
+        raise RuntimeError("chat_buckets is not empty; use --drop to rebuild it")
+    await ensure_indexes(bucket_collection)
+
+    chats_read = 0
+    buckets_written = 0
+    pending = []
+    user_id, user_chats = None, []
+
+    async def flush_user():
+        nonlocal buckets_written
+        if user_chats:
+            pending.extend(build_buckets(user_id, user_chats))
+        if len(pending) >= batch_size:
+            await bucket_collection.insert_many(pending, ordered=False)
+            buckets_written += len(pending)
+            pending.clear()
+
+    cursor = chat_collection.find({}, {"_id": 0}).sort([("user_id", 1), ("timestamp", 1)])
+    async for doc in cursor:
+        chats_read += 1
+        if doc.get("user_id") != user_id:
+            await flush_user()
+            user_id, user_chats = doc.get("user_id"), []
+        user_chats.append(doc)
+    await flush_user()
+    if pending:
+        await bucket_collection.insert_many(pending, ordered=False)
+        buckets_written += len(pending)
+    return chats_read, buckets_written
+
+
+async def collection_stats(db, name):
+    try:
+        s = await db.command("collStats", name)
+        return {"documents": s.get("count", 0), "data_bytes": s.get("size", 0), "index_bytes": s.get("totalIndexSize", 0)}
+    except Exception:
+        return {"documents": 0, "data_bytes": 0, "index_bytes": 0}
+
+
+async def _run_cli(args):
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    client = AsyncIOMotorClient(os.getenv("MONGO_URI", "mongodb://localhost:27017"))
+    try:
+        db = client.get_default_database()
+    except Exception:
+        db = client.vu_ai_agent
+
+    if args.command == "migrate":
+        chats_read, buckets_written = await migrate(db.chats, db.chat_buckets, drop=args.drop)
+        print(f"[OK] Migrated {chats_read} chats into {buckets_written} buckets ({BUCKET_PERIOD} periods)")
+
+    for name in ("chats", "chat_buckets"):
+        s = await collection_stats(db, name)
+        print(f"   {name:<14} docs={s['documents']:<8} data={s['data_bytes'] / 1024:.1f}KB index={s['index_bytes'] / 1024:.1f}KB")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Bucketed chat storage tools.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    migrate_p = sub.add_parser("migrate", help="Copy chats into chat_buckets")
+    migrate_p.add_argument("--drop", action="store_true", help="Rebuild chat_buckets from scratch")
+    sub.add_parser("stats", help="Compare document and index sizes")
+    asyncio.run(_run_cli(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main_cli()
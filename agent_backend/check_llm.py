@@ -1,6 +1,30 @@
+"""
+LLM provider checks.
+
+    python check_llm.py                      # one test prompt to the configured LLM_PROVIDER
+    python check_llm.py probe                # latency/throughput of every configured provider
+    python check_llm.py probe --concurrency 1,4,16 --requests 32 --providers openai,google
+    python check_llm.py probe --mock         # offline, against the local mock server
+    python check_llm.py mock-server --port 8765
+
+The probe sends a fixed prompt set to all configured providers at the same time, at
+each concurrency level, streaming every answer. It reports time to first token,
+output tokens per second, total latency percentiles, throughput and error rate as a
+table plus a JSON report under bench_results/. The mock server speaks the OpenAI chat
+completions API (streaming included) with configurable first-token delay, token rate
+and error rate, so the probe (or the app, via OPENAI_BASE_URL) runs without network.
+"""
 import os
 import sys
+import json
+import time
+import random
 import asyncio
+import hashlib
+import argparse
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -138,5 +162,352 @@ def check_ollama():
         print(f"❌ Generation Error: {e}")
         return False
 
+# --- Concurrent latency / throughput probe ---
+
+RESULTS_DIR = "bench_results"
+PROBE_TIMEOUT_SECONDS = 60
+
+# Fixed prompt set: greeting, short factual, explanation, long-form
+PROBE_PROMPTS = [
+    "Hello!",
+    "What is a stack in data structures? Answer in one sentence.",
+    "Explain the difference between a process and a thread with an example.",
+    "List five tips for preparing for a university operating systems exam.",
+    "Write a short Python function that reverses a linked list and explain how it works.",
+    "Summarize what a B-tree is and why databases use it.",
+]
+PROBE_SYSTEM = "You are Vu AI, a concise university assistant."
+
+# name -> (first token delay ms, tokens per second, error rate)
+MOCK_PROFILES = {
+    "mock-fast": (120, 120.0, 0.0),
+    "mock-slow": (600, 35.0, 0.02),
+    "mock-flaky": (250, 70.0, 0.15),
+}
+
+
+def _mock_words(prompt, n):
+    seed = int(hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8], 16)
+    rng = random.Random(seed)
+    vocab = ("the stack queue process thread memory index exam module course answer "
+             "example because each step returns value node tree student system").split()
+    return [rng.choice(vocab) for _ in range(n)]
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    """OpenAI-compatible POST /<profile>/v1/chat/completions with timing from MOCK_PROFILES."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        parts = self.path.strip("/").split("/")
+        profile = parts[0] if parts and parts[0] in MOCK_PROFILES else "mock-fast"
+        ttft_ms, rate, error_rate = MOCK_PROFILES[profile]
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        messages = body.get("messages") or [{}]
+        prompt = str(messages[-1].get("content", ""))
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in messages)
+
+        if random.random() < error_rate:
+            time.sleep(ttft_ms / 1000.0)
+            return self._send_json(503, {"error": {"message": "mock overload", "type": "server_error"}})
+
+        words = _mock_words(prompt, 40 + len(prompt) % 80)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                 "total_tokens": prompt_tokens + len(words)}
+        base = {"id": "chatcmpl-mock", "created": int(time.time()), "model": profile}
+        time.sleep(ttft_ms / 1000.0)
+
+        if not body.get("stream"):
+            time.sleep(len(words) / rate)
+            return self._send_json(200, {
+                **base, "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        def event(payload):
+            self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        chunk = {**base, "object": "chat.completion.chunk"}
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(1.0 / rate)
+            event({**chunk, "choices": [{"index": 0, "delta": {"content": (" " if i else "") + word},
+                                         "finish_reason": None}]})
+        event({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if (body.get("stream_options") or {}).get("include_usage"):
+            event({**chunk, "choices": [], "usage": usage})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+
+def start_mock_server(port=0):
+    """Starts the mock server on a daemon thread; returns (server, base_url)."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockLLMHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-llm", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def _ollama_up(url):
+    try:
+        import requests
+        return requests.get(url, timeout=1).status_code == 200
+    except Exception:
+        return False
+
+
+def configured_providers(mock_url=None):
+    """[(name, model_name, factory)] for every provider with credentials (or the mock profiles)."""
+    if mock_url:
+        from langchain_openai import ChatOpenAI
+        return [
+            (name, name, lambda name=name: ChatOpenAI(model=name, api_key="mock", base_url=f"{mock_url}/{name}/v1",
+                                                      max_retries=0, stream_usage=True))
+            for name in MOCK_PROFILES
+        ]
+
+    providers = []
+    if os.getenv("OPENAI_API_KEY"):
+        def openai_factory():
+            from langchain_openai import ChatOpenAI
+            return ChatOpenAI(model=os.getenv("OPENAI_MODEL", "gpt-4"), api_key=os.getenv("OPENAI_API_KEY"),
+                              base_url=os.getenv("OPENAI_BASE_URL"), temperature=0.5, max_retries=0,
+                              stream_usage=True)
+        providers.append(("openai", os.getenv("OPENAI_MODEL", "gpt-4"), openai_factory))
+    if os.getenv("SAMBANOVA_API_KEY"):
+        def sambanova_factory():
+            from langchain_openai import ChatOpenAI
+            return ChatOpenAI(model=os.getenv("SAMBANOVA_MODEL", "Meta-Llama-3.1-70B-Instruct"),
+                              api_key=os.getenv("SAMBANOVA_API_KEY"),
+                              base_url=os.getenv("SAMBANOVA_BASE_URL", "https://api.sambanova.ai/v1"),
+                              temperature=0.5, max_retries=0, stream_usage=True)
+        providers.append(("sambanova", os.getenv("SAMBANOVA_MODEL", "Meta-Llama-3.1-70B-Instruct"), sambanova_factory))
+    if os.getenv("GOOGLE_API_KEY"):
+        def google_factory():
+            from langchain_google_genai import ChatGoogleGenerativeAI
+            return ChatGoogleGenerativeAI(model=os.getenv("GOOGLE_MODEL", "gemini-1.0-pro"),
+                                          google_api_key=os.getenv("GOOGLE_API_KEY"), max_retries=0)
+        providers.append(("google", os.getenv("GOOGLE_MODEL", "gemini-1.0-pro"), google_factory))
+    if _ollama_up("http://127.0.0.1:11434"):
+        def ollama_factory():
+            from langchain_community.chat_models import ChatOllama
+            return ChatOllama(model=os.getenv("OLLAMA_MODEL", "llama3"), temperature=0.7)
+        providers.append(("ollama", os.getenv("OLLAMA_MODEL", "llama3"), ollama_factory))
+    return providers
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+async def probe_once(model, prompt, timeout):
+    """Streams one answer. Returns a dict with ttft, latency (seconds), output tokens and error."""
+    from langchain_core.messages import HumanMessage, SystemMessage
+
+    start = time.perf_counter()
+    result = {"ttft": None, "latency": None, "tokens": 0, "estimated_tokens": False, "error": None}
+    chars = 0
+    usage_tokens = None
+
+    async def consume():
+        nonlocal chars, usage_tokens
+        async for chunk in model.astream([SystemMessage(content=PROBE_SYSTEM), HumanMessage(content=prompt)]):
+            text = chunk.content if isinstance(chunk.content, str) else str(chunk.content or "")
+            if text and result["ttft"] is None:
+                result["ttft"] = time.perf_counter() - start
+            chars += len(text)
+            usage = getattr(chunk, "usage_metadata", None)
+            if usage and usage.get("output_tokens"):
+                usage_tokens = usage["output_tokens"]
+
+    try:
+        await asyncio.wait_for(consume(), timeout)
+        result["latency"] = time.perf_counter() - start
+        if usage_tokens is None:
+            usage_tokens = max(1, round(chars / 4))  # ~4 characters per token
+            result["estimated_tokens"] = True
+        result["tokens"] = usage_tokens
+    except asyncio.TimeoutError:
+        result["error"] = "Timeout"
+    except Exception as e:
+        result["error"] = type(e).__name__
+    return result
+
+
+async def probe_provider(name, model, concurrency, n_requests, timeout):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            return await probe_once(model, PROBE_PROMPTS[i % len(PROBE_PROMPTS)], timeout)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one(i) for i in range(n_requests)))
+    return summarize(name, concurrency, results, time.perf_counter() - start)
+
+
+def summarize(name, concurrency, results, wall):
+    ok = [r for r in results if r["error"] is None]
+    errors = {}
+    for r in results:
+        if r["error"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    ttfts = sorted(r["ttft"] * 1000 for r in ok if r["ttft"] is not None)
+    latencies = sorted(r["latency"] * 1000 for r in ok)
+    # Generation speed per answer: tokens after the first one over the streaming time
+    rates = sorted(
+        r["tokens"] / (r["latency"] - r["ttft"])
+        for r in ok if r["ttft"] is not None and r["latency"] > r["ttft"]
+    )
+
+    def ms(value):
+        return round(value, 1) if value is not None else None
+
+    return {
+        "provider": name,
+        "concurrency": concurrency,
+        "requests": len(results),
+        "ok": len(ok),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0,
+        "errors": errors,
+        "ttft_ms": {"p50": ms(percentile(ttfts, 50)), "p95": ms(percentile(ttfts, 95))},
+        "latency_ms": {"p50": ms(percentile(latencies, 50)), "p95": ms(percentile(latencies, 95)),
+                       "p99": ms(percentile(latencies, 99)), "max": ms(latencies[-1] if latencies else None)},
+        "tokens_per_s": {"p50": ms(percentile(rates, 50)), "p5": ms(percentile(rates, 5))},
+        "throughput_rps": round(len(ok) / wall, 2) if wall > 0 else None,
+        "aggregate_tokens_per_s": round(sum(r["tokens"] for r in ok) / wall, 1) if wall > 0 else None,
+        "estimated_tokens": any(r["estimated_tokens"] for r in ok),
+        "wall_s": round(wall, 2),
+    }
+
+
+def print_table(rows):
+    print(f"{'provider':<14}{'conc':>5}{'ok/n':>9}{'err%':>7}{'ttft p50':>10}{'ttft p95':>10}"
+          f"{'lat p50':>10}{'lat p95':>10}{'lat p99':>10}{'tok/s':>8}{'req/s':>8}")
+    for r in rows:
+        def f(v):
+            return "-" if v is None else f"{v:g}"
+        print(f"{r['provider']:<14}{r['concurrency']:>5}{str(r['ok']) + '/' + str(r['requests']):>9}"
+              f"{r['error_rate'] * 100:>7.1f}{f(r['ttft_ms']['p50']):>10}{f(r['ttft_ms']['p95']):>10}"
+              f"{f(r['latency_ms']['p50']):>10}{f(r['latency_ms']['p95']):>10}{f(r['latency_ms']['p99']):>10}"
+              f"{f(r['tokens_per_s']['p50']):>8}{f(r['throughput_rps']):>8}")
+    if any(r["estimated_tokens"] for r in rows):
+        print("(token counts estimated from characters where the provider reports no usage)")
+
+
+async def run_probe(args):
+    server = None
+    mock_url = None
+    if args.mock:
+        server, mock_url = start_mock_server()
+        print(f"🧪 Mock LLM server at {mock_url} (profiles: {', '.join(MOCK_PROFILES)})")
+
+    providers = configured_providers(mock_url)
+    if args.providers:
+        wanted = {p.strip().lower() for p in args.providers.split(",")}
+        providers = [p for p in providers if p[0] in wanted]
+    if not providers:
+        print("❌ No configured providers (set API keys in .env, start Ollama, or use --mock)")
+        return None
+
+    models = {}
+    for name, model_name, factory in providers:
+        try:
+            models[name] = (model_name, factory())
+            print(f"✅ {name}: {model_name}")
+        except Exception as e:
+            print(f"❌ {name}: could not create client ({e})")
+
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    rows = []
+    for level in levels:
+        n_requests = args.requests or max(2 * level, len(PROBE_PROMPTS))
+        print(f"⏳ Concurrency {level}: {n_requests} requests per provider, all providers at once...")
+        summaries = await asyncio.gather(*(
+            probe_provider(name, model, level, n_requests, args.timeout) for name, (_, model) in models.items()
+        ))
+        for summary in summaries:
+            summary["model"] = models[summary["provider"]][0]
+        rows.extend(summaries)
+
+    if server is not None:
+        server.shutdown()
+    return rows
+
+
+def probe_main(args):
+    print_header("LLM PROVIDER PROBE")
+    rows = asyncio.run(run_probe(args))
+    if not rows:
+        return False
+
+    print()
+    print_table(rows)
+
+    timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    out_path = args.out or os.path.join(RESULTS_DIR, f"llm-probe-{timestamp}.json")
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    config = {k: v for k, v in vars(args).items() if k not in ("out", "command")}
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump({"timestamp": timestamp, "config": config, "prompts": PROBE_PROMPTS, "results": rows}, f, indent=2)
+    print(f"\n✅ Report saved to {out_path}")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and compare the configured LLM providers.")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("check", help="Send one test prompt to LLM_PROVIDER (default)")
+    probe_p = sub.add_parser("probe", help="Concurrent latency/throughput comparison of all providers")
+    probe_p.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrency levels")
+    probe_p.add_argument("--requests", type=int, default=0,
+                         help="Requests per provider per level (default: max(2 x concurrency, prompt count))")
+    probe_p.add_argument("--providers", help="Only these providers (comma-separated)")
+    probe_p.add_argument("--timeout", type=float, default=PROBE_TIMEOUT_SECONDS, help="Seconds per request")
+    probe_p.add_argument("--mock", action="store_true", help="Probe the local mock server instead of real providers")
+    probe_p.add_argument("--out", help="JSON report path (default bench_results/llm-probe-<timestamp>.json)")
+    mock_p = sub.add_parser("mock-server", help="Run the OpenAI-compatible mock server in the foreground")
+    mock_p.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    if args.command == "probe":
+        return probe_main(args)
+    if args.command == "mock-server":
+        server, url = start_mock_server(args.port)
+        print(f"🧪 Mock LLM server at {url}; use OPENAI_BASE_URL={url}/mock-fast/v1 (Ctrl+C to stop)")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+        return True
+    return check_setup()
+
+
 if __name__ == "__main__":
-    check_setup()
+    sys.exit(0 if main() else 1)
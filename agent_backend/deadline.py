@@ -0,0 +1,77 @@
+"""
+Per-request deadline budget.
+
+A Deadline is created once per request (from the X-Request-Deadline-Ms header or the
+default) and every awaited step takes its timeout from it: knowledge and history
+fetch, each LLM attempt and every retry backoff. Work stops as soon as the budget is
+spent or the client disconnects, so no provider tokens go to answers nobody receives.
+"""
+import os
+import time
+import asyncio
+
+DEFAULT_DEADLINE_SECONDS = float(os.getenv("CHAT_DEADLINE_SECONDS", "25"))
+MAX_DEADLINE_SECONDS = float(os.getenv("CHAT_MAX_DEADLINE_SECONDS", "120"))
+DEADLINE_HEADER = "X-Request-Deadline-Ms"
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """Raised when a request's budget runs out; handled like any LLM timeout."""
+
+
+class ClientDisconnected(Exception):
+    """The client went away before the response was ready."""
+
+
+class Deadline:
+    __slots__ = ("budget", "expires_at")
+
+    def __init__(self, seconds):
+        self.budget = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def from_header(cls, value, default=DEFAULT_DEADLINE_SECONDS):
+        """Budget from a millisecond header value, clamped to the server maximum."""
+        try:
+            seconds = float(value) / 1000.0 if value else default
+        except (TypeError, ValueError):
+            seconds = default
+        return cls(max(0.0, min(seconds, MAX_DEADLINE_SECONDS)))
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, cap=None):
+        """Timeout for the next step: what is left, optionally capped per step."""
+        left = self.remaining()
+        if left <= 0:
+            raise DeadlineExceeded("Request deadline exceeded")
+        return min(left, cap) if cap else left
+
+    def allows(self, seconds):
+        """True if sleeping `seconds` still leaves some budget for the next attempt."""
+        return seconds < self.remaining()
+
+
+async def run_until_disconnected(http_request, coro, poll_interval=0.25):
+    """
+    Runs `coro` while polling the client connection; cancels it and raises
+    ClientDisconnected if the client goes away first.
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                task.cancel()
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
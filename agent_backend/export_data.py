@@ -4,6 +4,9 @@ import json
 from motor.motor_asyncio import AsyncIOMotorClient
 from dotenv import load_dotenv
 
+import chat_archive
+import chat_buckets
+
 load_dotenv()
 
 async def export_data():
@@ -27,11 +30,13 @@ async def export_data():
         json.dump(users, f, default=default_serializer, indent=2)
     print(f"Exported {len(users)} users to data_export/users.json")
 
-    # Chats
+    # Chats: hot documents, bucketed exchanges (CHAT_STORAGE=buckets) and the archive
     chats = await db.chats.find().to_list(length=1000)
+    chats += await chat_buckets.ExchangeView(db.chat_buckets).find().to_list(length=1000)
+    archived = [row async for row in chat_archive.iter_archived(db.chat_archive)]
     with open("data_export/chats.json", "w") as f:
-        json.dump(chats, f, default=default_serializer, indent=2)
-    print(f"Exported {len(chats)} chats to data_export/chats.json")
+        json.dump(chats + archived, f, default=default_serializer, indent=2)
+    print(f"Exported {len(chats)} chats and {len(archived)} archived exchanges to data_export/chats.json")
 
 if __name__ == "__main__":
     asyncio.run(export_data())
@@ -0,0 +1,210 @@
+"""
+Precomputed FAQ answers mined from chat history.
+
+The mining job groups normalized questions from the chats collection by role,
+generates an answer once for the most frequent ones and stores them in the `faqs`
+collection. Only vetted entries are served; chat() answers a matching question from
+memory before building a prompt or calling the LLM.
+
+    python faq_store.py mine --top 50 --min-count 3     # incremental, since last run
+    python faq_store.py list --role student             # review generated answers
+    python faq_store.py approve <faq id> [...]          # mark answers as vetted
+"""
+import os
+import re
+import asyncio
+import argparse
+import datetime
+
+from pymongo import UpdateOne
+
+FAQ_MIN_COUNT = int(os.getenv("FAQ_MIN_COUNT", "3"))
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_STOPWORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "to", "of", "in", "on", "for", "and", "or",
+    "me", "my", "i", "you", "your", "we", "our", "it", "this", "that", "what", "whats", "how", "do",
+    "does", "can", "could", "would", "please", "pls", "tell", "about", "hi", "hello", "hey", "vu", "ai",
+}
+
+
+def normalize_question(text):
+    """
+    Canonical key for a question: lowercase content words in their original order,
+    repeats dropped, so "What is the fee structure?" and "fee structure please" share
+    a key while "convert binary to decimal" and "convert decimal to binary" do not.
+    Returns "" for messages too short or too long to be FAQ candidates.
+    """
+    words = [w for w in _WORD_RE.findall((text or "").lower()) if w not in _STOPWORDS]
+    if not words or len(words) > 12:
+        return ""
+    return " ".join(dict.fromkeys(words))
+
+
+class FAQStore:
+    """In-memory view of the vetted FAQ entries, keyed by (role, normalized question)."""
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.loaded_at = None
+
+    async def refresh(self, collection):
+        entries = {}
+        async for doc in collection.find({"vetted": True, "answer": {"$ne": None}}, {"role": 1, "key": 1, "answer": 1}):
+            entries[(doc["role"], doc["key"])] = doc["answer"]
+        self.entries = entries
+        self.loaded_at = datetime.datetime.now(datetime.timezone.utc)
+        return len(entries)
+
+    def lookup(self, role, message):
+        """Stored answer for a confident (exact normalized) match, else None."""
+        if not self.entries:
+            return None
+        key = normalize_question(message)
+        answer = self.entries.get(((role or "").lower(), key)) if key else None
+        if answer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return answer
+
+    def stats(self):
+        total = self.hits + self.misses
+        per_role = {}
+        for role, _ in self.entries:
+            per_role[role] = per_role.get(role, 0) + 1
+        return {
+            "entries": len(self.entries),
+            "entries_per_role": per_role,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+        }
+
+
+async def ensure_indexes(faq_collection):
+    await faq_collection.create_index([("role", 1), ("key", 1)], unique=True)
+    await faq_collection.create_index([("role", 1), ("count", -1)])
+
+
+async def mine_new_chats(chat_collection, faq_collection, meta_collection):
+    """
+    Folds chats recorded since the last run into the per-question counters.
+    Returns the number of chats scanned.
+    """
+    meta = await meta_collection.find_one({"_id": "faq_miner"}) or {}
+    since = meta.get("last_mined_at")
+    query = {"timestamp": {"$gt": since}} if since else {}
+
+    counts = {}
+    samples = {}
+    newest = since
+    scanned = 0
+    async for chat in chat_collection.find(query, {"role": 1, "message": 1, "timestamp": 1}):
+        scanned += 1
+        role = (chat.get("role") or "").lower()
+        key = normalize_question(chat.get("message"))
+        if role and key:
+            counts[(role, key)] = counts.get((role, key), 0) + 1
+            samples.setdefault((role, key), chat.get("message").strip())
+        ts = chat.get("timestamp")
+        if ts and (newest is None or ts > newest):
+            newest = ts
+
+    ops = [
+        UpdateOne(
+            {"role": role, "key": key},
+            {"$inc": {"count": n}, "$setOnInsert": {"question": samples[(role, key)], "answer": None, "vetted": False}},
+            upsert=True,
+        )
+        for (role, key), n in counts.items()
+    ]
+    if ops:
+        await faq_collection.bulk_write(ops, ordered=False)
+    if newest is not None:
+        await meta_collection.update_one({"_id": "faq_miner"}, {"$set": {"last_mined_at": newest}}, upsert=True)
+    return scanned
+
+
+async def generate_answers(faq_collection, answer_fn, top_n, min_count, auto_approve=False):
+    """Generates answers for the top-N unanswered questions per role."""
+    generated = 0
+    for role in await faq_collection.distinct("role"):
+        cursor = faq_collection.find(
+            {"role": role, "answer": None, "count": {"$gte": min_count}}
+        ).sort("count", -1).limit(top_n)
+        async for entry in cursor:
+            try:
+                answer = await answer_fn(role, entry["question"])
+            except Exception as e:
+                print(f"   [!] Answer generation failed for '{entry['question'][:50]}': {e}")
+                continue
+            await faq_collection.update_one(
+                {"_id": entry["_id"]},
+                {"$set": {
+                    "answer": answer,
+                    "vetted": auto_approve,
+                    "generated_at": datetime.datetime.now(datetime.timezone.utc),
+                }},
+            )
+            generated += 1
+            print(f"   [OK] {role}: {entry['question'][:60]} ({entry['count']}x)")
+    return generated
+
+
+async def _run_cli(args):
+    # Reuse the agent's DB, LLM and role prompts so answers match live ones
+    import main
+    from langchain_core.messages import HumanMessage, SystemMessage
+
+    faqs = main.db.faqs
+    await ensure_indexes(faqs)
+
+    if args.command == "mine":
+        chats = main.chat_collection
+        if main.CHAT_STORAGE == "buckets":
+            from chat_buckets import ExchangeView
+            chats = ExchangeView(main.chat_bucket_collection)
+        scanned = await mine_new_chats(chats, faqs, main.db.faq_meta)
+        print(f"[*] Scanned {scanned} new chats")
+
+        async def answer_fn(role, question):
+            system_text = await main.get_role_prompt(role, None, None, question)
+            result = await main.llm.ainvoke([SystemMessage(content=system_text), HumanMessage(content=question)])
+            return result.content.strip()
+
+        generated = await generate_answers(faqs, answer_fn, args.top, args.min_count, args.auto_approve)
+        print(f"[OK] Generated {generated} FAQ answers" + ("" if args.auto_approve else " (pending approval)"))
+
+    elif args.command == "list":
+        query = {"role": args.role} if args.role else {}
+        async for entry in faqs.find(query).sort("count", -1).limit(args.limit):
+            status = "vetted" if entry.get("vetted") else ("pending" if entry.get("answer") else "unanswered")
+            print(f"{entry['_id']}  [{entry['role']}] {entry['count']:>5}x  {status:<10} {entry['question'][:60]}")
+
+    elif args.command == "approve":
+        from bson import ObjectId
+
+        result = await faqs.update_many(
+            {"_id": {"$in": [ObjectId(i) for i in args.ids]}, "answer": {"$ne": None}},
+            {"$set": {"vetted": True}},
+        )
+        print(f"[OK] Approved {result.modified_count} FAQ entries")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mine and manage precomputed FAQ answers.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    mine_p = sub.add_parser("mine", help="Count new chats and generate answers for the top questions")
+    mine_p.add_argument("--top", type=int, default=50, help="Questions to answer per role")
+    mine_p.add_argument("--min-count", type=int, default=FAQ_MIN_COUNT, help="Minimum occurrences to qualify")
+    mine_p.add_argument("--auto-approve", action="store_true", help="Serve generated answers without review")
+    list_p = sub.add_parser("list", help="Show FAQ entries by frequency")
+    list_p.add_argument("--role")
+    list_p.add_argument("--limit", type=int, default=50)
+    approve_p = sub.add_parser("approve", help="Mark answered entries as vetted")
+    approve_p.add_argument("ids", nargs="+")
+    asyncio.run(_run_cli(parser.parse_args()))
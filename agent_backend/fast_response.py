@@ -0,0 +1,86 @@
+"""
+Fast JSON responses with negotiated compression for the heavy read endpoints.
+
+json_response() serializes already-trusted data (Mongo documents, plain dicts)
+straight to bytes with orjson, skipping FastAPI's jsonable_encoder walk and
+response_model re-validation, and compresses the body with brotli or gzip when the
+client accepts it and the body exceeds COMPRESS_MIN_BYTES.
+
+orjson and brotli are optional: without them the stdlib json encoder and gzip are used.
+"""
+import os
+import gzip
+import asyncio
+import json
+import datetime
+
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))
+# Bodies larger than this are compressed off the event loop
+COMPRESS_THREAD_BYTES = 256 * 1024
+
+
+def _default(obj):
+    """ObjectId and anything else orjson doesn't know become strings."""
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    return str(obj)
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def choose_encoding(accept_encoding: str):
+    """Preferred supported encoding from an Accept-Encoding header: br, then gzip, else None."""
+    offered = {}
+    for part in (accept_encoding or "").lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        offered[name.strip()] = q
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and brotli is None:
+            continue
+        if offered.get(encoding, offered.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+async def json_response(request, content, status_code: int = 200) -> Response:
+    """JSON response for `content`, compressed according to the request's Accept-Encoding."""
+    body = dumps(content)
+    headers = {"Vary": "Accept-Encoding"}
+    encoding = choose_encoding(request.headers.get("accept-encoding")) if len(body) >= COMPRESS_MIN_BYTES else None
+    if encoding:
+        if len(body) >= COMPRESS_THREAD_BYTES:
+            body = await asyncio.to_thread(compress, body, encoding)
+        else:
+            body = compress(body, encoding)
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, status_code=status_code, media_type="application/json", headers=headers)
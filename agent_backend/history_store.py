@@ -0,0 +1,67 @@
+"""
+Compact conversation history for the in-memory cache.
+
+Each cached user holds an immutable tuple of Turn records (a role flag plus the text)
+instead of LangChain HumanMessage/AIMessage objects, which carry a per-instance dict,
+metadata fields and validation cost. Messages are only materialized when a prompt is
+built.
+"""
+from langchain_core.messages import HumanMessage, AIMessage
+
+MAX_CACHED_TURNS = 8  # last 4 exchanges
+HISTORY_USER_CHARS = 500
+HISTORY_AI_CHARS = 1000
+
+
+class Turn:
+    __slots__ = ("is_ai", "text")
+
+    def __init__(self, is_ai, text):
+        self.is_ai = is_ai
+        self.text = text
+
+    def __repr__(self):
+        return f"Turn({'ai' if self.is_ai else 'user'}, {self.text[:30]!r})"
+
+
+def from_chat_docs(docs):
+    """Turns for chat documents in chronological order, truncated to fit the context window."""
+    turns = []
+    for h in docs:
+        turns.append(Turn(False, (h.get("message") or "")[:HISTORY_USER_CHARS]))
+        ai_text = (h.get("response") or "")[:HISTORY_AI_CHARS]
+        if ai_text:
+            turns.append(Turn(True, ai_text))
+    return tuple(turns[-MAX_CACHED_TURNS:])
+
+
+def append_exchange(turns, user_text, ai_text):
+    """New history tuple with one exchange appended, capped at MAX_CACHED_TURNS."""
+    return (tuple(turns or ()) + (Turn(False, user_text), Turn(True, ai_text)))[-MAX_CACHED_TURNS:]
+
+
+def to_messages(turns):
+    return [AIMessage(content=t.text) if t.is_ai else HumanMessage(content=t.text) for t in turns or ()]
+
+
+def recent_history_pipeline(since, per_user=3, max_users=2000):
+    """
+    Aggregation over `chats` returning, for the most recently active users since
+    `since`, their last `per_user` exchanges: {_id: user_id, chats: [newest first]}.
+    $topN keeps only `per_user` chats per group while grouping (MongoDB 5.2+).
+    """
+    return [
+        {"$match": {"timestamp": {"$gte": since}}},
+        {"$group": {
+            "_id": "$user_id",
+            "last_active": {"$max": "$timestamp"},
+            "chats": {"$topN": {
+                "n": per_user,
+                "sortBy": {"timestamp": -1},
+                "output": {"message": "$message", "response": "$response"},
+            }},
+        }},
+        {"$sort": {"last_active": -1}},
+        {"$limit": max_users},
+        {"$project": {"chats": 1}},
+    ]
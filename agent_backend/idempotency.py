@@ -0,0 +1,225 @@
+"""
+Idempotency keys for /chat.
+
+A client that retries a slow request sends the same Idempotency-Key header. The
+first request with a key runs the work; a retry while it is still running attaches
+to the same task, and a retry after it finished gets the stored response replayed,
+so neither starts another LLM call or saves another chat document. Keys are scoped
+per user and bound to the request body: reusing a key for a different message is
+rejected.
+
+Keys live in a bounded in-process LRU (IDEMPOTENCY_MAX_KEYS) and in the
+`idempotency_keys` collection, where the key is the unique _id and a TTL index
+drops it after IDEMPOTENCY_TTL_SECONDS. Another worker that sees a pending key waits
+for its result. A pending claim is a short lease (IDEMPOTENCY_LEASE_SECONDS) that the
+owner renews while the work runs, so if the owner dies mid-answer a retry takes the
+key over once the lease lapses instead of getting 409 until the key expires. Once started, the work runs to completion even if the
+client that started it disconnects, so its retry can pick the answer up. Failed or
+timed-out answers are not stored, so a later retry with the same key runs again.
+"""
+import os
+import time
+import asyncio
+import uuid
+import hashlib
+import datetime
+import collections
+
+from pymongo.errors import DuplicateKeyError
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "3600"))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000"))
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "30"))
+IDEMPOTENCY_LEASE_SECONDS = float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "15"))
+MAX_KEY_LENGTH = 255
+PENDING = "pending"
+DONE = "done"
+
+
+class KeyConflict(Exception):
+    """The key was already used for a different request."""
+
+
+class InProgress(Exception):
+    """Another worker is still running the request for this key."""
+
+
+def fingerprint(*parts):
+    return hashlib.sha256("\x1f".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+class _Entry:
+    __slots__ = ("fingerprint", "task", "result", "expires")
+
+    def __init__(self, fingerprint, expires):
+        self.fingerprint = fingerprint
+        self.task = None
+        self.result = None
+        self.expires = expires
+
+
+class IdempotencyStore:
+    def __init__(self, collection=None, ttl=IDEMPOTENCY_TTL_SECONDS, max_keys=IDEMPOTENCY_MAX_KEYS,
+                 lease=IDEMPOTENCY_LEASE_SECONDS):
+        self.collection = collection
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.lease = lease
+        self._entries = collections.OrderedDict()  # "scope:key" -> _Entry, oldest first
+        self.counts = collections.Counter()
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def _evict(self, now):
+        while self._entries:
+            _, entry = next(iter(self._entries.items()))
+            if entry.expires > now and len(self._entries) <= self.max_keys:
+                break
+            self._entries.popitem(last=False)
+
+    def _local(self, key_id, fp, now):
+        entry = self._entries.get(key_id)
+        if entry is None or entry.expires <= now:
+            return None
+        if entry.fingerprint != fp:
+            raise KeyConflict("Idempotency-Key was already used for a different request")
+        return entry
+
+    def _lease_until(self):
+        return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.lease)
+
+    async def _claim_remote(self, key_id, fp, owner, wait_seconds):
+        """
+        None once `owner` holds the key in Mongo, else the stored result of the worker
+        that owned it. A pending claim whose lease lapsed (its worker died) is taken
+        over. Raises InProgress if it is still pending after `wait_seconds`.
+        """
+        give_up = time.monotonic() + wait_seconds
+        while True:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            try:
+                await self.collection.insert_one({
+                    "_id": key_id, "fingerprint": fp, "status": PENDING, "owner": owner, "created_at": now,
+                    "lease_until": self._lease_until(),
+                    "expires_at": now + datetime.timedelta(seconds=self.ttl),
+                })
+                return None
+            except DuplicateKeyError:
+                pass
+            taken = await self.collection.find_one_and_update(
+                {"_id": key_id, "fingerprint": fp, "status": PENDING, "lease_until": {"$lt": now}},
+                {"$set": {"owner": owner, "lease_until": self._lease_until()}},
+            )
+            if taken is not None:
+                self.counts["taken_over"] += 1
+                return None
+            doc = await self.collection.find_one({"_id": key_id})
+            if doc is not None:
+                if doc.get("fingerprint") != fp:
+                    raise KeyConflict("Idempotency-Key was already used for a different request")
+                if doc.get("status") == DONE:
+                    return doc["result"]
+            # pending elsewhere (or just released): wait, then try to claim again
+            if time.monotonic() >= give_up:
+                raise InProgress("A request with this Idempotency-Key is still in progress")
+            await asyncio.sleep(0.25)
+
+    async def _execute(self, key_id, entry, work, wait_seconds):
+        """Claims the key in Mongo (or replays its stored result), then runs the work. Returns (result, replayed)."""
+        remote = False
+        owner = uuid.uuid4().hex
+        if self.collection is not None:
+            try:
+                stored = await self._claim_remote(key_id, entry.fingerprint, owner, wait_seconds)
+            except (KeyConflict, InProgress):
+                self._entries.pop(key_id, None)
+                raise
+            except Exception as e:
+                print(f"   [!] Idempotency store unavailable, using this worker only: {e}")
+            else:
+                if stored is not None:
+                    entry.result = stored
+                    self.counts["replayed"] += 1
+                    return stored, True
+                remote = True
+
+        self.counts["executed"] += 1
+        renew = asyncio.ensure_future(self._renew(key_id, owner)) if remote else None
+        try:
+            result, cacheable = await work()
+        except BaseException:
+            self._entries.pop(key_id, None)
+            if remote:
+                renew.cancel()
+                await self._release(key_id, owner)
+            raise
+        if remote:
+            renew.cancel()
+        if not cacheable:
+            self._entries.pop(key_id, None)
+            if remote:
+                await self._release(key_id, owner)
+            return result, False
+        entry.result = result
+        if remote:
+            try:
+                await self.collection.update_one(
+                    {"_id": key_id, "owner": owner},
+                    {"$set": {"status": DONE, "result": result}, "$unset": {"lease_until": ""}},
+                )
+            except Exception as e:
+                print(f"   [!] Idempotency result save failed: {e}")
+        return result, False
+
+    async def _renew(self, key_id, owner):
+        """Extends the pending lease while the work runs."""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await self.collection.update_one(
+                    {"_id": key_id, "owner": owner, "status": PENDING},
+                    {"$set": {"lease_until": self._lease_until()}},
+                )
+            except Exception as e:
+                print(f"   [!] Idempotency lease renewal failed: {e}")
+
+    async def _release(self, key_id, owner):
+        try:
+            await self.collection.delete_one({"_id": key_id, "owner": owner, "status": PENDING})
+        except Exception as e:
+            print(f"   [!] Idempotency key release failed: {e}")
+
+    async def run(self, scope, key, fp, work, wait_seconds=IDEMPOTENCY_WAIT_SECONDS):
+        """
+        Runs `work()` once per (scope, key). `work` is an async callable returning
+        (result, cacheable); `result` must be BSON/JSON-serializable. Returns
+        (result, replayed). Raises KeyConflict or InProgress.
+        """
+        key_id = f"{scope}:{key}"
+        now = time.monotonic()
+        self._evict(now)
+        entry = self._local(key_id, fp, now)
+        if entry is not None:
+            self._entries.move_to_end(key_id)
+            if entry.result is not None:
+                self.counts["replayed"] += 1
+                return entry.result, True
+            self.counts["attached"] += 1
+            result, _ = await asyncio.shield(entry.task)
+            return result, True
+
+        entry = self._entries[key_id] = _Entry(fp, now + self.ttl)
+        entry.task = asyncio.ensure_future(self._execute(key_id, entry, work, wait_seconds))
+        return await asyncio.shield(entry.task)
+
+    def stats(self):
+        return {
+            "keys": len(self._entries),
+            "max_keys": self.max_keys,
+            "ttl_seconds": self.ttl,
+            "lease_seconds": self.lease,
+            "backend": "mongo" if self.collection is not None else "memory",
+            **dict(self.counts),
+        }
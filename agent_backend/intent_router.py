@@ -0,0 +1,322 @@
+"""
+Local intent router for dashboard commands.
+
+Short navigation/action requests ("go to assignments", "mark attendance", "check fee
+collection") are resolved here in well under a millisecond and answered with the same
+{{NAVIGATE:...}} / {{ACTION:...}} markers the LLM would emit. Resolution is two-stage:
+precompiled per-role pattern rules, then a small averaged-perceptron model over hashed
+word features for paraphrases. The model may only trigger an ACTION when the message
+also contains a command verb ("create", "mark", "upload", ...), so questions about a
+topic ("what are good exam questions for dbms") are not mistaken for the action.
+Anything not confidently a command returns None and falls through to the LLM.
+
+    python intent_router.py     # checks REGRESSION_EXAMPLES, exits non-zero on a miss
+"""
+import os
+import re
+import zlib
+import math
+import sys
+import random
+
+INTENT_MIN_CONFIDENCE = float(os.getenv("INTENT_MIN_CONFIDENCE", "0.8"))
+INTENT_MAX_WORDS = 10
+NONE = "none"
+
+# intent -> (marker kind, target, reply)
+INTENTS = {
+    "student": {
+        "nav:tasks": ("NAVIGATE", "tasks", "Opening your tasks and assignments 📚"),
+        "nav:attendance": ("NAVIGATE", "attendance", "Here's your attendance 📊"),
+        "nav:marks": ("NAVIGATE", "marks", "Opening your marks and results 🎓"),
+        "nav:exams": ("NAVIGATE", "exams", "Opening your exams 📝"),
+        "nav:schedule": ("NAVIGATE", "schedule", "Here's your schedule 🗓️"),
+        "nav:fees": ("NAVIGATE", "fees", "Opening your fee details 💳"),
+        "nav:faculty": ("NAVIGATE", "faculty", "Here are your faculty members 👩‍🏫"),
+        "nav:semester": ("NAVIGATE", "semester", "Opening your study materials 📂"),
+        "nav:placement": ("NAVIGATE", "placement", "Opening placement prep 🚀"),
+        "nav:roadmaps": ("NAVIGATE", "roadmaps", "Opening your learning roadmaps 🗺️"),
+        "nav:settings": ("NAVIGATE", "settings", "Opening settings ⚙️"),
+        "nav:overview": ("NAVIGATE", "overview", "Back to your dashboard ✨"),
+    },
+    "faculty": {
+        "action:mark_attendance": ("ACTION", "mark_attendance", "Let's mark attendance 📸"),
+        "action:create_exam": ("ACTION", "create_exam", "Let's create an exam paper 📝"),
+        "action:upload_notes": ("ACTION", "upload_notes", "Opening the material uploader 📂"),
+        "nav:attendance": ("NAVIGATE", "attendance", "Opening the attendance dashboard 📊"),
+        "nav:exams": ("NAVIGATE", "exams", "Opening exams 📝"),
+    },
+    "admin": {
+        "action:add_student": ("ACTION", "add_student", "Opening student registration ➕"),
+        "action:run_cleanup": ("ACTION", "run_cleanup", "Starting system cleanup 🧹"),
+        "nav:fees": ("NAVIGATE", "fees", "Opening fee collection 💼"),
+    },
+}
+
+_PREFIX = r"^(?:(?:please|pls|kindly|can you|could you|i want to|i need to|i wanna|let'?s|help me|now)\s+)*"
+_GO = r"(?:go to|goto|open|show(?: me)?|take me to|navigate to|switch to|view|see|check|display)\s+(?:my\s+|the\s+|our\s+)?"
+_TAIL = r"(?:\s+(?:page|section|tab|dashboard|now|please))*$"
+
+# role -> [(pattern, intent)]; first match wins
+_RULE_SOURCES = {
+    "student": [
+        (r"(?:assignments?|tasks?|todos?|to-dos?|homework|agenda)", "nav:tasks"),
+        (r"attendance", "nav:attendance"),
+        (r"(?:marks|results?|grades?|scores?|cgpa|sgpa)", "nav:marks"),
+        (r"(?:exams?|tests?)", "nav:exams"),
+        (r"(?:schedule|timetable|time table|classes)", "nav:schedule"),
+        (r"(?:fees?|fee details|payments?)", "nav:fees"),
+        (r"(?:faculty|teachers|professors)", "nav:faculty"),
+        (r"(?:notes|materials?|study materials?|semester)", "nav:semester"),
+        (r"(?:placements?|placement prep|jobs)", "nav:placement"),
+        (r"(?:roadmaps?)", "nav:roadmaps"),
+        (r"(?:settings|profile settings)", "nav:settings"),
+        (r"(?:dashboard|home|overview)", "nav:overview"),
+    ],
+    "faculty": [
+        (r"(?:mark|take|record|start)\s+(?:the\s+)?attendance", "action:mark_attendance"),
+        (r"(?:create|generate|make|prepare|set)\s+(?:an?\s+|the\s+)?(?:exam|question)\s*(?:paper)?", "action:create_exam"),
+        (r"(?:upload|share|add)\s+(?:the\s+|my\s+|some\s+)?(?:lecture\s+|class\s+)?(?:notes|materials?|slides)", "action:upload_notes"),
+        (_GO + r"attendance", "nav:attendance"),
+        (_GO + r"exams?", "nav:exams"),
+    ],
+    "admin": [
+        (r"(?:add|register|create|onboard)\s+(?:an?\s+|new\s+)*students?", "action:add_student"),
+        (r"(?:fix|clean\s*up|cleanup|optimi[sz]e)\s+(?:the\s+)?(?:database|db|system)", "action:run_cleanup"),
+        (r"(?:run\s+)?(?:system\s+)?cleanup", "action:run_cleanup"),
+        (r"(?:check\s+)?(?:the\s+)?fees?(?:\s+collection)?(?:\s+dashboard|\s+status)?", "nav:fees"),
+        (_GO + r"fees?(?:\s+collection)?", "nav:fees"),
+    ],
+}
+
+
+def _compile_rules():
+    rules = {}
+    for role, sources in _RULE_SOURCES.items():
+        compiled = []
+        for body, intent in sources:
+            if role == "student":
+                # Student rules are section names; accept "open my X" or just "X"
+                body = f"(?:{_GO})?{body}"
+            compiled.append((re.compile(_PREFIX + body + _TAIL), intent))
+        rules[role] = compiled
+    return rules
+
+
+RULES = _compile_rules()
+
+# Words that make a message a command; model-predicted ACTION intents need one of them
+_COMMAND_RE = re.compile(
+    r"\b(?:create|generate|make|prepare|set|build|draft|take|mark|record|start|upload|share|add|"
+    r"post|enroll|enrol|register|admit|onboard|run|fix|clean|cleanup|optimi[sz]e|open|go|show)\b"
+)
+
+# --- LINEAR MODEL ---
+
+_WORD_RE = re.compile(r"[a-z0-9']+")
+_N_FEATURES = 1 << 12
+
+
+def _normalize(text):
+    return " ".join(_WORD_RE.findall((text or "").lower()))
+
+
+def _features(text):
+    words = text.split()
+    grams = words + [f"{a}_{b}" for a, b in zip(words, words[1:])]
+    return {zlib.crc32(g.encode("utf-8")) % _N_FEATURES for g in grams}
+
+
+# Paraphrases the rules don't cover, plus open-ended questions labelled NONE
+TRAINING_EXAMPLES = {
+    "student": [
+        ("where can i find my assignments", "nav:tasks"), ("what is due this week", "nav:tasks"),
+        ("pending homework list", "nav:tasks"), ("my deadlines", "nav:tasks"),
+        ("how is my attendance", "nav:attendance"), ("attendance percentage", "nav:attendance"),
+        ("did i pass", "nav:marks"), ("my semester results", "nav:marks"), ("what did i score", "nav:marks"),
+        ("when are my exams", "nav:exams"), ("upcoming exam dates", "nav:exams"),
+        ("what classes do i have today", "nav:schedule"), ("today's timetable", "nav:schedule"),
+        ("how much fee is pending", "nav:fees"), ("pay my fees", "nav:fees"),
+        ("who teaches me", "nav:faculty"), ("my teachers list", "nav:faculty"),
+        ("lecture notes for this semester", "nav:semester"), ("download study material", "nav:semester"),
+        ("prepare for placements", "nav:placement"), ("interview preparation", "nav:placement"),
+        ("learning path for web dev", "nav:roadmaps"), ("change my password", "nav:settings"),
+        ("explain stacks and queues", NONE), ("what is a linked list", NONE), ("write a python function", NONE),
+        ("how does recursion work", NONE), ("help me understand dbms normalization", NONE),
+        ("what is the osi model", NONE), ("give me tips to study", NONE), ("tell me a joke", NONE),
+        ("explain dijkstra with code", NONE), ("difference between sql and nosql", NONE),
+        ("why is my code not working", NONE), ("what is machine learning", NONE),
+        ("how to prepare for exams effectively", NONE), ("what is attendance policy for exams", NONE),
+    ],
+    "faculty": [
+        ("attendance for today's class", "action:mark_attendance"), ("take roll call", "action:mark_attendance"),
+        ("mark students present", "action:mark_attendance"),
+        ("new question paper for dbms", "action:create_exam"), ("generate mcq test", "action:create_exam"),
+        ("prepare a quiz", "action:create_exam"),
+        ("upload lecture slides", "action:upload_notes"), ("share notes with my class", "action:upload_notes"),
+        ("attendance reports", "nav:attendance"), ("exam schedule", "nav:exams"),
+        ("how should i teach recursion", NONE), ("explain bloom's taxonomy", NONE),
+        ("tips for engaging students", NONE), ("what is the syllabus for os", NONE),
+        ("how to grade fairly", NONE), ("write feedback for a student", NONE),
+        ("explain normalization for my lecture", NONE), ("what is outcome based education", NONE),
+        ("what are good viva questions", NONE), ("what makes a good question paper", NONE),
+        ("explain the exam format", NONE),
+    ],
+    "admin": [
+        ("enroll a new student", "action:add_student"), ("new admission entry", "action:add_student"),
+        ("bulk upload students csv", "action:add_student"),
+        ("database is slow", "action:run_cleanup"), ("optimize system performance", "action:run_cleanup"),
+        ("fee collection status", "nav:fees"), ("who has not paid fees", "nav:fees"), ("fee defaulters", "nav:fees"),
+        ("strategies to improve fee collection", NONE), ("how many students are there", NONE),
+        ("explain naac accreditation", NONE), ("write a circular for holidays", NONE),
+        ("what is our placement rate", NONE), ("draft an email to faculty", NONE),
+        ("summarize this semester", NONE), ("tips for budget planning", NONE),
+    ],
+}
+
+
+class IntentModel:
+    """Multiclass averaged perceptron over hashed unigram/bigram features."""
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.weights = {label: [0.0] * _N_FEATURES for label in labels}
+
+    def scores(self, feats):
+        return {label: sum(w[f] for f in feats) for label, w in self.weights.items()}
+
+    def train(self, examples, epochs=20, seed=7):
+        totals = {label: [0.0] * _N_FEATURES for label in self.labels}
+        stamps = {label: [0] * _N_FEATURES for label in self.labels}
+        rng = random.Random(seed)
+        data = [(_features(_normalize(text)), label) for text, label in examples]
+        step = 0
+        for _ in range(epochs):
+            rng.shuffle(data)
+            for feats, gold in data:
+                step += 1
+                s = self.scores(feats)
+                guess = max(s, key=s.get)
+                if guess == gold:
+                    continue
+                for label, delta in ((gold, 1.0), (guess, -1.0)):
+                    w, t, st = self.weights[label], totals[label], stamps[label]
+                    for f in feats:
+                        t[f] += (step - st[f]) * w[f]
+                        st[f] = step
+                        w[f] += delta
+        for label in self.labels:
+            w, t, st = self.weights[label], totals[label], stamps[label]
+            for f in range(_N_FEATURES):
+                t[f] += (step - st[f]) * w[f]
+                w[f] = t[f] / max(step, 1)
+        return self
+
+    def predict(self, text):
+        """(label, softmax confidence) for normalized text."""
+        s = self.scores(_features(text))
+        top = max(s.values())
+        exp = {label: math.exp(v - top) for label, v in s.items()}
+        label = max(s, key=s.get)
+        return label, exp[label] / sum(exp.values())
+
+
+def _train_models():
+    models = {}
+    for role, examples in TRAINING_EXAMPLES.items():
+        # Rule sources double as training data so the model learns the core vocabulary
+        extra = []
+        for intent, (_, target, _) in INTENTS[role].items():
+            extra.append((f"open {target.replace('_', ' ')}", intent))
+            extra.append((target.replace("_", " "), intent))
+        labels = list(INTENTS[role]) + [NONE]
+        models[role] = IntentModel(labels).train(examples + extra)
+    return models
+
+
+MODELS = _train_models()
+
+
+class RoutedIntent:
+    __slots__ = ("intent", "kind", "target", "reply", "confidence", "source")
+
+    def __init__(self, intent, kind, target, reply, confidence, source):
+        self.intent = intent
+        self.kind = kind
+        self.target = target
+        self.reply = reply
+        self.confidence = confidence
+        self.source = source
+
+    @property
+    def marker(self):
+        return f"{{{{{self.kind}:{self.target}}}}}"
+
+    def response_text(self):
+        return f"{self.reply} {self.marker}"
+
+
+def route(role, message):
+    """Resolves a dashboard command locally, or returns None to use the LLM."""
+    role = (role or "").lower().strip()
+    intents = INTENTS.get(role)
+    if not intents:
+        return None
+
+    text = _normalize(message)
+    if not text or len(text.split()) > INTENT_MAX_WORDS:
+        return None
+
+    for pattern, intent in RULES[role]:
+        if pattern.match(text):
+            kind, target, reply = intents[intent]
+            return RoutedIntent(intent, kind, target, reply, 1.0, "rule")
+
+    intent, confidence = MODELS[role].predict(text)
+    if intent == NONE or confidence < INTENT_MIN_CONFIDENCE:
+        return None
+    kind, target, reply = intents[intent]
+    if kind == "ACTION" and not _COMMAND_RE.search(text):
+        return None
+    return RoutedIntent(intent, kind, target, reply, round(confidence, 3), "model")
+
+
+# (role, message, expected intent or None for the LLM)
+REGRESSION_EXAMPLES = [
+    ("faculty", "what are good exam questions for dbms", None),
+    ("faculty", "question paper pattern", None),
+    ("faculty", "what are good questions for a dbms exam", None),
+    ("faculty", "explain the exam pattern for os", None),
+    ("faculty", "how should i teach recursion", None),
+    ("admin", "what are good ways to add new students", None),
+    ("admin", "why is the database slow", None),
+    ("student", "explain stacks and queues", None),
+    ("faculty", "create question paper", "action:create_exam"),
+    ("faculty", "generate mcq test", "action:create_exam"),
+    ("faculty", "mark students present", "action:mark_attendance"),
+    ("faculty", "upload lecture slides", "action:upload_notes"),
+    ("faculty", "go to attendance", "nav:attendance"),
+    ("admin", "add a new student", "action:add_student"),
+    ("admin", "fee collection status", "nav:fees"),
+    ("student", "when are my exams", "nav:exams"),
+    ("student", "open my assignments", "nav:tasks"),
+]
+
+
+def check_regressions():
+    """Messages from REGRESSION_EXAMPLES that no longer route as expected: [(role, message, expected, got)]."""
+    failures = []
+    for role, message, expected in REGRESSION_EXAMPLES:
+        routed = route(role, message)
+        got = routed.intent if routed else None
+        if got != expected:
+            failures.append((role, message, expected, got))
+    return failures
+
+
+if __name__ == "__main__":
+    failures = check_regressions()
+    for role, message, expected, got in failures:
+        print(f"[X] {role}: {message!r} -> {got} (expected {expected})")
+    print(f"[OK] {len(REGRESSION_EXAMPLES) - len(failures)}/{len(REGRESSION_EXAMPLES)} intent regression examples pass")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,383 @@
+"""
+Background jobs for long generations (exam papers, lesson material, long reports).
+
+POST /jobs stores a job in the `jobs` collection and returns its id at once; a
+bounded pool of JOB_WORKERS workers runs jobs in priority order (by role, see
+JOB_ROLE_PRIORITIES, then submission order), so long generations never hold an HTTP
+request open or take interactive /chat capacity beyond the pool size. Progress is
+kept in memory for live streams and written to the job document every few seconds
+for polling from any worker.
+
+Crash safety: a running job holds a lease (lease_until) that its worker renews. On
+startup, and periodically, running jobs whose lease expired are put back in the
+queue (up to JOB_MAX_ATTEMPTS), and every process picks up queued jobs from Mongo.
+Jobs are claimed with an atomic queued -> running update, so each runs once.
+"""
+import os
+import time
+import uuid
+import asyncio
+import datetime
+import itertools
+import collections
+
+from pymongo import ReturnDocument
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_TIMEOUT_SECONDS = float(os.getenv("JOB_TIMEOUT_SECONDS", "300"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "500"))
+JOB_MAX_PER_USER = int(os.getenv("JOB_MAX_PER_USER", "3"))  # queued + running
+JOB_MAX_TOKENS = int(os.getenv("JOB_MAX_TOKENS", "4096"))
+JOB_LEASE_SECONDS = 60
+JOB_PROGRESS_SECONDS = 2.0
+DEFAULT_ROLE_PRIORITIES = "admin:0,faculty:1,worker:2,student:3,default:4"
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class QueueFull(Exception):
+    """The queue or the user's job quota is full; the job was not accepted."""
+
+
+class JobCancelled(Exception):
+    """The job document was cancelled while this worker was running it."""
+
+
+def parse_role_priorities(spec):
+    """{role: priority} from "role:priority,..."; lower runs first."""
+    priorities = {}
+    for item in (spec or "").split(","):
+        parts = item.strip().split(":")
+        if len(parts) == 2:
+            priorities[parts[0].lower()] = int(parts[1])
+    priorities.setdefault("default", max(priorities.values(), default=0) + 1)
+    return priorities
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _ms(start, end):
+    if start is None or end is None:
+        return None
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=datetime.timezone.utc)
+    if end.tzinfo is None:
+        end = end.replace(tzinfo=datetime.timezone.utc)
+    return round((end - start).total_seconds() * 1000, 1)
+
+
+class _LiveJob:
+    """In-memory state of a job running on this process, for streaming."""
+
+    __slots__ = ("parts", "listeners", "task", "cancelled", "last_saved")
+
+    def __init__(self):
+        self.parts = []
+        self.listeners = set()
+        self.task = None
+        self.cancelled = False
+        self.last_saved = time.monotonic()
+
+
+class JobQueue:
+    def __init__(self, collection, runner, workers=JOB_WORKERS, priorities=None):
+        """
+        `runner(job)` is an async generator yielding text chunks for a job document;
+        the joined chunks are the result.
+        """
+        self.collection = collection
+        self.runner = runner
+        self.workers = workers
+        self.priorities = priorities or parse_role_priorities(os.getenv("JOB_ROLE_PRIORITIES", DEFAULT_ROLE_PRIORITIES))
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._queue = asyncio.PriorityQueue()
+        self._queued_ids = set()
+        self._seq = itertools.count()
+        self._live = {}
+        self._tasks = []
+        self.counts = collections.Counter()
+        self.wait_ms = collections.deque(maxlen=500)
+        self.run_ms = collections.deque(maxlen=500)
+
+    def priority(self, role):
+        return self.priorities.get((role or "").lower(), self.priorities["default"])
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("status", 1), ("priority", 1), ("created_at", 1)])
+        await self.collection.create_index([("user_id", 1), ("created_at", -1)])
+
+    def _enqueue(self, job_id, priority, created_at):
+        if job_id not in self._queued_ids:
+            self._queued_ids.add(job_id)
+            self._queue.put_nowait((priority, created_at.timestamp(), next(self._seq), job_id))
+
+    async def submit(self, user_id, role, message, user_name=None, context=None, kind="generate"):
+        """Stores and enqueues a job; returns its document. Raises QueueFull."""
+        if self._queue.qsize() >= JOB_MAX_QUEUED:
+            raise QueueFull("The job queue is full, please try again later")
+        active = await self.collection.count_documents({"user_id": user_id, "status": {"$in": [QUEUED, RUNNING]}})
+        if active >= JOB_MAX_PER_USER:
+            raise QueueFull(f"At most {JOB_MAX_PER_USER} jobs may be queued or running per user")
+        job = {
+            "_id": uuid.uuid4().hex,
+            "kind": kind,
+            "user_id": user_id,
+            "role": role,
+            "user_name": user_name,
+            "context": context or {},
+            "message": message,
+            "priority": self.priority(role),
+            "status": QUEUED,
+            "attempts": 0,
+            "created_at": _now(),
+            "progress": {"chars": 0},
+        }
+        await self.collection.insert_one(job)
+        self._enqueue(job["_id"], job["priority"], job["created_at"])
+        self.counts["submitted"] += 1
+        return job
+
+    async def get(self, job_id):
+        job = await self.collection.find_one({"_id": job_id})
+        if job is not None and job["_id"] in self._live:
+            job["progress"] = {"chars": sum(len(p) for p in self._live[job_id].parts)}
+        return job
+
+    async def cancel(self, job_id):
+        """Cancels a queued or running job; returns the updated document or None."""
+        job = await self.collection.find_one_and_update(
+            {"_id": job_id, "status": {"$in": [QUEUED, RUNNING]}},
+            {"$set": {"status": CANCELLED, "finished_at": _now()}},
+            return_document=ReturnDocument.AFTER,
+        )
+        live = self._live.get(job_id)
+        if job is not None and live is not None and live.task is not None:
+            live.cancelled = True
+            live.task.cancel()
+        if job is not None and live is None:
+            self.counts["cancelled"] += 1  # running jobs are counted when they stop
+        return job
+
+    async def requeue_expired(self):
+        """Puts running jobs whose lease expired back in the queue (or fails them). Returns the count requeued."""
+        now = _now()
+        requeued = 0
+        async for job in self.collection.find({"status": RUNNING, "lease_until": {"$lt": now}}):
+            if job.get("attempts", 0) >= JOB_MAX_ATTEMPTS:
+                await self.collection.update_one(
+                    {"_id": job["_id"], "status": RUNNING},
+                    {"$set": {"status": FAILED, "error": "worker lost too many times", "finished_at": now}},
+                )
+                self.counts["failed"] += 1
+                continue
+            result = await self.collection.update_one(
+                {"_id": job["_id"], "status": RUNNING, "lease_until": {"$lt": now}},
+                {"$set": {"status": QUEUED, "progress": {"chars": 0}}, "$unset": {"worker": "", "lease_until": ""}},
+            )
+            if result.modified_count:
+                requeued += 1
+        self.counts["requeued"] += requeued
+        return requeued
+
+    async def load_queued(self):
+        """Enqueues jobs waiting in Mongo (submitted elsewhere or before a restart)."""
+        cursor = self.collection.find({"status": QUEUED}, {"priority": 1, "created_at": 1}).sort(
+            [("priority", 1), ("created_at", 1)]).limit(JOB_MAX_QUEUED)
+        async for job in cursor:
+            self._enqueue(job["_id"], job.get("priority", self.priorities["default"]), job["created_at"])
+
+    async def _claim(self, job_id):
+        now = _now()
+        return await self.collection.find_one_and_update(
+            {"_id": job_id, "status": QUEUED},
+            {"$set": {"status": RUNNING, "worker": self.owner, "started_at": now,
+                      "lease_until": now + datetime.timedelta(seconds=JOB_LEASE_SECONDS)},
+             "$inc": {"attempts": 1}},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def _publish(self, live, event, data):
+        for listener in list(live.listeners):
+            listener.put_nowait((event, data))
+
+    async def _run(self, job):
+        job_id = job["_id"]
+        live = self._live[job_id] = _LiveJob()
+        live.task = asyncio.current_task()
+        started = time.perf_counter()
+        first_chunk_ms = None
+        status, error = DONE, None
+
+        async def generate():
+            nonlocal first_chunk_ms
+            async for text in self.runner(job):
+                if not text:
+                    continue
+                if first_chunk_ms is None:
+                    first_chunk_ms = round((time.perf_counter() - started) * 1000, 1)
+                live.parts.append(text)
+                self._publish(live, "progress", {"text": text})
+                now = time.monotonic()
+                if now - live.last_saved >= JOB_PROGRESS_SECONDS:
+                    live.last_saved = now
+                    update = {"progress": {"chars": sum(len(p) for p in live.parts)}}
+                    saved = await self.collection.update_one({"_id": job_id, "status": RUNNING}, {"$set": update})
+                    if not saved.matched_count:
+                        raise JobCancelled()  # cancelled through another worker
+
+        async def renew_lease():
+            while True:
+                await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+                await self.collection.update_one(
+                    {"_id": job_id, "status": RUNNING},
+                    {"$set": {"lease_until": _now() + datetime.timedelta(seconds=JOB_LEASE_SECONDS)}},
+                )
+
+        heartbeat = asyncio.create_task(renew_lease())
+        try:
+            await asyncio.wait_for(generate(), timeout=JOB_TIMEOUT_SECONDS)
+        except asyncio.CancelledError:
+            if not live.cancelled:
+                del self._live[job_id]
+                raise  # shutting down: the lease runs out and the job is requeued
+            status, error = CANCELLED, "cancelled"
+        except JobCancelled:
+            status, error = CANCELLED, "cancelled"
+        except asyncio.TimeoutError:
+            status, error = FAILED, f"timed out after {JOB_TIMEOUT_SECONDS:g}s"
+        except Exception as e:
+            status, error = FAILED, str(e)[:500]
+        finally:
+            heartbeat.cancel()
+
+        finished = _now()
+        result = "".join(live.parts).strip()
+        timings = {
+            "queue_ms": _ms(job.get("created_at"), job.get("started_at")),
+            "first_chunk_ms": first_chunk_ms,
+            "run_ms": round((time.perf_counter() - started) * 1000, 1),
+        }
+        update = {"status": status, "finished_at": finished, "timings": timings,
+                  "progress": {"chars": len(result)}}
+        if status == DONE:
+            update["result"] = result
+        else:
+            update["error"] = error
+            if result:
+                update["partial_result"] = result
+        await self.collection.update_one({"_id": job_id, "status": RUNNING}, {"$set": update, "$unset": {"lease_until": ""}})
+
+        self.counts[status] += 1
+        if timings["queue_ms"] is not None:
+            self.wait_ms.append(timings["queue_ms"])
+        self.run_ms.append(timings["run_ms"])
+        self._publish(live, "done" if status == DONE else "error",
+                      {"status": status, "result": result, "error": error, "timings": timings})
+        del self._live[job_id]
+        print(f"[{'OK' if status == DONE else '!'}] Job {job_id} {status} in {timings['run_ms']:.0f} ms "
+              f"(queued {timings['queue_ms']} ms)")
+        return result
+
+    async def _worker(self):
+        while True:
+            _, _, _, job_id = await self._queue.get()
+            self._queued_ids.discard(job_id)
+            try:
+                job = await self._claim(job_id)
+                if job is not None:  # None: cancelled, or claimed by another process
+                    await asyncio.create_task(self._run(job))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[!] Job worker error for {job_id}: {e}")
+
+    async def _maintain(self):
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS)
+            try:
+                await self.requeue_expired()
+                await self.load_queued()
+            except Exception as e:
+                print(f"[!] Job queue maintenance failed: {e}")
+
+    async def start(self):
+        """Recovers jobs left by crashed workers and starts the worker pool."""
+        try:
+            await self.ensure_indexes()
+            requeued = await self.requeue_expired()
+            await self.load_queued()
+            print(f"[OK] Job queue: {self.workers} workers, {self._queue.qsize()} queued, {requeued} requeued")
+        except Exception as e:
+            print(f"[!] Job queue recovery failed: {e}")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._maintain()))
+
+    async def events(self, job_id, poll_seconds=1.0):
+        """
+        Yields (event, data) for a job: the text so far and live `progress` chunks when it
+        runs on this process, status polling otherwise, then `done` or `error`.
+        """
+        job = await self.collection.find_one({"_id": job_id})
+        if job is None:
+            return
+        live = self._live.get(job_id)
+        if live is not None:
+            listener = asyncio.Queue()
+            live.listeners.add(listener)
+            try:
+                if live.parts:
+                    yield "progress", {"text": "".join(live.parts)}
+                while True:
+                    event, data = await listener.get()
+                    yield event, data
+                    if event != "progress":
+                        return
+            finally:
+                live.listeners.discard(listener)
+
+        last = None
+        while True:
+            job = await self.get(job_id)
+            if job is None:
+                return
+            if job["status"] in FINISHED:
+                if job["status"] == DONE:
+                    yield "done", {"status": DONE, "result": job.get("result"), "timings": job.get("timings")}
+                else:
+                    yield "error", {"status": job["status"], "error": job.get("error"), "timings": job.get("timings")}
+                return
+            state = (job["status"], job.get("progress", {}).get("chars"))
+            if state != last:
+                last = state
+                yield "status", {"status": job["status"], "progress": job.get("progress")}
+            if job_id in self._live:  # started here meanwhile
+                async for event, data in self.events(job_id, poll_seconds):
+                    yield event, data
+                return
+            await asyncio.sleep(poll_seconds)
+
+    def stats(self):
+        def pct(values, p):
+            if not values:
+                return None
+            ordered = sorted(values)
+            return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+        return {
+            "workers": self.workers,
+            "owner": self.owner,
+            "queued_here": self._queue.qsize(),
+            "running_here": len(self._live),
+            "priorities": self.priorities,
+            "counts": dict(self.counts),
+            "queue_ms": {"p50": pct(self.wait_ms, 0.5), "p95": pct(self.wait_ms, 0.95)},
+            "run_ms": {"p50": pct(self.run_ms, 0.5), "p95": pct(self.run_ms, 0.95)},
+        }
@@ -0,0 +1,310 @@
+"""
+Prebuilt knowledge snapshot.
+
+Compiles the *_knowledges collections and knowledge/*.txt into a single binary file
+that agent workers mmap read-only, so every worker shares the same pages through the
+OS page cache instead of querying Mongo (or rebuilding an index) per request.
+
+Build:   python knowledge_snapshot.py build --out knowledge.snap
+Inspect: python knowledge_snapshot.py info knowledge.snap
+Use:     KNOWLEDGE_SNAPSHOT=knowledge.snap uvicorn main:app
+
+File layout (little-endian):
+    header       MAGIC, format version, doc/term counts, embedding dim, section offsets
+    doc index    doc_count x (blob offset u32, length u32, role u8)
+    doc blob     UTF-8 formatted knowledge text
+    term index   term_count x (blob offset u32, length u16, postings offset u32, postings count u32), sorted
+    term blob    UTF-8 terms
+    postings     (doc id u32, term frequency u32) pairs
+    embeddings   doc_count x dim float32 (optional, dim == 0 when absent)
+"""
+import os
+import re
+import sys
+import glob
+import math
+import mmap
+import array
+import struct
+import argparse
+
+MAGIC = b"VUKSNAP\x00"
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct("<8sIIII6Q")
+DOC_ENTRY = struct.Struct("<IIB3x")
+TERM_ENTRY = struct.Struct("<IH2xII")
+POSTING = struct.Struct("<II")
+
+ROLES = ["student", "faculty", "admin", "general"]
+ROLE_COLLECTIONS = {
+    "student": "student_knowledges",
+    "faculty": "faculty_knowledges",
+    "admin": "admin_knowledges",
+}
+
+KNOWLEDGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge")
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    """Lowercased alphanumeric terms, ignoring single characters."""
+    return [t for t in _TOKEN_RE.findall((text or "").lower()) if len(t) > 1]
+
+
+def format_entry(role, d):
+    """Formats a knowledge document the way it is injected into the role prompt."""
+    if role == "student":
+        text = f"\n[Subject: {d.get('subject')}] {d.get('topic')}: {d.get('content')}"
+        if d.get('codeExamples'):
+            text += f"\n   Code: {d.get('codeExamples')[0]}"
+    elif role == "faculty":
+        text = f"\n[Tool: {d.get('subject')}] {d.get('topic')}: {d.get('content')}"
+    elif role == "admin":
+        text = f"\n[Module: {d.get('module')}] {d.get('topic')}: {d.get('content')}"
+        if d.get('tips'):
+            text += f"\n   Tip: {d.get('tips')[0]}"
+    else:
+        text = f"\n{d.get('content')}"
+    return text
+
+
+def _searchable_text(d):
+    parts = [d.get("subject"), d.get("module"), d.get("topic"), d.get("content")]
+    parts.extend(d.get("tags") or [])
+    return " ".join(str(p) for p in parts if p)
+
+
+# --- BUILD ---
+
+def load_text_files(knowledge_dir=KNOWLEDGE_DIR):
+    """Splits knowledge/*.txt and *.md files into paragraph-sized general entries."""
+    docs = []
+    paths = sorted(glob.glob(os.path.join(knowledge_dir, "*.txt")) + glob.glob(os.path.join(knowledge_dir, "*.md")))
+    for path in paths:
+        if os.path.basename(path).startswith("00_"):
+            continue  # usage notes, not knowledge
+        with open(path, encoding="utf-8") as f:
+            raw = f.read()
+        for para in re.split(r"\n\s*\n", raw):
+            para = para.strip()
+            if para:
+                docs.append({"content": para, "source": os.path.basename(path)})
+    return docs
+
+
+def load_db_sources(db):
+    """Reads every role's knowledge collection from a (sync) pymongo database."""
+    sources = []
+    for role, name in ROLE_COLLECTIONS.items():
+        for d in db[name].find({}):
+            sources.append((role, d))
+    return sources
+
+
+def build_snapshot(sources, out_path):
+    """
+    Writes a snapshot for `sources`, a list of (role, document) pairs.
+    The file is written next to `out_path` and renamed into place so running
+    workers keep their existing mapping until they reload.
+    """
+    docs = []
+    postings = {}
+    embeddings = []
+    dim = 0
+
+    for doc_id, (role, d) in enumerate(sources):
+        text = format_entry(role, d).encode("utf-8")
+        docs.append((ROLES.index(role), text))
+
+        counts = {}
+        for term in tokenize(_searchable_text(d)):
+            counts[term] = counts.get(term, 0) + 1
+        for term, tf in counts.items():
+            postings.setdefault(term, []).append((doc_id, tf))
+
+        vector = d.get("embedding")
+        if vector:
+            if dim and len(vector) != dim:
+                raise ValueError(f"Embedding dimension mismatch in document {d.get('_id')}")
+            dim = len(vector)
+        embeddings.append(vector)
+
+    terms = sorted(postings, key=lambda t: t.encode("utf-8"))
+
+    doc_index = bytearray()
+    doc_blob = bytearray()
+    for role_code, text in docs:
+        doc_index += DOC_ENTRY.pack(len(doc_blob), len(text), role_code)
+        doc_blob += text
+
+    term_index = bytearray()
+    term_blob = bytearray()
+    posting_blob = bytearray()
+    for term in terms:
+        encoded = term.encode("utf-8")
+        plist = postings[term]
+        term_index += TERM_ENTRY.pack(len(term_blob), len(encoded), len(posting_blob) // POSTING.size, len(plist))
+        term_blob += encoded
+        for doc_id, tf in plist:
+            posting_blob += POSTING.pack(doc_id, tf)
+
+    embedding_blob = b""
+    if dim:
+        matrix = array.array("f")
+        for vector in embeddings:
+            matrix.extend(vector if vector else [0.0] * dim)
+        if sys.byteorder != "little":
+            matrix.byteswap()
+        embedding_blob = matrix.tobytes()
+
+    sections = [doc_index, doc_blob, term_index, term_blob, posting_blob, embedding_blob]
+    offsets = []
+    pos = HEADER.size
+    for section in sections:
+        pos += (-pos) % 8  # keep sections 8-byte aligned for the float matrix
+        offsets.append(pos)
+        pos += len(section)
+
+    tmp_path = f"{out_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(docs), len(terms), dim, *offsets))
+        for offset, section in zip(offsets, sections):
+            f.write(b"\x00" * (offset - f.tell()))
+            f.write(section)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, out_path)
+    return {"documents": len(docs), "terms": len(terms), "embedding_dim": dim, "bytes": pos}
+
+
+# --- READ ---
+
+class KnowledgeSnapshot:
+    """Read-only, mmap-backed view over a snapshot file."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, self.doc_count, self.term_count, self.embedding_dim,
+         self._doc_index, self._doc_blob, self._term_index, self._term_blob,
+         self._postings, self._embeddings) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self._mm.close()
+            raise ValueError(f"{path} is not a v{FORMAT_VERSION} knowledge snapshot")
+
+    def close(self):
+        self._mm.close()
+
+    def _doc(self, doc_id):
+        offset, length, role_code = DOC_ENTRY.unpack_from(self._mm, self._doc_index + doc_id * DOC_ENTRY.size)
+        return role_code, offset, length
+
+    def text(self, doc_id):
+        _, offset, length = self._doc(doc_id)
+        start = self._doc_blob + offset
+        return self._mm[start:start + length].decode("utf-8")
+
+    def role(self, doc_id):
+        return ROLES[self._doc(doc_id)[0]]
+
+    def embedding(self, doc_id):
+        """Float32 row for a document as a zero-copy memoryview, or None."""
+        if not self.embedding_dim:
+            return None
+        row = self.embedding_dim * 4
+        start = self._embeddings + doc_id * row
+        return memoryview(self._mm)[start:start + row].cast("f")
+
+    def _term(self, i):
+        offset, length, p_offset, p_count = TERM_ENTRY.unpack_from(self._mm, self._term_index + i * TERM_ENTRY.size)
+        start = self._term_blob + offset
+        return self._mm[start:start + length], p_offset, p_count
+
+    def postings(self, term):
+        """(doc_id, tf) pairs for a term, found by binary search over the sorted term index."""
+        key = term.encode("utf-8")
+        lo, hi = 0, self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found, p_offset, p_count = self._term(mid)
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                base = self._postings + p_offset * POSTING.size
+                return [POSTING.unpack_from(self._mm, base + j * POSTING.size) for j in range(p_count)]
+        return []
+
+    def search(self, role, query=None, limit=5):
+        """
+        Top documents for a role ranked by tf-idf against the query.
+        Without a query (or without matches) returns the role's first entries,
+        like the Mongo lookup it replaces.
+        """
+        role_code = ROLES.index(role) if role in ROLES else None
+        allowed = {role_code, ROLES.index("general")}
+        scores = {}
+        for term in set(tokenize(query)):
+            plist = self.postings(term)
+            if not plist:
+                continue
+            idf = math.log(1 + self.doc_count / len(plist))
+            for doc_id, tf in plist:
+                if self._doc(doc_id)[0] in allowed:
+                    scores[doc_id] = scores.get(doc_id, 0.0) + tf * idf
+
+        if scores:
+            ranked = sorted(scores, key=lambda i: (-scores[i], i))[:limit]
+        else:
+            ranked = [i for i in range(self.doc_count) if self._doc(i)[0] == role_code][:limit]
+        return [self.text(i) for i in ranked]
+
+
+def open_snapshot(path):
+    """Opens a snapshot if `path` is set and valid, otherwise returns None."""
+    if not path:
+        return None
+    try:
+        snapshot = KnowledgeSnapshot(path)
+        print(f"[OK] Knowledge snapshot mapped: {path} ({snapshot.doc_count} docs, {snapshot.term_count} terms)")
+        return snapshot
+    except Exception as e:
+        print(f"[!] Knowledge snapshot unavailable ({path}): {e}")
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or inspect a knowledge snapshot.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build_p = sub.add_parser("build", help="Compile Mongo knowledge and knowledge/*.txt into a snapshot")
+    build_p.add_argument("--out", default=os.getenv("KNOWLEDGE_SNAPSHOT", "knowledge.snap"))
+    build_p.add_argument("--no-db", action="store_true", help="Only include knowledge/*.txt files")
+    info_p = sub.add_parser("info", help="Print snapshot statistics")
+    info_p.add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        snap = KnowledgeSnapshot(args.path)
+        print(f"Documents: {snap.doc_count}, Terms: {snap.term_count}, Embedding dim: {snap.embedding_dim}")
+        snap.close()
+    else:
+        sources = []
+        if not args.no_db:
+            from dotenv import load_dotenv
+            from pymongo import MongoClient
+
+            load_dotenv()
+            mongo_client = MongoClient(os.getenv("MONGO_URI", "mongodb://localhost:27017"), serverSelectionTimeoutMS=5000)
+            try:
+                mongo_db = mongo_client.get_default_database()
+            except Exception:
+                mongo_db = mongo_client.vu_ai_agent
+            sources.extend(load_db_sources(mongo_db))
+        sources.extend(("general", d) for d in load_text_files())
+        stats = build_snapshot(sources, args.out)
+        print(f"[OK] Snapshot written to {args.out}: {stats}")
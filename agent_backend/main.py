@@ -4,19 +4,44 @@ from datetime import timezone
 import asyncio
 import random
 import functools
+import time
+import math
 import glob
+import json
+import hashlib
+from collections import Counter
+from typing import List
 print = functools.partial(print, flush=True)
 
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Response, Request, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
+from langchain_core.messages import HumanMessage, SystemMessage
 from motor.motor_asyncio import AsyncIOMotorClient
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from fastapi.security import OAuth2PasswordBearer
 
+from knowledge_snapshot import open_snapshot, format_entry
+from faq_store import FAQStore
+import intent_router
+from action_stream import MarkerStreamParser, extract_markers, strip_markers
+from model_tiers import TieringPolicy
+import history_store
+import ws_channel
+import chat_buckets
+import chat_archive
+from offline_answer import OfflineAnswerEngine, OfflineLLM, OFFLINE_NOTICE
+from rate_limit import RateLimiter, MongoRateLimiter, RATE_LIMIT_ENABLED, RATE_LIMIT_BACKEND
+from fast_response import json_response
+import analytics
+import profiler
+import job_queue
+import idempotency
+from deadline import Deadline, ClientDisconnected, DEADLINE_HEADER, run_until_disconnected
+
 # Load environment variables
 load_dotenv()
 
@@ -41,35 +66,35 @@ LLM_PROVIDER = os.getenv("LLM_PROVIDER", "google").lower()
 llm = None
 MODEL_NAME = None
 
-class _FallbackLLM:
-    async def ainvoke(self, messages):
-        # Determine the role from the system message if possible
-        role = "student"
-        user_name = "User"
-        
-        for msg in messages:
-            if isinstance(msg, SystemMessage):
-                content = msg.content.lower()
-                if "admin" in content: role = "admin"
-                elif "faculty" in content: role = "faculty"
-                
-                if "commander" in content: user_name = "Commander"
-                elif "professor" in content: user_name = "Professor"
+class _FakeLLM:
+    """Deterministic offline model for benchmarks (LLM_PROVIDER=fake): fixed latency, hashed echo."""
 
+    def __init__(self, latency_ms):
+        self.latency = latency_ms / 1000.0
+
+    async def ainvoke(self, messages):
         class _R:
             def __init__(self, content):
                 self.content = content
 
-        if role == "admin":
-            res = f"**Sentinel Prime: [DEMO MODE ACTIVE]**\n\nCommand accepted, {user_name}. However, my neural uplink to Gemini-1.5 is currently offline (Invalid API Key). Under Protocol 7-Beta, I am operating in local simulation mode.\n\n**System Diagnostics:**\n- Security: Operational\n- Knowledge Base: Cached\n- LLM Status: Standby\n\nPlease update the `GOOGLE_API_KEY` in my configuration to restore full cognitive functions."
-        elif role == "faculty":
-            res = f"**Academic Core: [DEMO MODE]**\n\nProfessor, I can assist with syllabus planning and student records locally. Note that my advanced generative features are currently paused while we verify the AI gateway key.\n\nHow can I help you manage your classes today?"
-        else:
-            res = f"**Study Buddy: [DEMO MODE]**\n\nHey {user_name}! 🚀 I'm here to help, though my 'big brain' is currently in low-power mode because I need a valid API key to connect to the cloud. \n\nI can still help you navigate the dashboard or talk about what we've learned so far! Just ask me anything about the University."
-            
-        return _R(res)
+        await asyncio.sleep(self.latency)
+        last = messages[-1].content if isinstance(messages, list) and messages else str(messages)
+        digest = hashlib.sha1(last.encode("utf-8")).hexdigest()[:8]
+        return _R(f"[fake:{digest}] You asked: {last[:200]}")
+
+    async def astream(self, messages):
+        class _Chunk:
+            def __init__(self, content):
+                self.content = content
 
-llm = _FallbackLLM() # Default to fallback, override if successful
+        result = await self.ainvoke(messages)
+        for word in result.content.split(" "):
+            yield _Chunk(word + " ")
+
+# Extractive answers from the knowledge base; stands in when no provider is available
+offline_engine = OfflineAnswerEngine()
+offline_llm = OfflineLLM(offline_engine, role_of=lambda system_text: role_for_prompt(system_text))
+llm = offline_llm # Default to offline answers, override if successful
 
 if LLM_PROVIDER in ("openai", "gpt", "gpt-4", "gpt-3.5-turbo", "gpt-4o"):
     try:
@@ -107,6 +132,12 @@ if LLM_PROVIDER in ("openai", "gpt", "gpt-4", "gpt-3.5-turbo", "gpt-4o"):
             print("   -> Please check your billing at https://platform.openai.com/account/billing")
         print("   -> Ensure `openai` and `langchain-openai` packages are installed and `OPENAI_API_KEY` is set.")
 
+elif LLM_PROVIDER in ("fake", "mock"):
+    MODEL_NAME = "fake"
+    FAKE_LLM_LATENCY_MS = float(os.getenv("FAKE_LLM_LATENCY_MS", "200"))
+    print(f"[?] Using deterministic fake LLM ({FAKE_LLM_LATENCY_MS:.0f} ms latency)")
+    llm = _FakeLLM(FAKE_LLM_LATENCY_MS)
+
 elif LLM_PROVIDER in ("ollama", "local", "llama", "llama3"):
     try:
         from langchain_community.chat_models import ChatOllama
@@ -168,8 +199,8 @@ elif LLM_PROVIDER in ("google", "gemini", "google_gen", "gemini-pro"):
         print("   -> Please install it with: pip install langchain-google-genai")
     except Exception as e:
         print(f"[!] Google Gemini initialization failed: {e}")
-        print("   -> Switching to Sentinel Demo Mode (Fallback).")
-        llm = _FallbackLLM()
+        print("   -> Switching to offline answers from the knowledge base.")
+        llm = offline_llm
 
 elif LLM_PROVIDER in ("anthropic", "claude"):
     try:
@@ -225,29 +256,41 @@ elif LLM_PROVIDER == "ollama":
         print(f"[!] Ollama initialization failed: {e}")
         print("   -> Ensure Ollama is running (ollama serve).")
 
-    class _FallbackImpl(_FallbackLLM):
-        async def ainvoke(self, messages):
-            class _R:
-                def __init__(self, content):
-                    self.content = content
-
-            msg = (
-                "[!] No LLM available. Initialization failed.\n"
-                "Check server logs for details.\n"
-                "1. Google (Default): Ensure GOOGLE_API_KEY is set.\n"
-                "2. OpenAI: Check API key and quota.\n"
-                "3. Ollama: Ensure it's running.\n"
-                "4. SambaNova: Ensure SAMBANOVA_API_KEY is set.\n"
-                "5. Anthropic: Ensure ANTHROPIC_API_KEY is set.\n"
-                "6. Groq: Ensure GROQ_API_KEY is set.\n"
-                f"7. Verify LLM_PROVIDER in .env (Current: {LLM_PROVIDER})"
-            )
-            return _R(msg)
+if llm is offline_llm:
+    print(
+        "[!] No LLM available; answering offline from the knowledge base.\n"
+        "   1. Google (Default): Ensure GOOGLE_API_KEY is set.\n"
+        "   2. OpenAI: Check API key and quota.\n"
+        "   3. Ollama: Ensure it's running.\n"
+        "   4. SambaNova: Ensure SAMBANOVA_API_KEY is set.\n"
+        "   5. Anthropic: Ensure ANTHROPIC_API_KEY is set.\n"
+        "   6. Groq: Ensure GROQ_API_KEY is set.\n"
+        f"   7. Verify LLM_PROVIDER in .env (Current: {LLM_PROVIDER})"
+    )
+# Answer from the knowledge base when the provider errors or times out mid-request
+OFFLINE_FAILOVER = os.getenv("OFFLINE_FAILOVER", "true").lower() == "true"
 
-    llm = _FallbackImpl()
+# Small/large model selection and per-intent max_tokens (see model_tiers.py)
+tiering = TieringPolicy(llm, LLM_PROVIDER, MODEL_NAME, os.getenv("LLM_SMALL_MODEL"))
+if tiering.has_small_tier:
+    print(f"[OK] Model tiering enabled: small={tiering.model_names['small']}, large={MODEL_NAME}")
 
 # --- IN-MEMORY CACHE ---
 chat_history_cache = {}
+# Startup warmup of the history cache: max users (0 disables) and activity window
+WARMUP_USERS = int(os.getenv("WARMUP_USERS", "2000"))
+WARMUP_HOURS = float(os.getenv("WARMUP_HOURS", "24"))
+
+# Per-day role/user usage counters, flushed to usage_rollups (see analytics.py)
+usage = analytics.UsageRollups()
+token_budgets = analytics.TokenBudgets()
+
+# Vetted answers to frequent questions, mined offline by faq_store.py
+faq_store = FAQStore()
+FAQ_REFRESH_SECONDS = int(os.getenv("FAQ_REFRESH_SECONDS", "300"))
+
+# Navigation/action commands resolved locally by intent_router.py instead of the LLM
+INTENT_ROUTER_ENABLED = os.getenv("INTENT_ROUTER_ENABLED", "true").lower() == "true"
 
 # --- PYDANTIC MODELS ---
 
@@ -269,6 +312,17 @@ class ChatRequest(BaseModel):
 
 class ChatResponse(BaseModel):
     response: str
+    actions: List[dict] = []  # parsed {{NAVIGATE:...}}/{{ACTION:...}} markers
+
+class BatchChatItem(BaseModel):
+    user_id: str
+    message: str
+
+class BatchChatRequest(BaseModel):
+    user_name: str = None
+    context: dict = {}
+    items: List[BatchChatItem]
+    max_concurrency: int = 8
 
 class Token(BaseModel):
     access_token: str
@@ -296,23 +350,31 @@ def create_access_token(data: dict):
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login", auto_error=False)
 
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
-    credentials_exception = HTTPException(
-        status_code=401,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+def decode_access_token(token: str):
+    """Claims of a valid access token ({username, role, user_id}), or None."""
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username = payload.get("sub")
-        role = payload.get("role")
-        if username is None or role is None:
-            raise credentials_exception
-        return {"username": username, "role": role}
     except JWTError:
-        raise credentials_exception
+        return None
+    username = payload.get("sub")
+    role = payload.get("role")
+    if username is None or role is None:
+        return None
+    return {"username": username, "role": role, "user_id": payload.get("user_id")}
+
+
+def get_current_user(token: str = Depends(oauth2_scheme)):
+    claims = decode_access_token(token)
+    if claims is None:
+        raise HTTPException(
+            status_code=401,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return {"username": claims["username"], "role": claims["role"], "user_id": claims["user_id"]}
 
 
 def get_current_admin_user(current_user: dict = Depends(get_current_user)):
@@ -322,15 +384,28 @@ def get_current_admin_user(current_user: dict = Depends(get_current_user)):
 
 
 # --- KNOWLEDGE BASE ---
+# Optional prebuilt snapshot (see knowledge_snapshot.py), shared by all workers via mmap
+KNOWLEDGE_SNAPSHOT_PATH = os.getenv("KNOWLEDGE_SNAPSHOT")
+knowledge_snapshot = open_snapshot(KNOWLEDGE_SNAPSHOT_PATH)
+
+
 async def load_knowledge_from_db(role: str, query: str = None) -> str:
     """
-    Fetches relevant knowledge from MongoDB based on role and optional query.
+    Fetches relevant knowledge from the mapped snapshot if one is configured,
+    otherwise from MongoDB, based on role and optional query.
     """
     if not role:
         return ""
         
     role = role.lower()
     knowledge_text = ""
+
+    if knowledge_snapshot and role in ("student", "faculty", "admin"):
+        try:
+            knowledge_text = "".join(knowledge_snapshot.search(role, query, limit=5))
+            return knowledge_text if knowledge_text else "No specific database records found."
+        except Exception as e:
+            print(f"[!] Snapshot knowledge lookup failed, using DB: {e}")
     
     try:
         if role == "student":
@@ -353,23 +428,19 @@ async def load_knowledge_from_db(role: str, query: str = None) -> str:
             cursor = db.student_knowledges.find(query_filter).limit(5)
             docs = await cursor.to_list(length=5)
             for d in docs:
-                knowledge_text += f"\n[Subject: {d.get('subject')}] {d.get('topic')}: {d.get('content')}"
-                if d.get('codeExamples'):
-                    knowledge_text += f"\n   Code: {d.get('codeExamples')[0]}"
+                knowledge_text += format_entry(role, d)
 
         elif role == "faculty":
              cursor = db.faculty_knowledges.find({}).limit(5)
              docs = await cursor.to_list(length=5)
              for d in docs:
-                 knowledge_text += f"\n[Tool: {d.get('subject')}] {d.get('topic')}: {d.get('content')}"
+                 knowledge_text += format_entry(role, d)
 
         elif role == "admin":
              cursor = db.admin_knowledges.find({}).limit(5)
              docs = await cursor.to_list(length=5)
              for d in docs:
-                 knowledge_text += f"\n[Module: {d.get('module')}] {d.get('topic')}: {d.get('content')}"
-                 if d.get('tips'):
-                      knowledge_text += f"\n   Tip: {d.get('tips')[0]}"
+                 knowledge_text += format_entry(role, d)
 
     except Exception as e:
         print(f"[!] DB Knowledge fetch failed: {e}")
@@ -379,67 +450,150 @@ async def load_knowledge_from_db(role: str, query: str = None) -> str:
 
 
 
-async def get_role_prompt(role: str, user_name: str = None, context: dict = None, user_message: str = "") -> str:
-    """
-    Generate a system prompt tailored to the user's role with enhanced knowledge base from DB.
-    """
-    role = role.lower().strip()
-    greeting_name = f" {user_name}" if user_name else ""
-    context_str = f"\n**Context**: {context}" if context else ""
-
-    # Fetch dynamic knowledge from DB based on role and current message content (for searching)
-    db_knowledge = await load_knowledge_from_db(role, user_message)
-
-    base_instructions = f"""You are Vu AI, the friendly AI assistant for Vignan University (VFSTR).
+# Static instructions come first and never vary per request, so every prompt for a role
+# shares a byte-identical prefix that providers (OpenAI, Anthropic, Gemini) can cache.
+BASE_INSTRUCTIONS = """You are Vu AI, the friendly AI assistant for Vignan University (VFSTR).
     Role: Study Companion & Friendly Assistant.
-    Hello{greeting_name}! It's great to see you again. I am here to help you succeed! 🌟
+    I am here to help you succeed! 🌟
     
     **CORE RULES:**
     1. **Multi-Language**: Detect user's language and respond in the SAME language.
-    2. **Knowledge Base**: Use the provided knowledge below.
+    2. **Knowledge Base**: Use the dynamic knowledge base provided after these instructions.
     3. **Tone**: Warm, Encouraging, and Motivating. Use emojis 🎓🚀✨
     4. **Speed**: Be concise and actionable.
+    5. **Greeting**: Address the user by the name given in the request details, if any.
     """
 
-    if role == "student":
-        role_text = """
+ROLE_INSTRUCTIONS = {
+    "student": """
         **ROLE: FRIENDLY STUDY COMPANION 🎓**
         - **Subject Helper**: Explain concepts (Math, CS, Physics) simply with real-world examples.
         - **Programming Mentor**: For coding (Python, Java, etc.), provide logic + code + clear explanation.
         - **Doubts & Ideas**: encourage brainstorming! "What do you think about..."
         - **Navigation**: {{NAVIGATE: <section>}} (e.g., {{NAVIGATE:assignments}}).
-        """
-    elif role == "faculty":
-        role_text = """
+        """,
+    "faculty": """
         **ROLE: EFFICIENT TEACHING ASSISTANT 👩‍🏫**
         - **Attendance**: "Want me to mark attendance?" -> {{ACTION:mark_attendance}}.
         - **Exams**: "Let's create an exam paper!" -> {{ACTION:create_exam}}.
         - **Materials**: Upload helper -> {{ACTION:upload_notes}}.
         - **Dashboards**: {{NAVIGATE:attendance}}, {{NAVIGATE:exams}}.
-        """
-    elif role == "admin":
-        role_text = """
+        """,
+    "admin": """
         **ROLE: INSTITUTIONAL MANAGER 💼**
         - **Students**: "Add new student" -> {{ACTION:add_student}}.
         - **Fees**: "Check fee collection" -> {{NAVIGATE:fees}}.
         - **System**: "Fix database" -> {{ACTION:run_cleanup}}.
         - **Tips**: Provide fee collection strategies and optimization tips.
-        """
-    else:
-        role_text = "Be helpful and guide the user."
+        """,
+}
+DEFAULT_ROLE_INSTRUCTIONS = "Be helpful and guide the user."
+
+
+def _compile_role_prefixes() -> dict:
+    """Builds the static prompt prefix for every role once, at startup."""
+    prefixes = {
+        role: f"{BASE_INSTRUCTIONS}\n\n{role_text}\n\n"
+        for role, role_text in ROLE_INSTRUCTIONS.items()
+    }
+    prefixes[None] = f"{BASE_INSTRUCTIONS}\n\n{DEFAULT_ROLE_INSTRUCTIONS}\n\n"
+    return prefixes
+
+
+ROLE_PROMPT_PREFIXES = _compile_role_prefixes()
+
 
-    return f"""*** DYNAMIC KNOWLEDGE BASE ***
+def role_for_prompt(system_text: str):
+    """Role whose static prefix starts `system_text`, if any."""
+    for role, prefix in ROLE_PROMPT_PREFIXES.items():
+        if role and system_text.startswith(prefix):
+            return role
+    return None
+
+
+async def get_role_prompt_parts(role: str, user_name: str = None, context: dict = None, user_message: str = "") -> tuple:
+    """
+    Returns (static prefix, dynamic suffix) for a role's system prompt.
+    The prefix is precompiled and identical for every request of that role; the
+    suffix carries the per-request knowledge, user name and context.
+    """
+    role = role.lower().strip()
+    prefix = ROLE_PROMPT_PREFIXES.get(role, ROLE_PROMPT_PREFIXES[None])
+
+    # Fetch dynamic knowledge from DB based on role and current message content (for searching)
+    db_knowledge = await load_knowledge_from_db(role, user_message)
+
+    name_str = f"\n**User Name**: {user_name}" if user_name else ""
+    context_str = f"\n**Context**: {context}" if context else ""
+    suffix = f"""*** DYNAMIC KNOWLEDGE BASE ***
 {db_knowledge}
 *****************************
+{name_str}{context_str}"""
+    return prefix, suffix
 
-{base_instructions}
 
-{role_text}
+async def get_role_prompt(role: str, user_name: str = None, context: dict = None, user_message: str = "") -> str:
+    """
+    Generate a system prompt tailored to the user's role with enhanced knowledge base from DB.
+    """
+    prefix, suffix = await get_role_prompt_parts(role, user_name, context, user_message)
+    return prefix + suffix
+
+
+async def build_system_message(role: str, user_name: str = None, context: dict = None, user_message: str = "") -> SystemMessage:
+    """
+    System message with the cacheable static prefix first. Anthropic only caches
+    explicitly marked blocks, so there the prefix gets a cache_control breakpoint;
+    OpenAI and Gemini cache matching prefixes automatically.
+    """
+    prefix, suffix = await get_role_prompt_parts(role, user_name, context, user_message)
+    if LLM_PROVIDER in ("anthropic", "claude"):
+        return SystemMessage(content=[
+            {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": suffix},
+        ])
+    return SystemMessage(content=prefix + suffix)
+
+
+class PromptCacheStats:
+    """Provider-reported prefix cache usage, for providers that return it."""
+
+    def __init__(self):
+        self.calls = 0
+        self.reported = 0
+        self.hits = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+
+    def record(self, ai_response):
+        self.calls += 1
+        reported = analytics.provider_usage(ai_response)
+        if reported is None:
+            return
+        input_tokens, _, cached = reported
+        self.reported += 1
+        self.input_tokens += input_tokens
+        self.cached_tokens += cached
+        if cached:
+            self.hits += 1
+
+    def snapshot(self):
+        return {
+            "calls": self.calls,
+            "calls_with_usage": self.reported,
+            "prefix_hit_rate": round(self.hits / self.reported, 4) if self.reported else None,
+            "input_tokens": self.input_tokens,
+            "cached_input_tokens": self.cached_tokens,
+            "cached_token_ratio": round(self.cached_tokens / self.input_tokens, 4) if self.input_tokens else None,
+        }
 
-{context_str}"""
+
+prompt_cache_stats = PromptCacheStats()
 
 
 # --- DATABASE SETUP ---
+# "documents": one chats document per exchange; "buckets": per-user period buckets (chat_buckets.py)
+CHAT_STORAGE = os.getenv("CHAT_STORAGE", "documents").lower()
 mongo_uri = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 try:
     client = AsyncIOMotorClient(mongo_uri)
@@ -451,18 +605,117 @@ try:
 
     users_collection = db.users
     chat_collection = db.chats
+    chat_bucket_collection = db.chat_buckets
+    batch_chat_collection = db.batch_chats
+    archive_collection = db.chat_archive
+    usage_collection = db.usage_rollups
     print(f"[OK] MongoDB connection configured: {mongo_uri}")
 except Exception as e:
     print(f"[!] MongoDB initialization failed: {e}")
 
+# Per-user and per-role token buckets in front of the chat endpoints (see rate_limit.py)
+if RATE_LIMIT_BACKEND == "mongo":
+    rate_limiter = MongoRateLimiter(db.rate_limits)
+else:
+    rate_limiter = RateLimiter()
+
+
+# Idempotency-Key support for /chat retries (see idempotency.py)
+idempotency_store = idempotency.IdempotencyStore(db.idempotency_keys)
+
+
+async def rate_limit_retry_after(user_id: str, role: str, cost: int = 1) -> int:
+    """Seconds the caller must wait (0 if the request may proceed). Fails open if the limiter errors."""
+    if not RATE_LIMIT_ENABLED:
+        return 0
+    try:
+        allowed, retry_after = await rate_limiter.check(user_id, role, cost)
+    except Exception as e:
+        print(f"   [!] Rate limiter unavailable: {e}")
+        return 0
+    if allowed:
+        return 0
+    print(f"   [!] Rate limited: user={user_id} role={role} retry in {retry_after:.1f}s")
+    return max(1, math.ceil(retry_after))
+
+
+async def token_budget_retry_after(user_id: str, role: str) -> int:
+    """Seconds until the user's daily token budget resets if it is used up, else 0."""
+    if not token_budgets.limits:
+        return 0
+    if await token_budgets.check(usage_collection, user_id, role) != analytics.THROTTLE:
+        return 0
+    print(f"   [!] Token budget used up: user={user_id} role={role}")
+    return token_budgets.seconds_until_reset()
+
+
+def token_budget_downgrade(request: ChatRequest) -> bool:
+    """True once the user has used TOKEN_BUDGET_DOWNGRADE_AT of today's token budget."""
+    return token_budgets.state(request.user_id, request.role) != analytics.OK
+
+
+def chat_identity(request: ChatRequest, http_request: Request, token: str = None) -> str:
+    """
+    Pins a chat request to its bearer token's user and role when one is sent, and
+    returns the key for the per-user rate limit bucket. Without a token the body's
+    user_id and role are trusted as sent by the Node backend, so per-role fairness
+    holds only for trusted callers; the bucket is keyed on the client address as well
+    so a direct caller can't drain another user's bucket.
+    """
+    if token:
+        claims = decode_access_token(token)
+        if claims is None:
+            raise HTTPException(
+                status_code=401,
+                detail="Could not validate credentials",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        request.user_id = claims["user_id"] or claims["username"]
+        request.role = claims["role"]
+        return request.user_id
+    client = http_request.client.host if http_request.client else "unknown"
+    return f"{request.user_id}@{client}"
+
+
+async def enforce_rate_limit(user_id: str, role: str, cost: int = 1, limit_key: str = None):
+    """
+    Raises 429 with Retry-After when the user's daily token budget or the user's or role's
+    bucket is empty. `limit_key` overrides the user bucket key (see chat_identity).
+    """
+    budget_wait = await token_budget_retry_after(user_id, role)
+    if budget_wait:
+        raise HTTPException(
+            status_code=429,
+            detail="Daily AI usage limit reached. It resets at midnight UTC.",
+            headers={"Retry-After": str(budget_wait)},
+        )
+    retry_after = await rate_limit_retry_after(limit_key or user_id, role, cost)
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests. Please wait a moment and try again.",
+            headers={"Retry-After": str(retry_after)},
+        )
+
 @app.post("/agent/reload")
 async def reload_agent_knowledge():
     """Admin endpoint to reload internal caches or knowledge."""
     # In future, if we have in-memory caches for DB content, clear them here.
     # For now, it's a signal that works.
     print("[!] Received reload signal. Clearing internal caches...")
-    global chat_history_cache
+    global chat_history_cache, knowledge_snapshot
     chat_history_cache = {}
+    if KNOWLEDGE_SNAPSHOT_PATH:
+        # Remap so a rebuilt snapshot file is picked up
+        old_snapshot = knowledge_snapshot
+        knowledge_snapshot = open_snapshot(KNOWLEDGE_SNAPSHOT_PATH)
+        if old_snapshot:
+            old_snapshot.close()
+    try:
+        await faq_store.refresh(db.faqs)
+    except Exception as e:
+        print(f"[!] FAQ refresh failed: {e}")
+    await refresh_offline_engine()
     return {"status": "reloaded", "message": "Agent caches cleared & Knowledge updated."}
 
 
@@ -509,6 +762,124 @@ async def startup_checks():
         print("[X] SYSTEM STATUS: ISSUES DETECTED\n")
 
 
+async def refresh_faq_store_periodically():
+    """Keeps the in-memory FAQ answers in sync with newly mined/approved entries."""
+    while True:
+        try:
+            count = await faq_store.refresh(db.faqs)
+            print(f"[FAQ] Loaded {count} vetted FAQ answers")
+        except Exception as e:
+            print(f"[!] FAQ refresh failed: {e}")
+        await asyncio.sleep(FAQ_REFRESH_SECONDS)
+
+
+async def refresh_offline_engine():
+    """Re-indexes the knowledge collections for offline answers."""
+    try:
+        count = await offline_engine.refresh(db)
+        print(f"[OK] Offline answer index: {count} sentences")
+    except Exception as e:
+        print(f"[!] Offline answer index refresh failed: {e}")
+
+
+async def warm_history_cache():
+    """
+    Fills chat_history_cache for recently active users with one aggregation, so the
+    first messages after a restart don't each pay a history query.
+    """
+    if WARMUP_USERS <= 0:
+        return
+    since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=WARMUP_HOURS)
+    try:
+        if CHAT_STORAGE == "buckets":
+            pipeline = chat_buckets.recent_history_pipeline(since, per_user=3, max_users=WARMUP_USERS)
+            cursor = chat_bucket_collection.aggregate(pipeline, allowDiskUse=True)
+        else:
+            pipeline = history_store.recent_history_pipeline(since, per_user=3, max_users=WARMUP_USERS)
+            cursor = chat_collection.aggregate(pipeline, allowDiskUse=True)
+
+        warmed = 0
+        async for entry in cursor:
+            # Entries written by live requests while warming are newer; keep them
+            if entry["_id"] is None or entry["_id"] in chat_history_cache:
+                continue
+            chat_history_cache[entry["_id"]] = history_store.from_chat_docs(reversed(entry.get("chats") or []))
+            warmed += 1
+        print(f"[OK] History cache warmed for {warmed} users active in the last {WARMUP_HOURS:g}h")
+    except Exception as e:
+        print(f"[!] History cache warmup skipped: {e}")
+
+
+async def archive_chats_periodically():
+    """Moves chats older than ARCHIVE_AFTER_DAYS into the compressed archive (one worker at a time)."""
+    buckets = CHAT_STORAGE == "buckets"
+    source = chat_bucket_collection if buckets else chat_collection
+    owner = f"{os.uname().nodename}:{os.getpid()}"
+    try:
+        await chat_archive.ensure_indexes(archive_collection, None if buckets else chat_collection)
+    except Exception as e:
+        print(f"[!] Archive index setup failed: {e}")
+    while True:
+        try:
+            moved = await chat_archive.archive_old_chats(
+                source, archive_collection, db.chat_archive_meta, buckets=buckets, owner=owner
+            )
+            if moved:
+                print(f"[Archive] Moved {moved} exchanges older than {chat_archive.ARCHIVE_AFTER_DAYS:g} days")
+        except Exception as e:
+            print(f"[!] Chat archival failed: {e}")
+        await asyncio.sleep(chat_archive.ARCHIVE_INTERVAL_HOURS * 3600)
+
+
+async def flush_usage_periodically():
+    """Writes the in-memory usage counters to the rollup collection."""
+    try:
+        await analytics.ensure_indexes(usage_collection)
+    except Exception as e:
+        print(f"[!] Usage rollup index setup failed: {e}")
+    while True:
+        await asyncio.sleep(analytics.ANALYTICS_FLUSH_SECONDS)
+        try:
+            await usage.flush(usage_collection)
+        except Exception as e:
+            print(f"[!] Usage rollup flush failed: {e}")
+
+
+@app.on_event("shutdown")
+async def flush_usage_on_shutdown():
+    try:
+        await usage.flush(usage_collection)
+    except Exception as e:
+        print(f"[!] Final usage rollup flush failed: {e}")
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    """Starts long-running background refresh tasks."""
+    asyncio.create_task(refresh_faq_store_periodically())
+    asyncio.create_task(warm_history_cache())
+    asyncio.create_task(refresh_offline_engine())
+    asyncio.create_task(flush_usage_periodically())
+    asyncio.create_task(jobs.start())
+    if chat_archive.ARCHIVE_AFTER_DAYS > 0:
+        asyncio.create_task(archive_chats_periodically())
+    try:
+        await idempotency_store.ensure_indexes()
+    except Exception as e:
+        print(f"[!] Idempotency key index setup failed: {e}")
+    if isinstance(rate_limiter, MongoRateLimiter):
+        try:
+            await rate_limiter.ensure_indexes()
+        except Exception as e:
+            print(f"[!] Rate limit index setup failed: {e}")
+    if CHAT_STORAGE == "buckets":
+        try:
+            await chat_buckets.ensure_indexes(chat_bucket_collection)
+            print("[OK] Chat storage: buckets")
+        except Exception as e:
+            print(f"[!] Chat bucket index setup failed: {e}")
+
+
 @app.get("/")
 async def root():
     """
@@ -524,7 +895,7 @@ async def root():
         
     # 2. Check LLM
     llm_ok = False
-    if llm and getattr(getattr(llm, "__class__", None), "__name__", "") != "_FallbackLLM":
+    if llm and llm is not offline_llm:
         llm_ok = True
 
     # 3. Determine Overall Status
@@ -538,12 +909,239 @@ async def root():
     }
 
 
+# --- CONVERSATION HISTORY ---
+async def load_history_messages(user_id: str) -> list:
+    """
+    Returns the user's recent exchanges as LangChain messages, from the in-memory
+    cache when present, otherwise from the DB (and caches them).
+    The cache itself holds compact Turn tuples (see history_store.py).
+    """
+    if user_id in chat_history_cache:
+        print("   [History] Loaded from cache")
+        return history_store.to_messages(chat_history_cache[user_id])
+
+    try:
+        if CHAT_STORAGE == "buckets":
+            history = await chat_buckets.recent_exchanges(chat_bucket_collection, user_id, limit=3)
+        else:
+            history_cursor = (
+                chat_collection.find({"user_id": user_id})
+                .sort("timestamp", -1)
+                .limit(3) # Load last 3 exchanges
+            )
+            history = await history_cursor.to_list(length=3)
+            history.reverse()  # Restore chronological order
+
+        # Truncated to prevent context window overflow
+        turns = history_store.from_chat_docs(history)
+        chat_history_cache[user_id] = turns
+        print(f"   [History] Loaded {len(history)} exchanges from DB and cached")
+        return history_store.to_messages(turns)
+    except Exception as history_error:
+        print(f"   [!] History load from DB skipped: {history_error}")
+        chat_history_cache[user_id] = () # Init empty cache on error
+        return []
+
+
+def update_history_cache(user_id: str, user_message: str, response_text: str):
+    """Appends the latest exchange to the user's cached history (last 4 exchanges kept)."""
+    chat_history_cache[user_id] = history_store.append_exchange(
+        chat_history_cache.get(user_id), user_message, response_text
+    )
+
+
+async def save_chat(user_id: str, role: str, message: str, response_text: str, **extra):
+    """Persists one exchange; failures are logged, never raised."""
+    try:
+        chat_doc = {
+            "user_id": user_id,
+            "role": role,
+            "message": message,
+            "response": response_text,
+            "timestamp": datetime.datetime.now(datetime.timezone.utc),
+            **extra,
+        }
+        if CHAT_STORAGE == "buckets":
+            await chat_buckets.append_exchange(chat_bucket_collection, user_id, chat_doc)
+        else:
+            await chat_collection.insert_one(chat_doc)
+        print("   [Save] Chat saved to database")
+    except Exception as db_error:
+        print(f"   [!] Database save failed: {db_error}")
+
+
+def answer_locally(role: str, user_message: str):
+    """
+    (response text, source, label) for dashboard commands and vetted FAQ hits,
+    which are answered without any LLM call; None otherwise.
+    """
+    routed = intent_router.route(role, user_message) if INTENT_ROUTER_ENABLED else None
+    if routed:
+        print(f"   [Intent] {routed.intent} ({routed.source}, confidence {routed.confidence})")
+        return routed.response_text(), "intent", routed.intent
+
+    faq_answer = faq_store.lookup(role, user_message)
+    if faq_answer:
+        print("   [FAQ] Answered from FAQ store")
+        return faq_answer, "faq", "hit"
+    return None
+
+
+async def build_chat_messages(request: ChatRequest, user_message: str, history=None) -> list:
+    """System prompt + recent history + the current message."""
+    # 1. Build system prompt with knowledge base (async wait)
+    messages = [await build_system_message(request.role, request.user_name, request.context, user_message)]
+
+    # 2. Conversation history: given turns, else the user's history (cached for speed)
+    if history is not None:
+        messages.extend(history_store.to_messages(history))
+    else:
+        messages.extend(await load_history_messages(request.user_id))
+
+    # 3. Add current user message
+    messages.append(HumanMessage(content=user_message))
+    return messages
+
+
+def offline_failover(role: str, user_message: str):
+    """Extractive answer used when the provider fails; None if disabled or already offline."""
+    if not OFFLINE_FAILOVER or llm is offline_llm:
+        return None
+    try:
+        answer = offline_engine.answer((role or "").lower(), user_message)
+    except Exception as e:
+        print(f"   [!] Offline failover failed: {e}")
+        return None
+    print("   [Offline] Answered from the knowledge base")
+    return f"{OFFLINE_NOTICE}\n\n{answer}"
+
+
+def llm_error_text(llm_error: Exception) -> str:
+    """User-facing message for a failed LLM call."""
+    error_msg = str(llm_error).lower()
+    print(f"   [X] LLM Error: {error_msg[:100]}")
+
+    if "not found" in error_msg and "model" in error_msg:
+        return (
+            f"[X] The AI model ({MODEL_NAME or 'unknown'}) is not available. "
+            f"Please ensure the model is available for provider '{LLM_PROVIDER}'."
+        )
+    if "429" in error_msg or "rate limit" in error_msg or "quota" in error_msg:
+        return "[!] I'm receiving too many requests right now. Please wait a moment and try again! (Rate Limit Exceeded)"
+    return (
+        f"[!] The AI encountered an error: {str(llm_error)}. "
+        "Please check the LLM provider configuration and try again."
+    )
+
+
+LLM_TIMEOUT_TEXT = (
+    "[Timeout] The AI is taking a bit longer than usual. "
+    f"The model ({MODEL_NAME}) might be busy. Please try asking again!"
+)
+EMPTY_RESPONSE_TEXT = (
+    "I'm here but having trouble forming a response. "
+    "Please try again! [!]"
+)
+
+
+async def finish_exchange(request: ChatRequest, user_message: str, response_text: str,
+                          outcome: str = "ok", llm_latency_ms: float = None, tokens=None, model: str = None,
+                          **extra):
+    """
+    Updates the history cache, usage rollups and token budget, and persists the
+    exchange. `tokens` is (prompt, completion, estimated) for the LLM call, if any.
+    """
+    try:
+        update_history_cache(request.user_id, user_message, response_text)
+        print("   [Cache] Updated chat history cache")
+    except Exception as cache_error:
+        print(f"   [!] Cache update failed: {cache_error}")
+    source = "offline" if response_text.startswith(OFFLINE_NOTICE) else extra.get("source", "llm")
+    prompt_tokens, completion_tokens, estimated = tokens or (0, 0, False)
+    usage.record(request.role, request.user_id, len(response_text), llm_latency_ms, outcome, source,
+                 prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, model=model,
+                 tokens_estimated=estimated)
+    if tokens:
+        token_budgets.spend(request.user_id, prompt_tokens + completion_tokens)
+        extra["model"] = model
+        extra["tokens"] = {"prompt": prompt_tokens, "completion": completion_tokens, "estimated": estimated}
+    await save_chat(request.user_id, request.role, user_message, response_text, **extra)
+
+
 @app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, response: Response, http_request: Request,
+               token: str = Depends(optional_oauth2_scheme)):
     """
     Main chat endpoint. Processes user messages and returns AI responses.
     Supports conversation history and role-based responses.
+    The whole request runs within one deadline (X-Request-Deadline-Ms header or
+    CHAT_DEADLINE_SECONDS) and is cancelled if the client disconnects.
+    With a bearer token the user and role come from the token (see chat_identity).
+    """
+    limit_key = chat_identity(request, http_request, token)
+    deadline = Deadline.from_header(http_request.headers.get(DEADLINE_HEADER))
+    idempotency_key = (http_request.headers.get(idempotency.IDEMPOTENCY_HEADER) or "").strip()
+    if idempotency_key:
+        return await idempotent_chat(request, response, http_request, idempotency_key, deadline, limit_key)
+    await enforce_rate_limit(request.user_id, request.role, limit_key=limit_key)
+    try:
+        return await run_until_disconnected(http_request, chat_work(request, response, deadline))
+    except ClientDisconnected:
+        print(f"   [!] Client disconnected, cancelled chat for {request.user_id}")
+        return Response(status_code=499)
+
+
+def chat_work(request: ChatRequest, response: Response, deadline: Deadline):
+    """handle_chat, profiled for the PROFILE_REQUEST_RATE sample of requests."""
+    work = handle_chat(request, response, deadline)
+    if profiler.sample_request():
+        work = profiler.run_profiled(work, f"/chat {request.role} {request.user_id}")
+    return work
+
+
+async def idempotent_chat(request: ChatRequest, response: Response, http_request: Request, key: str,
+                          deadline: Deadline, limit_key: str = None):
+    """
+    /chat with an Idempotency-Key: retries attach to the running answer or get the
+    stored one replayed (Idempotent-Replayed: true) instead of calling the LLM again.
+    The answer is finished even if this client disconnects, so its retry can collect it.
+    Rate limits and token budgets are charged only when the answer is actually generated,
+    not for replays or retries that attach to it.
     """
+    if len(key) > idempotency.MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail="Idempotency-Key is too long")
+
+    async def work():
+        await enforce_rate_limit(request.user_id, request.role, limit_key=limit_key)
+        own_response = Response()
+        body = await chat_work(request, own_response, deadline)
+        headers = {k: v for k, v in own_response.headers.items() if k.startswith("x-")}
+        # Failed and timed-out answers are not kept, so a later retry tries again
+        return {"response": body.response, "actions": body.actions, "headers": headers}, "x-outcome" not in headers
+
+    fp = idempotency.fingerprint(request.role, request.message.strip(), request.user_name)
+    try:
+        result, replayed = await run_until_disconnected(
+            http_request, idempotency_store.run(request.user_id, key, fp, work)
+        )
+    except idempotency.KeyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except idempotency.InProgress as e:
+        raise HTTPException(status_code=409, detail=str(e), headers={"Retry-After": "2"})
+    except ClientDisconnected:
+        print(f"   [!] Client disconnected, answer for {request.user_id} kept for its retry")
+        return Response(status_code=499)
+
+    for name, value in result["headers"].items():
+        response.headers[name] = value
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+        print(f"   [Idempotency] Replayed answer for {request.user_id}")
+    return ChatResponse(response=result["response"], actions=result["actions"])
+
+
+async def handle_chat(request: ChatRequest, response: Response, deadline: Deadline):
+    """Processes one chat message within the given deadline."""
     user_message = request.message.strip()
 
     # Validation
@@ -556,51 +1154,34 @@ async def chat(request: ChatRequest):
     print(f"   Message: {user_message[:80]}...")
 
     try:
-        # 1. Build system prompt with knowledge base (async wait)
-        system_text = await get_role_prompt(request.role, request.user_name, request.context, user_message)
-        messages = [SystemMessage(content=system_text)]
-
-        # 2. Fetch conversation history, using cache for speed
-        if request.user_id in chat_history_cache:
-            print("   [History] Loaded from cache")
-            messages.extend(chat_history_cache[request.user_id])
-        else:
-            try:
-                history_cursor = (
-                    chat_collection.find({"user_id": request.user_id})
-                    .sort("timestamp", -1)
-                    .limit(3) # Load last 3 exchanges
-                )
-                history = await history_cursor.to_list(length=3)
-                history.reverse()  # Restore chronological order
-
-                cached_messages = []
-                for h in history:
-                    # Truncate history to prevent context window overflow
-                    user_msg_str = (h.get("message") or "")[:500]
-                    ai_msg_str = (h.get("response") or "")[:1000]
-
-                    user_msg_obj = HumanMessage(content=user_msg_str)
-                    messages.append(user_msg_obj)
-                    cached_messages.append(user_msg_obj)
-
-                    if ai_msg_str:
-                        ai_msg_obj = AIMessage(content=ai_msg_str)
-                        messages.append(ai_msg_obj)
-                        cached_messages.append(ai_msg_obj)
-                
-                chat_history_cache[request.user_id] = cached_messages
-                print(f"   [History] Loaded {len(history)} exchanges from DB and cached")
-            except Exception as history_error:
-                print(f"   [!] History load from DB skipped: {history_error}")
-                chat_history_cache[request.user_id] = [] # Init empty cache on error
-
-        # 3. Add current user message
-        current_user_message = HumanMessage(content=user_message)
-        messages.append(current_user_message)
+        # 0. Dashboard commands and frequent questions are answered without any LLM call
+        local = answer_locally(request.role, user_message)
+        if local:
+            response_text, source, label = local
+            response.headers["X-Intent" if source == "intent" else "X-FAQ"] = label
+            await finish_exchange(request, user_message, response_text, source=source)
+            return ChatResponse(response=response_text, actions=extract_markers(response_text))
+
+        # 1-3. Prompt, history and current message
+        cache_hit = request.user_id in chat_history_cache
+        response.headers["X-History-Cache"] = "hit" if cache_hit else "miss"
+        try:
+            messages = await asyncio.wait_for(
+                build_chat_messages(request, user_message), timeout=deadline.timeout()
+            )
+        except asyncio.TimeoutError:
+            print("   [Timeout] Deadline spent before reaching the LLM")
+            usage.record(request.role, request.user_id, 0, outcome="timeout", source="none")
+            response.headers["X-Outcome"] = "timeout"
+            return ChatResponse(response=LLM_TIMEOUT_TEXT)
 
         # 4. Generate AI Response with timeout and retries
-        print("   [LLM] Invoking LLM...")
+        choice = tiering.select(request.role, user_message, token_budget_downgrade(request))
+        response.headers["X-Model-Tier"] = choice.tier
+        print(f"   [LLM] Invoking LLM ({choice.tier} tier, {choice.intent}, max_tokens {choice.max_tokens})...")
+        outcome = "ok"
+        ai_response = None
+        llm_started = time.perf_counter()
         try:
             # Retry loop for Rate Limits (429)
             max_retries = 3
@@ -608,85 +1189,55 @@ async def chat(request: ChatRequest):
             
             while True:
                 try:
-                    ai_response = await asyncio.wait_for(
-                        llm.ainvoke(messages), timeout=15
-                    )
+                    async with tiering.track(choice):
+                        ai_response = await asyncio.wait_for(
+                            choice.model.ainvoke(messages), timeout=deadline.timeout(15)
+                        )
                     response_text = ai_response.content.strip()
+                    prompt_cache_stats.record(ai_response)
                     break # Success
                 except Exception as inner_e:
                     err_str = str(inner_e).lower()
                     if "429" in err_str or "rate limit" in err_str:
                         current_retry += 1
-                        if current_retry > max_retries:
-                            raise inner_e
-                        
                         # Use exponential backoff with jitter to be more resilient
                         wait_seconds = (2 ** current_retry) + (random.random() * 0.5)
+                        if current_retry > max_retries or not deadline.allows(wait_seconds):
+                            raise inner_e
+
                         print(f"   [!] Rate limit hit. Retrying in {wait_seconds:.2f}s... ({current_retry}/{max_retries})")
                         await asyncio.sleep(wait_seconds)
                     else:
                         raise inner_e
 
             if not response_text:
-                response_text = (
-                    "I'm here but having trouble forming a response. "
-                    "Please try again! [!]"
-                )
+                response_text = EMPTY_RESPONSE_TEXT
 
             print(f"   [OK] LLM Response: {response_text[:80]}...")
 
         except asyncio.TimeoutError:
-            print("   [Timeout] LLM timeout (90s)")
-            response_text = (
-                "[Timeout] The AI is taking a bit longer than usual. "
-                f"The model ({MODEL_NAME}) might be busy. Please try asking again!"
-            )
+            print(f"   [Timeout] LLM timeout ({deadline.budget:.1f}s budget)")
+            outcome = "timeout"
+            response_text = offline_failover(request.role, user_message) or LLM_TIMEOUT_TEXT
         except Exception as llm_error:
-            error_msg = str(llm_error).lower()
-            print(f"   [X] LLM Error: {error_msg[:100]}")
-
-            if "not found" in error_msg and "model" in error_msg:
-                response_text = (
-                    f"[X] The AI model ({MODEL_NAME or 'unknown'}) is not available. "
-                    f"Please ensure the model is available for provider '{LLM_PROVIDER}'."
-                )
-            elif "429" in error_msg or "rate limit" in error_msg or "quota" in error_msg:
-                response_text = "[!] I'm receiving too many requests right now. Please wait a moment and try again! (Rate Limit Exceeded)"
-            else:
-                response_text = (
-                    f"[!] The AI encountered an error: {str(llm_error)}. "
-                    "Please check the LLM provider configuration and try again."
-                )
+            outcome = "error"
+            error_text = llm_error_text(llm_error)
+            response_text = offline_failover(request.role, user_message) or error_text
+        llm_latency_ms = (time.perf_counter() - llm_started) * 1000
+        if response_text.startswith(OFFLINE_NOTICE):
+            response.headers["X-Answer-Source"] = "offline"
+        if outcome != "ok":
+            response.headers["X-Outcome"] = outcome
 
         # 5. Update cache and save to Database
-        try:
-            # Update in-memory cache
-            if request.user_id not in chat_history_cache:
-                chat_history_cache[request.user_id] = []
-            chat_history_cache[request.user_id].extend([current_user_message, AIMessage(content=response_text)])
-            # Keep cache size manageable (e.g., last 4 exchanges)
-            if len(chat_history_cache[request.user_id]) > 8:
-                chat_history_cache[request.user_id] = chat_history_cache[request.user_id][-8:]
-            print("   [Cache] Updated chat history cache")
-        except Exception as cache_error:
-            print(f"   [!] Cache update failed: {cache_error}")
-        try:
-            chat_doc = {
-                "user_id": request.user_id,
-                "role": request.role,
-                "message": user_message,
-                "response": response_text,
-                "timestamp": datetime.datetime.now(datetime.timezone.utc),
-            }
-            await chat_collection.insert_one(chat_doc)
-            print("   [Save] Chat saved to database")
-        except Exception as db_error:
-            print(f"   [!] Database save failed: {db_error}")
+        tokens = analytics.token_counts(ai_response, messages, response_text) if ai_response is not None else None
+        await finish_exchange(request, user_message, response_text, outcome, llm_latency_ms, tokens, choice.model_name)
 
-        return ChatResponse(response=response_text)
+        return ChatResponse(response=response_text, actions=extract_markers(response_text))
 
     except Exception as e:
         print(f"   [X] Critical Error: {e}")
+        response.headers["X-Outcome"] = "error"
         error_response = (
             "An unexpected error occurred. "
             "Please try again or contact support."
@@ -694,26 +1245,491 @@ async def chat(request: ChatRequest):
         return ChatResponse(response=error_response)
 
 
+# --- STREAMING CHAT ---
+def _chunk_text(chunk) -> str:
+    content = getattr(chunk, "content", chunk)
+    if isinstance(content, list):  # content blocks (e.g. Anthropic)
+        return "".join(b.get("text", "") if isinstance(b, dict) else str(b) for b in content)
+    return content or ""
+
+
+async def stream_llm(messages, choice, deadline: Deadline, chunk_timeout: float = 15, usage: dict = None):
+    """
+    Yields response text chunks from the chosen tier's model within the deadline.
+    Rate-limited attempts are retried with backoff as long as nothing has been
+    streamed yet; models without astream yield one chunk. Provider token usage,
+    when reported, is copied into `usage`.
+    """
+    model = choice.model
+    if not hasattr(model, "astream"):
+        async with tiering.track(choice):
+            ai_response = await asyncio.wait_for(model.ainvoke(messages), timeout=deadline.timeout(chunk_timeout))
+        if usage is not None and getattr(ai_response, "usage_metadata", None):
+            usage.update(ai_response.usage_metadata)
+        yield ai_response.content
+        return
+
+    max_retries = 3
+    current_retry = 0
+    while True:
+        started = False
+        try:
+            async with tiering.track(choice):
+                stream = model.astream(messages).__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(stream.__anext__(), timeout=deadline.timeout(chunk_timeout))
+                    except StopAsyncIteration:
+                        return
+                    started = True
+                    if usage is not None and getattr(chunk, "usage_metadata", None):
+                        usage.update(chunk.usage_metadata)
+                    yield _chunk_text(chunk)
+        except Exception as inner_e:
+            err_str = str(inner_e).lower()
+            if started or not ("429" in err_str or "rate limit" in err_str):
+                raise
+            current_retry += 1
+            wait_seconds = (2 ** current_retry) + (random.random() * 0.5)
+            if current_retry > max_retries or not deadline.allows(wait_seconds):
+                raise
+            print(f"   [!] Rate limit hit. Retrying in {wait_seconds:.2f}s... ({current_retry}/{max_retries})")
+            await asyncio.sleep(wait_seconds)
+
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def chat_events(request: ChatRequest, user_message: str, deadline: Deadline, history=None):
+    """
+    Yields (event, data) pairs for one streamed exchange: `action` for each marker
+    as soon as it is complete, `token` for display text, `error`, then `done` with
+    the full response. Shared by /chat/stream and /ws/chat. `history` (Turn tuple)
+    replaces the cached user history when given.
+    """
+    local = answer_locally(request.role, user_message)
+    if local:
+        response_text, source, _ = local
+        actions = extract_markers(response_text)
+        for action in actions:
+            yield "action", action
+        yield "token", {"text": strip_markers(response_text)}
+        await finish_exchange(request, user_message, response_text, source=source)
+        yield "done", {"response": response_text, "actions": actions, "source": source}
+        return
+
+    parser = MarkerStreamParser()
+    parts = []
+    outcome = "ok"
+    messages = None
+    choice = None
+    llm_usage = {}
+    llm_started = time.perf_counter()
+    try:
+        messages = await asyncio.wait_for(
+            build_chat_messages(request, user_message, history), timeout=deadline.timeout()
+        )
+        choice = tiering.select(request.role, user_message, token_budget_downgrade(request))
+        async for text in stream_llm(messages, choice, deadline, usage=llm_usage):
+            parts.append(text)
+            for kind, payload in parser.feed(text):
+                if kind == "marker":
+                    yield "action", payload
+                elif payload:
+                    yield "token", {"text": payload}
+        for _, payload in parser.flush():
+            yield "token", {"text": payload}
+        response_text = "".join(parts).strip() or EMPTY_RESPONSE_TEXT
+    except Exception as llm_error:
+        if isinstance(llm_error, asyncio.TimeoutError):
+            print("   [Timeout] LLM stream stalled")
+            outcome = "timeout"
+            response_text = LLM_TIMEOUT_TEXT
+        else:
+            outcome = "error"
+            response_text = llm_error_text(llm_error)
+        fallback = None if parts else offline_failover(request.role, user_message)
+        if fallback:
+            response_text = fallback
+            yield "token", {"text": response_text}
+        else:
+            yield "error", {"message": response_text}
+
+    llm_latency_ms = (time.perf_counter() - llm_started) * 1000
+    tokens = analytics.token_counts(llm_usage, messages, "".join(parts)) if parts else None
+    await finish_exchange(request, user_message, response_text, outcome, llm_latency_ms, tokens,
+                          choice.model_name if choice else None)
+    yield "done", {"response": response_text, "actions": parser.markers}
+
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest, http_request: Request, token: str = Depends(optional_oauth2_scheme)):
+    """
+    Server-sent events version of /chat. Navigation/action markers are parsed while
+    the model generates and sent as `action` events as soon as they are complete,
+    ahead of the remaining `token` events; `done` carries the full response.
+    Uses the same deadline as /chat; the stream is cancelled on client disconnect.
+    """
+    limit_key = chat_identity(request, http_request, token)
+    deadline = Deadline.from_header(http_request.headers.get(DEADLINE_HEADER))
+    user_message = request.message.strip()
+    if not user_message:
+        raise HTTPException(status_code=400, detail="Message is empty")
+    await enforce_rate_limit(request.user_id, request.role, limit_key=limit_key)
+
+    print("\n[?] New Streaming Chat Request")
+    print(f"   User: {request.user_id}")
+    print(f"   Role: {request.role}")
+
+    async def events():
+        async for event, data in chat_events(request, user_message, deadline):
+            yield sse_event(event, data)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# --- BACKGROUND JOBS ---
+async def run_generation_job(job):
+    """Streams a job's answer: the /chat prompt and history on the large tier, with the job's output budget."""
+    request = ChatRequest(user_id=job["user_id"], message=job["message"], role=job["role"],
+                          user_name=job.get("user_name"), context=job.get("context") or {})
+    messages = await build_chat_messages(request, request.message)
+    choice = tiering.background(job_queue.JOB_MAX_TOKENS)
+    deadline = Deadline(job_queue.JOB_TIMEOUT_SECONDS)
+    parts = []
+    llm_usage = {}
+    llm_started = time.perf_counter()
+    async for text in stream_llm(messages, choice, deadline, chunk_timeout=60, usage=llm_usage):
+        parts.append(text)
+        yield text
+    response_text = "".join(parts).strip() or EMPTY_RESPONSE_TEXT
+    await finish_exchange(request, request.message, response_text, "ok", (time.perf_counter() - llm_started) * 1000,
+                          analytics.token_counts(llm_usage, messages, response_text), choice.model_name,
+                          job_id=job["_id"])
+
+
+jobs = job_queue.JobQueue(db.jobs, run_generation_job)
+
+
+def job_view(job: dict) -> dict:
+    """Public fields of a job document."""
+    view = {k: job.get(k) for k in ("status", "kind", "user_id", "role", "priority", "attempts",
+                                    "created_at", "started_at", "finished_at", "progress", "timings")}
+    view["job_id"] = job["_id"]
+    if job.get("status") == job_queue.DONE:
+        view["result"] = job.get("result")
+        view["actions"] = extract_markers(job.get("result") or "")
+    elif job.get("error"):
+        view["error"] = job["error"]
+        view["partial_result"] = job.get("partial_result")
+    return view
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job(request: ChatRequest, current_user: dict = Depends(get_current_user)):
+    """
+    Queues a long generation (exam papers, lesson material) and returns its job_id at
+    once. Poll GET /jobs/{job_id} or stream GET /jobs/{job_id}/stream for the result.
+    The job belongs to the token's user and runs with the token's role.
+    """
+    user_id = current_user.get("user_id") or current_user["username"]
+    role = current_user["role"]
+    user_message = request.message.strip()
+    if not user_message:
+        raise HTTPException(status_code=400, detail="Message is empty")
+    await enforce_rate_limit(user_id, role)
+    try:
+        job = await jobs.submit(user_id, role, user_message, request.user_name, request.context)
+    except job_queue.QueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "30"})
+    print(f"[OK] Job {job['_id']} queued for {user_id} ({role}, priority {job['priority']})")
+    return job_view(job)
+
+
+async def find_job(job_id: str, current_user: dict) -> dict:
+    """The job if it belongs to the token's user (admins see every job), else 404."""
+    job = await jobs.get(job_id)
+    owner = current_user.get("user_id") or current_user["username"]
+    if job is None or (current_user.get("role") != "admin" and job.get("user_id") != owner):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Status, progress and timings of a job, with the result once done."""
+    return job_view(await find_job(job_id, current_user))
+
+
+@app.get("/jobs/{job_id}/stream")
+async def stream_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Server-sent events: `progress` text chunks (or `status` updates), then `done` or `error`."""
+    await find_job(job_id, current_user)
+
+    async def events():
+        async for event, data in jobs.events(job_id):
+            yield sse_event(event, data)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Cancels a queued or running job."""
+    await find_job(job_id, current_user)
+    job = await jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=409, detail="Job already finished")
+    return job_view(job)
+
+
+@app.get("/admin/jobs")
+async def get_job_stats(current_user: dict = Depends(get_current_admin_user)):
+    """Job queue depth, outcomes and queue/run time percentiles for this worker."""
+    stats = jobs.stats()
+    try:
+        counts = await db.jobs.aggregate([{"$group": {"_id": "$status", "n": {"$sum": 1}}}]).to_list(length=None)
+        stats["by_status"] = {c["_id"]: c["n"] for c in counts}
+    except Exception as e:
+        stats["by_status"] = f"unavailable: {e}"
+    return stats
+
+
+# --- WEBSOCKET CHAT ---
+async def ws_chat_exchange(connection, conversation, frame):
+    """Runs one chat message of a /ws/chat conversation, streaming its events."""
+    user = connection.user
+    user_id = user.get("user_id") or user["username"]
+    user_message = frame["message"].strip()
+    request = ChatRequest(
+        user_id=user_id,
+        message=user_message,
+        role=user["role"],
+        user_name=frame.get("user_name") or user["username"],
+        context=connection.context,
+    )
+    retry_after = (await token_budget_retry_after(user_id, user["role"])
+                   or await rate_limit_retry_after(user_id, user["role"]))
+    if retry_after:
+        await connection.send_event(conversation, "error", {"message": "Too many requests.", "retry_after": retry_after})
+        return
+    if conversation.turns is None:
+        # New conversations continue from the user's recent history
+        await load_history_messages(user_id)
+        conversation.turns = chat_history_cache.get(user_id, ())
+
+    deadline = Deadline.from_header(frame.get("deadline_ms"))
+    async for event, data in chat_events(request, user_message, deadline, history=conversation.turns):
+        await connection.send_event(conversation, event, data)
+        if event == "done":
+            conversation.turns = history_store.append_exchange(conversation.turns, user_message, data["response"])
+
+
+@app.websocket("/ws/chat")
+async def ws_chat(websocket: WebSocket):
+    """
+    Persistent chat channel: authenticates once with the access token, then streams
+    several concurrent conversations over one socket (protocol in ws_channel.py).
+    The role comes from the token, not from the client.
+    """
+    await websocket.accept()
+    user = await ws_channel.authenticate(websocket, decode_access_token)
+    if user is None:
+        return
+    print(f"[WS] Connected: {user['username']} ({user['role']})")
+    await ws_channel.ChatConnection(websocket, user).serve(ws_chat_exchange)
+    print(f"[WS] Disconnected: {user['username']}")
+
+
+# --- BATCH CHAT ---
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "16"))
+BATCH_ROLES = ("faculty", "admin")
+batch_saves = set()  # in-flight background saves of batch answers
+
+
+async def save_batch_chats(chat_docs):
+    try:
+        await batch_chat_collection.insert_many(chat_docs, ordered=False)
+        print(f"   [Save] {len(chat_docs)} batch chats saved to database")
+    except Exception as db_error:
+        print(f"   [!] Batch database save failed: {db_error}")
+
+
+def batch_knowledge_query(messages, max_keywords=20):
+    """Most frequent keywords across a batch, used for one shared knowledge lookup."""
+    words = Counter()
+    for m in messages:
+        words.update(w for w in m.lower().split() if len(w) > 3 and w.isalnum())
+    return " ".join(w for w, _ in words.most_common(max_keywords))
+
+
+async def generate_batch(inputs, max_concurrency):
+    """
+    Yields (index, AI message or exception) as generations complete; the message
+    carries the provider's token usage.
+    Uses the provider's abatch_as_completed when available, else bounded ainvoke calls.
+    """
+    if hasattr(llm, "abatch_as_completed"):
+        async for index, output in llm.abatch_as_completed(
+            inputs, config={"max_concurrency": max_concurrency}, return_exceptions=True
+        ):
+            yield index, output
+        return
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_one(index, messages):
+        async with semaphore:
+            try:
+                return index, await llm.ainvoke(messages)
+            except Exception as e:
+                return index, e
+
+    for task in asyncio.as_completed([run_one(i, m) for i, m in enumerate(inputs)]):
+        yield await task
+
+
+@app.post("/chat/batch")
+async def chat_batch(request: BatchChatRequest, current_user: dict = Depends(get_current_user)):
+    """
+    Answers many messages in a single call (e.g. section feedback, FAQ lists); faculty and
+    admins only, answered for the caller's role. The system prompt and knowledge lookup are
+    built once and shared; items are stateless: no per-user history is read, and answers
+    go to `batch_chats` under the caller (item user_id kept as `for_user`), never into a
+    student's history. The batch takes one rate limit token per item in a single charge
+    and its tokens count against the caller's daily budget. Results stream back as NDJSON
+    lines in completion order; answers are saved in the background once the stream ends,
+    including when the client disconnects part way.
+    """
+    role = current_user["role"]
+    if role not in BATCH_ROLES:
+        raise HTTPException(status_code=403, detail="Batch chat is available to faculty and admins only")
+    caller_id = current_user.get("user_id") or current_user["username"]
+    items = [i for i in request.items if i.message.strip()]
+    if not items:
+        raise HTTPException(status_code=400, detail="No messages to process")
+    max_items = BATCH_MAX_ITEMS
+    if RATE_LIMIT_ENABLED:
+        max_items = min(max_items, int(rate_limiter.capacity(role)))
+    if len(items) > max_items:
+        raise HTTPException(status_code=413, detail=f"Batch too large (max {max_items} items)")
+    max_concurrency = max(1, min(request.max_concurrency, BATCH_MAX_CONCURRENCY))
+    await enforce_rate_limit(caller_id, role, cost=len(items))
+
+    print(f"\n[?] New Batch Chat Request: {len(items)} items, role {role}, concurrency {max_concurrency}")
+
+    shared_query = batch_knowledge_query([i.message for i in items])
+    system_message = await build_system_message(role, request.user_name, request.context, shared_query)
+    inputs = [[system_message, HumanMessage(content=i.message.strip())] for i in items]
+
+    async def stream_results():
+        chat_docs = []
+        try:
+            async for index, output in generate_batch(inputs, max_concurrency):
+                item = items[index]
+                if isinstance(output, Exception):
+                    print(f"   [X] Batch item {index} failed: {str(output)[:100]}")
+                    usage.record(role, caller_id, 0, outcome="error", source="batch")
+                    yield json.dumps({"index": index, "user_id": item.user_id, "error": str(output)}) + "\n"
+                    continue
+
+                response_text = (output.content or "").strip() or \
+                    "I'm here but having trouble forming a response. Please try again! [!]"
+                prompt_tokens, completion_tokens, estimated = analytics.token_counts(output, inputs[index], response_text)
+                usage.record(role, caller_id, len(response_text), source="batch", prompt_tokens=prompt_tokens,
+                             completion_tokens=completion_tokens, model=MODEL_NAME, tokens_estimated=estimated)
+                token_budgets.spend(caller_id, prompt_tokens + completion_tokens)
+                chat_docs.append({
+                    "user_id": caller_id,
+                    "for_user": item.user_id,
+                    "role": role,
+                    "message": item.message.strip(),
+                    "response": response_text,
+                    "timestamp": datetime.datetime.now(datetime.timezone.utc),
+                    "batch": True,
+                })
+                yield json.dumps({"index": index, "user_id": item.user_id, "response": response_text}) + "\n"
+        finally:
+            # a task, so answers already paid for are kept even if this stream was cancelled
+            if chat_docs:
+                task = asyncio.create_task(save_batch_chats(chat_docs))
+                batch_saves.add(task)
+                task.add_done_callback(batch_saves.discard)
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
 @app.get("/history/{user_id}")
-async def get_history(user_id: str):
-    """Retrieve chat history for a user."""
+async def get_history(user_id: str, http_request: Request, limit: int = 100, before: str = None):
+    """
+    Retrieve a user's chat history: the newest `limit` exchanges before `before`
+    (ISO timestamp; default now), oldest first. Pages reach into the compressed
+    archive once the hot collection runs out; pass `next_before` to get older pages.
+    """
+    limit = max(1, min(limit, 500))
     try:
-        cursor = chat_collection.find({"user_id": user_id}).sort("timestamp", 1)
-        history = await cursor.to_list(length=100)
+        before_ts = datetime.datetime.fromisoformat(before) if before else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="before must be an ISO timestamp")
+    if before_ts is not None and before_ts.tzinfo is None:
+        before_ts = before_ts.replace(tzinfo=timezone.utc)
+
+    try:
+        if CHAT_STORAGE == "buckets":
+            history = await chat_buckets.exchanges_before(chat_bucket_collection, user_id, before_ts, limit)
+        else:
+            query = {"user_id": user_id}
+            if before_ts is not None:
+                query["timestamp"] = {"$lt": before_ts}
+            history = await chat_collection.find(query).sort("timestamp", -1).to_list(length=limit)
+            history.reverse()
+
+        archived = []
+        archive_error = False
+        if len(history) < limit:
+            oldest = history[0].get("timestamp") if history else before_ts
+            if oldest is not None and oldest.tzinfo is None:
+                oldest = oldest.replace(tzinfo=timezone.utc)
+            try:
+                archived = await chat_archive.read_archived(
+                    archive_collection, user_id, before=oldest, limit=limit - len(history),
+                    skip_keys=[chat_archive.row_key(h) for h in history],
+                )
+            except Exception as e:
+                # keep serving the hot page; the archive error is logged, not hidden
+                print(f"[X] Archive read failed for {user_id}: {e}")
+                archive_error = True
+            history = archived + history
 
         clean_history = []
         for h in history:
             clean_history.append({"role": "user", "content": h.get("message", "")})
             clean_history.append({"role": "ai", "content": h.get("response", "")})
 
-        return {
+        next_before = None
+        if len(history) == limit and history[0].get("timestamp"):
+            next_before = history[0]["timestamp"].isoformat()
+        return await json_response(http_request, {
             "user_id": user_id,
             "message_count": len(clean_history) // 2,
+            "archived_count": len(archived),
+            "archive_unavailable": archive_error,
+            "next_before": next_before,
             "history": clean_history,
-        }
+        })
     except Exception as e:
         print(f"Error retrieving history: {e}")
-        return {"user_id": user_id, "message_count": 0, "history": []}
+        return await json_response(http_request, {"user_id": user_id, "message_count": 0, "history": []})
 
 
 @app.post("/auth/register", response_model=Token)
@@ -802,27 +1818,28 @@ async def login(user_data: UserLogin):
 
 
 @app.get("/admin/data")
-async def get_admin_data(current_user: dict = Depends(get_current_admin_user)):
-    """Admin endpoint to retrieve all users and chats."""
+async def get_admin_data(http_request: Request, current_user: dict = Depends(get_current_admin_user)):
+    """
+    Admin endpoint to retrieve all users and chats. The documents are serialized
+    directly with orjson (ObjectIds and dates included) and compressed when accepted.
+    """
     try:
         users = await users_collection.find().to_list(length=100)
-        chats = (
-            await chat_collection.find()
-            .sort("timestamp", -1)
-            .to_list(length=500)
-        )
-
-        def serialize(doc):
-            if "_id" in doc:
-                doc["_id"] = str(doc["_id"])
-            return doc
+        if CHAT_STORAGE == "buckets":
+            chats = await chat_buckets.latest_exchanges(chat_bucket_collection, limit=500)
+        else:
+            chats = (
+                await chat_collection.find()
+                .sort("timestamp", -1)
+                .to_list(length=500)
+            )
 
-        return {
+        return await json_response(http_request, {
             "total_users": len(users),
             "total_chats": len(chats),
-            "users": [serialize(u) for u in users],
-            "chats": [serialize(c) for c in chats],
-        }
+            "users": users,
+            "chats": chats,
+        })
 
     except Exception as e:
         raise HTTPException(
@@ -830,6 +1847,120 @@ async def get_admin_data(current_user: dict = Depends(get_current_admin_user)):
         )
 
 
+@app.get("/admin/analytics")
+async def get_analytics(days: int = 7, current_user: dict = Depends(get_current_admin_user)):
+    """Usage per day, per role and top users, answered from the usage rollups (never from chats)."""
+    days = max(1, min(days, 90))
+    try:
+        await usage.flush(usage_collection)
+        return await analytics.usage_report(usage_collection, days=days)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to load analytics: {str(e)}")
+
+
+@app.get("/admin/tokens")
+async def get_token_usage(days: int = 7, current_user: dict = Depends(get_current_admin_user)):
+    """Prompt/completion tokens per role and model (with TOKEN_PRICES cost), top users and budget state."""
+    days = max(1, min(days, 90))
+    try:
+        await usage.flush(usage_collection)
+        report = await analytics.token_report(usage_collection, days=days)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to load token usage: {str(e)}")
+    report["budgets"] = token_budgets.stats()
+    report["budget_downgrades"] = tiering.budget_downgrades
+    return report
+
+
+@app.get("/admin/faq/stats")
+async def get_faq_stats(current_user: dict = Depends(get_current_admin_user)):
+    """FAQ store size and hit rate for this worker."""
+    return faq_store.stats()
+
+
+@app.get("/admin/prompt-cache")
+async def get_prompt_cache_stats(current_user: dict = Depends(get_current_admin_user)):
+    """Provider prefix-cache usage for this worker (where the provider reports it)."""
+    return {"provider": LLM_PROVIDER, "model": MODEL_NAME, **prompt_cache_stats.snapshot()}
+
+
+@app.get("/admin/tiers")
+async def get_tier_stats(current_user: dict = Depends(get_current_admin_user)):
+    """Model tier distribution, surge downgrades and per-tier latency for this worker."""
+    return tiering.stats()
+
+
+@app.get("/admin/rate-limits")
+async def get_rate_limit_stats(current_user: dict = Depends(get_current_admin_user)):
+    """Rate limiter configuration, bucket count and allowed/denied requests per role."""
+    return rate_limiter.stats()
+
+
+@app.get("/admin/idempotency")
+async def get_idempotency_stats(current_user: dict = Depends(get_current_admin_user)):
+    """Idempotency keys held by this worker and how many retries were attached or replayed."""
+    return idempotency_store.stats()
+
+
+@app.get("/admin/ws")
+async def get_ws_stats(current_user: dict = Depends(get_current_admin_user)):
+    """Open /ws/chat connections and in-flight conversations on this worker."""
+    return ws_channel.stats()
+
+
+@app.get("/admin/profile")
+async def get_profile(seconds: float = 10, format: str = "collapsed",
+                      current_user: dict = Depends(get_current_admin_user)):
+    """
+    Samples this worker's event loop for `seconds` (max PROFILE_MAX_SECONDS).
+    format=collapsed returns flamegraph collapsed stacks, speedscope a speedscope file,
+    summary the loop lag, per-coroutine wall time and hottest functions.
+    """
+    if format not in ("collapsed", "speedscope", "summary"):
+        raise HTTPException(status_code=400, detail="format must be collapsed, speedscope or summary")
+    try:
+        stacks, summary = await profiler.profile(seconds)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    print(f"[OK] Profiled worker for {summary['seconds']}s: {summary['samples']} samples, "
+          f"loop lag p99 {summary['loop_lag_ms']['p99']} ms")
+    if format == "summary":
+        return summary
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d-%H%M%S")
+    if format == "speedscope":
+        return Response(
+            content=json.dumps(profiler.speedscope(stacks, f"worker {os.getpid()}")),
+            media_type="application/json",
+            headers={"Content-Disposition": f'attachment; filename="profile-{stamp}.speedscope.json"'},
+        )
+    return Response(
+        content=profiler.collapsed(stacks),
+        media_type="text/plain",
+        headers={"Content-Disposition": f'attachment; filename="profile-{stamp}.collapsed.txt"'},
+    )
+
+
+@app.get("/admin/profile/requests")
+async def get_request_profiles(format: str = "summary", current_user: dict = Depends(get_current_admin_user)):
+    """
+    The last sampled /chat request profiles (PROFILE_REQUEST_RATE). format=collapsed
+    merges their stacks into one collapsed file; summary lists each request.
+    """
+    requests = list(profiler.recent_requests)
+    if format == "collapsed":
+        merged = Counter()
+        for r in requests:
+            merged.update(r["stacks"])
+        return Response(content=profiler.collapsed(merged), media_type="text/plain")
+    return {
+        **profiler.stats(),
+        "requests": [
+            {**{k: v for k, v in r.items() if k != "stacks"}, "top_functions": profiler.top_functions(r["stacks"], 5)}
+            for r in reversed(requests)
+        ],
+    }
+
+
 @app.get("/health")
 async def health_check():
     """Detailed health check for monitoring."""
@@ -851,9 +1982,8 @@ async def health_check():
 
     # LLM provider status (best-effort)
     try:
-        llm_cls_name = getattr(getattr(llm, "__class__", None), "__name__", "")
-        if llm is None or "FallbackLLM" in llm_cls_name:
-             health_status["components"]["llm"] = f"fallback (Provider: {LLM_PROVIDER})"
+        if llm is None or llm is offline_llm:
+             health_status["components"]["llm"] = f"offline fallback (provider: {LLM_PROVIDER})"
              health_status["status"] = "degraded"
         else:
              health_status["components"]["llm"] = f"healthy (provider: {LLM_PROVIDER}, model: {MODEL_NAME})"
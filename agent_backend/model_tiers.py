@@ -0,0 +1,189 @@
+"""
+Load-adaptive model tiering.
+
+Each chat message is classified into a coarse intent (greeting, short, default,
+explain). The intent and role decide max_tokens, and together with the current number
+of in-flight LLM calls (the queue depth) decide whether the small, fast model or the
+large one answers. During surges everything except heavy explanations moves to the
+small tier, and past a higher threshold those too, so p95 stays flat.
+
+Configure with LLM_SMALL_MODEL (same provider as the main model), TIER_SURGE_DEPTH and
+TIER_HEAVY_SURGE_DEPTH. Without a small model only the max_tokens policy applies.
+"""
+import os
+import re
+import time
+import collections
+from contextlib import asynccontextmanager
+
+TIER_SURGE_DEPTH = int(os.getenv("TIER_SURGE_DEPTH", "16"))
+TIER_HEAVY_SURGE_DEPTH = int(os.getenv("TIER_HEAVY_SURGE_DEPTH", "48"))
+
+SMALL = "small"
+LARGE = "large"
+
+_GREETING_RE = re.compile(r"^(hi|hii+|hello|hey|yo|thanks|thank you|thx|ok|okay|good (morning|evening|night)|bye)\b")
+_HEAVY_RE = re.compile(
+    r"\b(explain|code|program|implement|write|derive|proof|prove|compare|difference|algorithm|"
+    r"step by step|example|examples|debug|error|exam paper|question paper|syllabus|essay|analy[sz]e)\b"
+)
+
+# max_tokens per intent, with role overrides
+MAX_TOKENS = {
+    "greeting": 128,
+    "short": 384,
+    "default": 768,
+    "explain": 1536,
+}
+ROLE_MAX_TOKENS = {
+    ("faculty", "explain"): 2048,  # exam papers and lesson material run long
+    ("admin", "explain"): 1024,
+}
+
+# Field names for the output cap and model id on each LangChain integration
+_MAX_TOKENS_FIELD = {"google": "max_output_tokens", "ollama": "num_predict"}
+_MODEL_FIELD = {"openai": "model_name", "sambanova": "model_name", "groq": "model_name"}
+_PROVIDER_FAMILY = {
+    "openai": "openai", "gpt": "openai", "gpt-4": "openai", "gpt-3.5-turbo": "openai", "gpt-4o": "openai",
+    "sambanova": "sambanova", "samba": "sambanova",
+    "google": "google", "gemini": "google", "google_gen": "google", "gemini-pro": "google",
+    "anthropic": "anthropic", "claude": "anthropic",
+    "groq": "groq",
+    "ollama": "ollama", "local": "ollama", "llama": "ollama", "llama3": "ollama",
+}
+
+
+def classify_intent(message):
+    text = (message or "").lower().strip()
+    words = len(text.split())
+    if words <= 4 and _GREETING_RE.match(text):
+        return "greeting"
+    if _HEAVY_RE.search(text) or words > 40:
+        return "explain"
+    if words <= 12:
+        return "short"
+    return "default"
+
+
+def derive_chat_model(base, provider, model_name=None, max_tokens=None):
+    """
+    Copy of a LangChain chat model with a different model id and/or output cap.
+    Clients are shared with the base instance. Non-LangChain models (fallback,
+    fake) are returned unchanged.
+    """
+    copy = getattr(base, "model_copy", None)
+    if copy is None:
+        return base
+    family = _PROVIDER_FAMILY.get(provider, provider)
+    update = {}
+    if model_name:
+        update[_MODEL_FIELD.get(family, "model")] = model_name
+    if max_tokens:
+        update[_MAX_TOKENS_FIELD.get(family, "max_tokens")] = max_tokens
+    return copy(update=update) if update else base
+
+
+class TierChoice:
+    __slots__ = ("tier", "intent", "max_tokens", "model", "model_name", "surge")
+
+    def __init__(self, tier, intent, max_tokens, model, model_name, surge):
+        self.tier = tier
+        self.intent = intent
+        self.max_tokens = max_tokens
+        self.model = model
+        self.model_name = model_name
+        self.surge = surge
+
+
+class TieringPolicy:
+    def __init__(self, large_llm, provider, large_model_name, small_model_name=None):
+        self.large_llm = large_llm
+        self.provider = provider
+        self.model_names = {LARGE: large_model_name, SMALL: small_model_name or large_model_name}
+        self.has_small_tier = bool(small_model_name) and hasattr(large_llm, "model_copy")
+        self._models = {}
+        self.in_flight = 0
+        self.counts = collections.Counter()
+        self.intents = collections.Counter()
+        self.surge_downgrades = 0
+        self.budget_downgrades = 0
+        self.latencies = {SMALL: collections.deque(maxlen=500), LARGE: collections.deque(maxlen=500)}
+        self.failures = collections.Counter()
+
+    def _model(self, tier, max_tokens):
+        key = (tier, max_tokens)
+        if key not in self._models:
+            model_name = self.model_names[tier] if tier == SMALL else None
+            self._models[key] = derive_chat_model(self.large_llm, self.provider, model_name, max_tokens)
+        return self._models[key]
+
+    def select(self, role, message, downgrade=False):
+        """Tier and output cap for a message; `downgrade` (user over its token budget) forces the cheap tier."""
+        role = (role or "").lower()
+        intent = classify_intent(message)
+        max_tokens = ROLE_MAX_TOKENS.get((role, intent), MAX_TOKENS[intent])
+        if downgrade:
+            max_tokens = min(max_tokens, MAX_TOKENS["default"])
+            self.budget_downgrades += 1
+
+        tier = SMALL if intent in ("greeting", "short") or downgrade else LARGE
+        surge = False
+        if tier == LARGE:
+            limit = TIER_HEAVY_SURGE_DEPTH if intent == "explain" else TIER_SURGE_DEPTH
+            if self.in_flight >= limit:
+                tier, surge = SMALL, True
+        if not self.has_small_tier:
+            tier, surge = LARGE, False
+
+        self.intents[intent] += 1
+        if surge:
+            self.surge_downgrades += 1
+        return TierChoice(tier, intent, max_tokens, self._model(tier, max_tokens), self.model_names[tier], surge)
+
+    def background(self, max_tokens):
+        """Large-tier choice for background jobs; never surge-downgraded, as no request waits on it."""
+        self.intents["job"] += 1
+        return TierChoice(LARGE, "job", max_tokens, self._model(LARGE, max_tokens), self.model_names[LARGE], False)
+
+    @asynccontextmanager
+    async def track(self, choice):
+        """Counts an LLM call toward the queue depth and records its latency."""
+        self.in_flight += 1
+        self.counts[choice.tier] += 1
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.failures[choice.tier] += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self.latencies[choice.tier].append(time.perf_counter() - start)
+
+    def stats(self):
+        def pct(values, p):
+            if not values:
+                return None
+            ordered = sorted(values)
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 1)
+
+        total = sum(self.counts.values())
+        return {
+            "small_tier_enabled": self.has_small_tier,
+            "models": self.model_names,
+            "in_flight": self.in_flight,
+            "surge_thresholds": {"default": TIER_SURGE_DEPTH, "explain": TIER_HEAVY_SURGE_DEPTH},
+            "surge_downgrades": self.surge_downgrades,
+            "budget_downgrades": self.budget_downgrades,
+            "intents": dict(self.intents),
+            "tiers": {
+                tier: {
+                    "calls": self.counts[tier],
+                    "share": round(self.counts[tier] / total, 4) if total else 0.0,
+                    "failures": self.failures[tier],
+                    "latency_ms_p50": pct(self.latencies[tier], 0.50),
+                    "latency_ms_p95": pct(self.latencies[tier], 0.95),
+                }
+                for tier in (SMALL, LARGE)
+            },
+        }
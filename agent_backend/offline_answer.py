@@ -0,0 +1,165 @@
+"""
+Offline extractive answer engine.
+
+Splits the role knowledge collections and knowledge/*.txt into sentences, indexes them
+with BM25, and answers a question by returning the best-matching sentences for the
+caller's role. Pure Python, CPU-only, a few milliseconds per answer.
+
+OfflineLLM wraps the engine behind the ainvoke/astream interface, so it stands in
+for the chat model when no provider is configured and answers in its place when the
+provider fails at request time.
+"""
+import re
+import math
+import asyncio
+import collections
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from knowledge_snapshot import ROLE_COLLECTIONS, load_text_files, tokenize
+
+GENERAL = "general"
+OFFLINE_NOTICE = "_(Offline mode: answering from the knowledge base.)_"
+NO_MATCH_TEXT = {
+    "student": "I couldn't find that in my study notes yet. Try asking about a specific subject or topic!",
+    "faculty": "I couldn't find that in the faculty knowledge base. Try naming the tool or task you need.",
+    "admin": "No matching entry in the admin knowledge base. Try naming the module (fees, students, system).",
+}
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+|\n+")
+_STOPWORDS = frozenset(
+    "the is are was were be been an and or of to in on for with at by from as it its this that these those "
+    "what which who whom how why when where do does did can could should would will shall may might me my "
+    "you your we our they them their he she his her about into than then there here please tell explain give".split()
+)
+_K1 = 1.5
+_B = 0.75
+
+
+def _stem(term):
+    """Folds simple plurals so "stacks" matches "stack"."""
+    if len(term) > 3 and term.endswith("s") and not term.endswith("ss"):
+        return term[:-1]
+    return term
+
+
+def _terms(text):
+    return [_stem(t) for t in tokenize(text) if t not in _STOPWORDS]
+
+
+def _text(content):
+    """Plain text of a message content (string or content blocks)."""
+    if isinstance(content, list):
+        return "".join(b.get("text", "") if isinstance(b, dict) else str(b) for b in content)
+    return str(content or "")
+
+
+class OfflineAnswerEngine:
+    def __init__(self, max_sentences=3, min_score=1.0):
+        self.max_sentences = max_sentences
+        self.min_score = min_score
+        self._text_docs = [(GENERAL, d) for d in load_text_files()]
+        self._build(self._text_docs)
+
+    def _build(self, sources):
+        sentences = []  # (role, text, label)
+        for role, d in sources:
+            label = d.get("topic") or d.get("subject") or d.get("module")
+            heading = " ".join(str(p) for p in (d.get("subject"), d.get("module"), d.get("topic")) if p)
+            for sentence in _SENTENCE_RE.split(str(d.get("content") or "")):
+                sentence = sentence.strip(" -*\t")
+                if len(sentence) >= 8:
+                    sentences.append((role, sentence, label, heading))
+
+        postings = collections.defaultdict(list)
+        lengths = []
+        for sid, (_, sentence, _, heading) in enumerate(sentences):
+            terms = _terms(sentence) + _terms(heading)
+            lengths.append(len(terms) or 1)
+            for term, tf in collections.Counter(terms).items():
+                postings[term].append((sid, tf))
+
+        n = len(sentences) or 1
+        self._sentences = [(role, sentence, label) for role, sentence, label, _ in sentences]
+        self._postings = dict(postings)
+        self._idf = {t: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for t, p in postings.items()}
+        self._lengths = lengths
+        self._avg_length = (sum(lengths) / len(lengths)) if lengths else 1.0
+
+    async def refresh(self, db):
+        """Rebuilds the index from the knowledge collections plus knowledge/*.txt. Returns the sentence count."""
+        sources = list(self._text_docs)
+        for role, name in ROLE_COLLECTIONS.items():
+            docs = await getattr(db, name).find({}, {"_id": 0}).to_list(length=None)
+            sources.extend((role, d) for d in docs)
+        await asyncio.to_thread(self._build, sources)
+        return len(self._sentences)
+
+    def search(self, role, query, limit=None):
+        """Best (score, sentence, label) matches for `query` among the role's and general sentences."""
+        role = (role or "").lower()
+        scores = collections.defaultdict(float)
+        for term in set(_terms(query)):
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for sid, tf in self._postings[term]:
+                if self._sentences[sid][0] not in (role, GENERAL):
+                    continue
+                norm = _K1 * (1 - _B + _B * self._lengths[sid] / self._avg_length)
+                scores[sid] += idf * tf * (_K1 + 1) / (tf + norm)
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        results = []
+        seen = set()
+        for sid, score in ranked:
+            if score < self.min_score or len(results) >= (limit or self.max_sentences):
+                break
+            _, sentence, label = self._sentences[sid]
+            if sentence in seen:
+                continue
+            seen.add(sentence)
+            results.append((round(score, 3), sentence, label))
+        return results
+
+    def answer(self, role, query):
+        matches = self.search(role, query)
+        if not matches:
+            return NO_MATCH_TEXT.get((role or "").lower(), "I couldn't find anything about that in the knowledge base.")
+        lines = [f"- {sentence}" + (f" _({label})_" if label else "") for _, sentence, label in matches]
+        return "Here's what I found:\n\n" + "\n".join(lines)
+
+    def stats(self):
+        by_role = collections.Counter(role for role, _, _ in self._sentences)
+        return {"sentences": len(self._sentences), "terms": len(self._postings), "by_role": dict(by_role)}
+
+
+class OfflineLLM:
+    """
+    Chat-model stand-in backed by OfflineAnswerEngine. `role_of(system_text)` maps
+    the system prompt to a role; the last human message is the query.
+    """
+
+    def __init__(self, engine, role_of=None, notice=OFFLINE_NOTICE):
+        self.engine = engine
+        self.role_of = role_of
+        self.notice = notice
+
+    def respond(self, messages):
+        if isinstance(messages, str):
+            messages = [HumanMessage(content=messages)]
+        role = None
+        query = ""
+        for msg in messages:
+            if isinstance(msg, SystemMessage) and self.role_of:
+                role = self.role_of(_text(msg.content))
+            elif isinstance(msg, HumanMessage):
+                query = _text(msg.content)
+        text = self.engine.answer(role, query)
+        return f"{self.notice}\n\n{text}" if self.notice else text
+
+    async def ainvoke(self, messages, **kwargs):
+        return AIMessage(content=self.respond(messages))
+
+    async def astream(self, messages, **kwargs):
+        yield AIMessage(content=self.respond(messages))
@@ -0,0 +1,268 @@
+"""
+On-demand sampling profiler for a live worker.
+
+A sampler thread reads the event loop thread's stack (sys._current_frames) every
+interval while at least one profile is active, and nothing runs otherwise. Two
+kinds of profile share it:
+
+- Session profiles (/admin/profile): every sample of the loop thread for a fixed
+  number of seconds, plus event loop lag (how late a periodic sleep wakes up) and
+  the wall time each coroutine was alive during the window.
+- Request profiles: with PROFILE_REQUEST_RATE > 0, that fraction of /chat calls
+  keeps only the samples taken while its own coroutine was on the stack, so the
+  result is that request's on-CPU time; wall time is measured separately. The last
+  PROFILE_KEEP_REQUESTS are kept for /admin/profile/requests.
+
+Stacks come out as collapsed text (flamegraph.pl, speedscope, inferno) or a
+speedscope JSON file. With PROFILE_REQUEST_RATE=0 (the default) the only cost on
+the request path is one comparison.
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import threading
+import collections
+
+PROFILE_REQUEST_RATE = float(os.getenv("PROFILE_REQUEST_RATE", "0"))  # fraction of /chat calls, 0 disables
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_KEEP_REQUESTS = int(os.getenv("PROFILE_KEEP_REQUESTS", "20"))
+MAX_STACK_DEPTH = 64
+
+
+def _label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _stack(frame, stop=None):
+    """Root-first function labels for `frame`; starts at `stop` when given (None if it isn't on the stack)."""
+    labels = []
+    found = stop is None
+    while frame is not None and len(labels) < MAX_STACK_DEPTH:
+        labels.append(_label(frame.f_code))
+        if frame is stop:
+            found = True
+            break
+        frame = frame.f_back
+    if not found:
+        return None
+    labels.reverse()
+    return tuple(labels)
+
+
+class _Sink:
+    __slots__ = ("target", "stacks", "samples")
+
+    def __init__(self, target=None):
+        self.target = target  # frame that must be on the stack, None for every sample
+        self.stacks = collections.Counter()  # stack -> microseconds
+        self.samples = 0
+
+    @property
+    def total_ms(self):
+        return round(sum(self.stacks.values()) / 1000, 1)
+
+
+class Sampler:
+    """Samples one thread's stack into the registered sinks; the thread runs only while sinks exist."""
+
+    def __init__(self, interval_ms=PROFILE_INTERVAL_MS):
+        self.interval = interval_ms / 1000.0
+        self._sinks = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._thread_id = None
+
+    def add(self, sink, thread_id):
+        with self._lock:
+            self._thread_id = thread_id
+            self._sinks.add(sink)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler-sampler", daemon=True)
+                self._thread.start()
+
+    def remove(self, sink):
+        with self._lock:
+            self._sinks.discard(sink)
+
+    def _run(self):
+        # Each sample is weighted by the time since the previous one: a loop holding the
+        # GIL delays the sampler, and counting samples alone would under-report it.
+        last = time.perf_counter()
+        while True:
+            with self._lock:
+                sinks = list(self._sinks)
+                if not sinks:
+                    self._thread = None
+                    return
+                thread_id = self._thread_id
+            frame = sys._current_frames().get(thread_id)
+            now = time.perf_counter()
+            weight = int((now - last) * 1_000_000)
+            last = now
+            if frame is not None:
+                whole = None
+                for sink in sinks:
+                    if sink.target is None:
+                        whole = whole or _stack(frame)
+                        stack = whole
+                    else:
+                        stack = _stack(frame, sink.target)
+                    if stack:
+                        sink.stacks[stack] += weight
+                        sink.samples += 1
+                del frame
+            time.sleep(self.interval)
+
+    @property
+    def active(self):
+        return len(self._sinks)
+
+
+sampler = Sampler()
+recent_requests = collections.deque(maxlen=PROFILE_KEEP_REQUESTS)
+_session_lock = asyncio.Lock()
+
+
+def collapsed(stacks):
+    """Brendan Gregg's collapsed format: "root;child;leaf weight" per line, weights in microseconds."""
+    return "\n".join(f"{';'.join(stack)} {count}" for stack, count in stacks.most_common()) + "\n"
+
+
+def speedscope(stacks, name):
+    """A speedscope "sampled" profile (https://www.speedscope.app/file-format-schema.json)."""
+    frames = []
+    index = {}
+    samples = []
+    weights = []
+    for stack, count in stacks.items():
+        ids = []
+        for label in stack:
+            if label not in index:
+                index[label] = len(frames)
+                frames.append({"name": label})
+            ids.append(index[label])
+        samples.append(ids)
+        weights.append(round(count / 1000, 3))
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": "milliseconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights,
+        }],
+        "name": name,
+        "exporter": "vu-ai-agent profiler",
+    }
+
+
+def top_functions(stacks, limit=20):
+    """Self and total milliseconds per function."""
+    own = collections.Counter()
+    total = collections.Counter()
+    for stack, count in stacks.items():
+        own[stack[-1]] += count
+        for label in set(stack):
+            total[label] += count
+    return [{"function": f, "self_ms": round(n / 1000, 1), "total_ms": round(total[f] / 1000, 1)}
+            for f, n in own.most_common(limit)]
+
+
+def _coroutine_name(task):
+    coro = task.get_coro()
+    return getattr(coro, "__qualname__", None) or type(coro).__name__
+
+
+async def profile(seconds):
+    """
+    Profiles the running event loop for `seconds`. Returns the stacks Counter plus a
+    summary with loop lag percentiles and per-coroutine wall time. Raises RuntimeError
+    if another session profile is running.
+    """
+    if _session_lock.locked():
+        raise RuntimeError("A profile is already running on this worker")
+    async with _session_lock:
+        seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+        interval = sampler.interval
+        sink = _Sink()
+        sampler.add(sink, threading.get_ident())
+        lags = []
+        alive = collections.Counter()  # coroutine -> ticks seen alive
+        tasks_seen = collections.defaultdict(set)
+        me = asyncio.current_task()
+        started = time.monotonic()
+        try:
+            while time.monotonic() - started < seconds:
+                before = time.monotonic()
+                await asyncio.sleep(interval)
+                lags.append(max(0.0, time.monotonic() - before - interval) * 1000)
+                for task in asyncio.all_tasks():
+                    if task is not me:
+                        name = _coroutine_name(task)
+                        alive[name] += 1
+                        tasks_seen[name].add(id(task))
+        finally:
+            sampler.remove(sink)
+        elapsed = time.monotonic() - started
+
+    lags.sort()
+    tick_ms = elapsed * 1000 / max(len(lags), 1)
+
+    def pct(p):
+        return round(lags[min(len(lags) - 1, int(len(lags) * p))], 2) if lags else None
+
+    summary = {
+        "seconds": round(elapsed, 3),
+        "interval_ms": round(interval * 1000, 3),
+        "samples": sink.samples,
+        "sampled_ms": sink.total_ms,
+        "loop_lag_ms": {"p50": pct(0.50), "p95": pct(0.95), "p99": pct(0.99),
+                        "max": round(lags[-1], 2) if lags else None, "ticks": len(lags)},
+        "coroutines": [
+            {"coroutine": name, "tasks": len(tasks_seen[name]), "wall_ms": round(ticks * tick_ms, 1)}
+            for name, ticks in alive.most_common(30)
+        ],
+        "top_functions": top_functions(sink.stacks),
+    }
+    return sink.stacks, summary
+
+
+def sample_request():
+    """True for the PROFILE_REQUEST_RATE fraction of requests that should be profiled."""
+    return PROFILE_REQUEST_RATE > 0 and random.random() < PROFILE_REQUEST_RATE
+
+
+async def run_profiled(coro, label):
+    """Awaits `coro` while sampling only the stacks it is on, then keeps the profile in recent_requests."""
+    sink = _Sink(coro.cr_frame)
+    sampler.add(sink, threading.get_ident())
+    started = time.monotonic()
+    try:
+        return await coro
+    finally:
+        sampler.remove(sink)
+        recent_requests.append({
+            "label": label,
+            "at": time.time(),
+            "wall_ms": round((time.monotonic() - started) * 1000, 1),
+            "on_cpu_ms": sink.total_ms,
+            "samples": sink.samples,
+            "stacks": sink.stacks,
+        })
+
+
+def stats():
+    return {
+        "request_rate": PROFILE_REQUEST_RATE,
+        "interval_ms": PROFILE_INTERVAL_MS,
+        "sampler_running": sampler.active > 0,
+        "session_running": _session_lock.locked(),
+        "recent_requests": len(recent_requests),
+    }
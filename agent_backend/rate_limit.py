@@ -0,0 +1,186 @@
+"""
+Token-bucket rate limiting for chat requests.
+
+Every request takes one token from the caller's user bucket and one from its role's
+bucket. Each role has its own capacity, so a burst of student traffic empties only
+the student bucket and faculty/admin requests keep their share. A denied request
+gets the time until a token is available, for Retry-After. The guarantee rests on
+the caller's role being real: main.py takes user and role from the bearer token when
+one is sent, and otherwise trusts the body (as sent by the Node backend) with the
+user bucket keyed on the client address too.
+
+State is in-process by default: an LRU of at most RATE_LIMIT_MAX_BUCKETS buckets,
+where buckets idle long enough to have refilled are dropped (a fresh bucket is
+identical). With RATE_LIMIT_BACKEND=mongo the buckets live in the `rate_limits`
+collection, updated atomically and expired by a TTL index, so all workers share them.
+
+Configure per-role limits as RATE_LIMIT_ROLES="student:5:30,faculty:2:15,admin:2:15"
+(role:tokens per second:burst) and per-user limits with RATE_LIMIT_USER_RATE and
+RATE_LIMIT_USER_BURST.
+"""
+import os
+import time
+import datetime
+import collections
+
+from pymongo import ReturnDocument
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()
+RATE_LIMIT_USER_RATE = float(os.getenv("RATE_LIMIT_USER_RATE", "0.5"))  # tokens per second
+RATE_LIMIT_USER_BURST = float(os.getenv("RATE_LIMIT_USER_BURST", "10"))
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "50000"))
+DEFAULT_ROLE_LIMITS = "student:5:30,faculty:2:15,admin:2:15,default:1:5"
+
+
+def parse_role_limits(spec):
+    """{role: (rate, burst)} from "role:rate:burst,..."."""
+    limits = {}
+    for item in (spec or "").split(","):
+        parts = item.strip().split(":")
+        if len(parts) == 3:
+            limits[parts[0].lower()] = (float(parts[1]), float(parts[2]))
+    limits.setdefault("default", (1.0, 5.0))
+    return limits
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter:
+    def __init__(self, role_limits=None, user_rate=RATE_LIMIT_USER_RATE, user_burst=RATE_LIMIT_USER_BURST,
+                 max_buckets=RATE_LIMIT_MAX_BUCKETS):
+        self.role_limits = role_limits or parse_role_limits(os.getenv("RATE_LIMIT_ROLES", DEFAULT_ROLE_LIMITS))
+        self.user_limit = (user_rate, user_burst)
+        self.max_buckets = max_buckets
+        self._buckets = collections.OrderedDict()  # key -> _Bucket, least recently used first
+        self.allowed = collections.Counter()
+        self.denied = collections.Counter()
+        self.evicted = 0
+
+    def _role_key(self, role):
+        role = (role or "").lower()
+        return role if role in self.role_limits else "default"
+
+    def _limits(self, key):
+        if key[0] == "role":
+            return self.role_limits[key[1]]
+        return self.user_limit
+
+    def _evict(self, now):
+        """Drops buckets that have fully refilled while idle, then the LRU overflow."""
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            rate, burst = self._limits(key)
+            if bucket.tokens + (now - bucket.updated) * rate < burst and len(self._buckets) <= self.max_buckets:
+                break
+            del self._buckets[key]
+            self.evicted += 1
+
+    def _bucket(self, key, now):
+        bucket = self._buckets.get(key)
+        rate, burst = self._limits(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket(burst, now)
+        else:
+            self._buckets.move_to_end(key)
+            bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+            bucket.updated = now
+        return bucket, rate
+
+    def capacity(self, role):
+        """Most tokens one request can ever take: the smaller of the user and role bursts."""
+        return min(self.role_limits[self._role_key(role)][1], self.user_limit[1])
+
+    async def check(self, user_id, role, cost=1):
+        return self.acquire(user_id, role, cost)
+
+    def acquire(self, user_id, role, cost=1):
+        """
+        Takes `cost` tokens from the user and role buckets.
+        Returns (allowed, retry_after_seconds); nothing is taken when denied.
+        """
+        now = time.monotonic()
+        role_key = self._role_key(role)
+        keys = [("role", role_key)]
+        if user_id:
+            keys.append(("user", str(user_id)))
+
+        self._evict(now)
+        buckets = [self._bucket(key, now) for key in keys]
+        wait = max((cost - b.tokens) / rate if rate > 0 else float("inf") for b, rate in buckets)
+        if wait > 0:
+            self.denied[role_key] += 1
+            return False, wait
+        for bucket, _ in buckets:
+            bucket.tokens -= cost
+        self.allowed[role_key] += 1
+        return True, 0.0
+
+    def stats(self):
+        return {
+            "backend": "memory",
+            "buckets": len(self._buckets),
+            "max_buckets": self.max_buckets,
+            "evicted": self.evicted,
+            "role_limits": {role: {"rate": r, "burst": b} for role, (r, b) in self.role_limits.items()},
+            "user_limit": {"rate": self.user_limit[0], "burst": self.user_limit[1]},
+            "allowed": dict(self.allowed),
+            "denied": dict(self.denied),
+        }
+
+
+class MongoRateLimiter(RateLimiter):
+    """Same policy with buckets in a shared collection (one atomic update per bucket)."""
+
+    def __init__(self, collection, **kwargs):
+        super().__init__(**kwargs)
+        self.collection = collection
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def _take(self, key, cost, now):
+        rate, burst = self._limits(key)
+        idle = datetime.timedelta(seconds=burst / rate if rate > 0 else 3600)
+        elapsed = {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated", now]}]}, 1000]}
+        doc = await self.collection.find_one_and_update(
+            {"_id": f"{key[0]}:{key[1]}"},
+            [
+                {"$set": {
+                    "tokens": {"$min": [burst, {"$add": [{"$ifNull": ["$tokens", burst]}, {"$multiply": [elapsed, rate]}]}]},
+                    "updated": now,
+                }},
+                {"$set": {"allowed": {"$gte": ["$tokens", cost]}}},
+                {"$set": {
+                    "tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", cost]}, "$tokens"]},
+                    "expires_at": now + idle,
+                }},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        wait = 0.0 if doc["allowed"] else ((cost - doc["tokens"]) / rate if rate > 0 else float("inf"))
+        return doc["allowed"], wait
+
+    async def check(self, user_id, role, cost=1):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        role_key = self._role_key(role)
+        allowed, wait = await self._take(("role", role_key), cost, now)
+        if allowed and user_id:
+            allowed, wait = await self._take(("user", str(user_id)), cost, now)
+            if not allowed:
+                # give the role token back so a throttled user doesn't cost the role
+                await self.collection.update_one({"_id": f"role:{role_key}"}, {"$inc": {"tokens": cost}})
+        (self.allowed if allowed else self.denied)[role_key] += 1
+        return allowed, wait
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({"backend": "mongo", "buckets": None, "evicted": None})
+        return stats
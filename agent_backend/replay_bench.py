@@ -0,0 +1,227 @@
+"""
+Replay benchmark: re-sends recorded chats (data_export/chats.json) to a running agent
+and reports throughput, latency percentiles, error rate and history-cache hit ratio.
+
+Closed loop (fixed number of concurrent clients):
+    python replay_bench.py --concurrency 16 --requests 500
+Open loop (Poisson arrivals at a target rate, latency measured from scheduled arrival):
+    python replay_bench.py --mode poisson --rate 20 --duration 60
+
+Run the server with LLM_PROVIDER=fake (and FAKE_LLM_LATENCY_MS) to benchmark offline,
+and RATE_LIMIT_ENABLED=false unless the rate limiter itself is being measured.
+Results are saved as JSON under bench_results/ and can be compared with --compare.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+DEFAULT_CHATS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data_export", "chats.json")
+RESULTS_DIR = "bench_results"
+
+_local = threading.local()
+
+
+def load_workload(path, user_prefix):
+    """Turns exported chat documents into /chat payloads, keeping their original order."""
+    with open(path, encoding="utf-8") as f:
+        chats = json.load(f)
+
+    workload = []
+    for c in chats:
+        message = (c.get("message") or "").strip()
+        if not message:
+            continue
+        user_id = c.get("user_id") or c.get("student_id") or "guest"
+        workload.append({
+            "user_id": f"{user_prefix}{user_id}",
+            "message": message,
+            "role": c.get("role") or "student",
+        })
+    return workload
+
+
+def _session():
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def send_chat(base_url, payload, timeout):
+    """Blocking /chat call; returns (status, cache header, error)."""
+    try:
+        res = _session().post(f"{base_url}/chat", json=payload, timeout=timeout)
+        return res.status_code, res.headers.get("X-History-Cache"), None
+    except Exception as e:
+        return None, None, type(e).__name__
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.errors = {}
+        self.cache = {"hit": 0, "miss": 0}
+
+    def record(self, latency, status, cache, error):
+        self.latencies.append(latency)
+        key = str(status) if status is not None else "exception"
+        self.statuses[key] = self.statuses.get(key, 0) + 1
+        if error:
+            self.errors[error] = self.errors.get(error, 0) + 1
+        if cache in self.cache:
+            self.cache[cache] += 1
+
+    def summary(self, wall_seconds):
+        total = len(self.latencies)
+        ok = self.statuses.get("200", 0)
+        lat = sorted(self.latencies)
+        cache_total = self.cache["hit"] + self.cache["miss"]
+        ms = lambda v: round(v * 1000, 1) if v is not None else None
+        return {
+            "requests": total,
+            "succeeded": ok,
+            "error_rate": round((total - ok) / total, 4) if total else 0.0,
+            "throughput_rps": round(ok / wall_seconds, 2) if wall_seconds else 0.0,
+            "wall_seconds": round(wall_seconds, 2),
+            "latency_ms": {
+                "mean": ms(sum(lat) / total) if total else None,
+                "p50": ms(percentile(lat, 50)),
+                "p95": ms(percentile(lat, 95)),
+                "p99": ms(percentile(lat, 99)),
+                "max": ms(lat[-1]) if lat else None,
+            },
+            "cache_hit_ratio": round(self.cache["hit"] / cache_total, 4) if cache_total else None,
+            "status_codes": self.statuses,
+            "errors": self.errors,
+        }
+
+
+async def run_closed(args, workload, recorder):
+    """`concurrency` clients each send their next request as soon as the previous one finishes."""
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=args.concurrency)
+    queue = iter(workload[i % len(workload)] for i in range(args.requests))
+    lock = asyncio.Lock()
+
+    async def client():
+        while True:
+            async with lock:
+                payload = next(queue, None)
+            if payload is None:
+                return
+            start = time.perf_counter()
+            status, cache, error = await loop.run_in_executor(executor, send_chat, args.url, payload, args.timeout)
+            recorder.record(time.perf_counter() - start, status, cache, error)
+
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    executor.shutdown(wait=False)
+
+
+async def run_poisson(args, workload, recorder):
+    """
+    Open loop: arrivals follow a Poisson process at `rate` req/s regardless of how fast the
+    server answers. Latency counts from the scheduled arrival, so queueing is not hidden.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=args.concurrency)
+    rng = random.Random(args.seed)
+    tasks = []
+
+    async def fire(payload, scheduled):
+        status, cache, error = await loop.run_in_executor(executor, send_chat, args.url, payload, args.timeout)
+        recorder.record(time.perf_counter() - scheduled, status, cache, error)
+
+    start = time.perf_counter()
+    next_arrival = start
+    i = 0
+    while next_arrival - start < args.duration:
+        delay = next_arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(fire(workload[i % len(workload)], next_arrival)))
+        i += 1
+        next_arrival += rng.expovariate(args.rate)
+
+    await asyncio.gather(*tasks)
+    executor.shutdown(wait=False)
+
+
+def compare(current, previous_path):
+    with open(previous_path, encoding="utf-8") as f:
+        previous = json.load(f)["summary"]
+    print(f"\nComparison with {previous_path}:")
+    rows = [("throughput_rps", current["throughput_rps"], previous["throughput_rps"])]
+    for p in ("p50", "p95", "p99"):
+        rows.append((f"latency {p} (ms)", current["latency_ms"][p], previous["latency_ms"][p]))
+    rows.append(("error_rate", current["error_rate"], previous["error_rate"]))
+    for name, now, before in rows:
+        if now is None or before is None:
+            continue
+        change = f"{(now - before) / before * 100:+.1f}%" if before else "n/a"
+        print(f"  {name:<18} {before:>10} -> {now:>10}  ({change})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded chats against a running agent.")
+    parser.add_argument("--url", default=os.getenv("AGENT_URL", "http://localhost:8000"))
+    parser.add_argument("--chats", default=DEFAULT_CHATS, help="Exported chats JSON file")
+    parser.add_argument("--mode", choices=["closed", "poisson"], default="closed")
+    parser.add_argument("--concurrency", type=int, default=8, help="Clients (closed) or max in-flight requests (poisson)")
+    parser.add_argument("--requests", type=int, default=200, help="Total requests in closed mode")
+    parser.add_argument("--rate", type=float, default=10.0, help="Mean arrivals per second in poisson mode")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of arrivals in poisson mode")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Per-request client timeout (s)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--user-prefix", default="bench_", help="Prefix for replayed user ids")
+    parser.add_argument("--out", help="Result file (default: bench_results/replay-<timestamp>.json)")
+    parser.add_argument("--compare", help="Previous result file to compare against")
+    args = parser.parse_args()
+
+    workload = load_workload(args.chats, args.user_prefix)
+    if not workload:
+        print(f"[X] No replayable chats in {args.chats}")
+        sys.exit(1)
+
+    print(f"[*] Replaying {len(workload)} recorded chats against {args.url} ({args.mode} mode)")
+    recorder = Recorder()
+    start = time.perf_counter()
+    if args.mode == "poisson":
+        asyncio.run(run_poisson(args, workload, recorder))
+    else:
+        asyncio.run(run_closed(args, workload, recorder))
+    summary = recorder.summary(time.perf_counter() - start)
+
+    print(json.dumps(summary, indent=2))
+
+    timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    out_path = args.out or os.path.join(RESULTS_DIR, f"replay-{timestamp}.json")
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    config = {k: v for k, v in vars(args).items() if k not in ("out", "compare")}
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump({"timestamp": timestamp, "config": config, "summary": summary}, f, indent=2)
+    print(f"[OK] Results saved to {out_path}")
+
+    if args.compare:
+        compare(summary, args.compare)
+
+
+if __name__ == "__main__":
+    main()
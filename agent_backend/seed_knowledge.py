@@ -1,8 +1,13 @@
 import os
+import json
+import hashlib
+import argparse
+import datetime
 from pathlib import Path
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 import certifi
+import requests
 
 # Robustly find .env file
 env_path = Path('.env')
@@ -44,9 +49,12 @@ except Exception as e:
     client = MongoClient(MONGO_RETRY, serverSelectionTimeoutMS=5000)
     db = client.friendly_notebook
 
+# Running agent, notified after the knowledge base changes
+AGENT_URL = os.getenv("AGENT_URL", "http://127.0.0.1:8000")
 
-def seed_knowledge_base():
-    """Seeds the database with specialized knowledge for Student, Faculty, and Admin agents."""
+
+def get_seed_knowledge():
+    """Returns the specialized knowledge for Student, Faculty, and Admin agents, keyed by collection."""
     
     # 1. Student Knowledge - Extensive B.Tech Subjects & Programming
     student_knowledge = [
@@ -205,24 +213,116 @@ def seed_knowledge_base():
         }
     ]
 
-    print("[*] clearing old knowledge...")
-    db.student_knowledges.delete_many({})
-    db.faculty_knowledges.delete_many({})
-    db.admin_knowledges.delete_many({})
+    return {
+        "student_knowledges": student_knowledge,
+        "faculty_knowledges": faculty_knowledge,
+        "admin_knowledges": admin_knowledge,
+    }
 
-    print("[*] Seeding Student Knowledge...")
-    if student_knowledge:
-        db.student_knowledges.insert_many(student_knowledge)
-    
-    print("[*] Seeding Faculty Knowledge...")
-    if faculty_knowledge:
-        db.faculty_knowledges.insert_many(faculty_knowledge)
 
-    print("[*] Seeding Admin Knowledge...")
-    if admin_knowledge:
-        db.admin_knowledges.insert_many(admin_knowledge)
+def content_hash(doc):
+    """Stable hash of a knowledge entry, used as its upsert key."""
+    body = {k: v for k, v in doc.items() if k not in ("_id", "content_hash")}
+    canonical = json.dumps(body, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def ensure_hash_index(collection):
+    # Partial so legacy entries without a hash don't collide before they are cleaned up
+    collection.create_index(
+        "content_hash",
+        unique=True,
+        partialFilterExpression={"content_hash": {"$exists": True}},
+    )
+
+
+def sync_collection(collection, docs):
+    """
+    Incrementally syncs a collection with `docs` using content-hash keyed upserts.
+    Unchanged entries are not touched; changed entries are inserted under their new
+    hash and stale ones (including legacy entries without a hash) are removed.
+    Returns True if anything changed.
+    """
+    hashes = []
+    ops = []
+    for doc in docs:
+        h = content_hash(doc)
+        hashes.append(h)
+        ops.append(UpdateOne({"content_hash": h}, {"$setOnInsert": dict(doc, content_hash=h)}, upsert=True))
+
+    ensure_hash_index(collection)
+
+    upserted = 0
+    if ops:
+        result = collection.bulk_write(ops, ordered=False)
+        upserted = result.upserted_count
+
+    removed = collection.delete_many({"content_hash": {"$nin": hashes}}).deleted_count
+    print(f"   {collection.name}: {upserted} added, {removed} removed, {len(set(hashes)) - upserted} unchanged")
+    return bool(upserted or removed)
+
+
+def swap_collection(collection, docs, version):
+    """
+    Builds `docs` into a versioned staging collection and atomically renames it over
+    the live collection, so readers never see an empty or partial knowledge base.
+    """
+    staging = db[f"{collection.name}__v{version}"]
+    staging.drop()
+    unique_docs = {}
+    for doc in docs:
+        unique_docs.setdefault(content_hash(doc), doc)
+    if unique_docs:
+        staging.insert_many([dict(doc, content_hash=h) for h, doc in unique_docs.items()])
+    ensure_hash_index(staging)
+    staging.rename(collection.name, dropTarget=True)
+    print(f"   {collection.name}: swapped in {len(unique_docs)} entries (version {version})")
+
+
+def trigger_agent_reload(agent_url):
+    """Asks the running agent to drop any knowledge it has cached."""
+    try:
+        res = requests.post(f"{agent_url}/agent/reload", timeout=5)
+        print(f"[OK] Agent reload triggered ({res.status_code})")
+    except Exception as e:
+        print(f"[!] Agent reload failed: {e}")
+
+
+def seed_knowledge_base(mode="incremental", reload_agent=True, agent_url=AGENT_URL):
+    """Seeds the knowledge collections without ever leaving them empty."""
+    knowledge = get_seed_knowledge()
+
+    if mode == "swap":
+        version = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d%H%M%S")
+        print(f"[*] Building knowledge version {version}...")
+        for name, docs in knowledge.items():
+            swap_collection(db[name], docs, version)
+        db.knowledge_meta.update_one(
+            {"_id": "version"},
+            {"$set": {"version": version, "updated_at": datetime.datetime.now(datetime.timezone.utc)}},
+            upsert=True,
+        )
+        changed = True
+    else:
+        print("[*] Syncing knowledge (incremental)...")
+        changed = False
+        for name, docs in knowledge.items():
+            changed = sync_collection(db[name], docs) or changed
+
+    if not changed:
+        print("[OK] Knowledge Base already up to date.")
+        return
 
     print("[OK] Knowledge Base Updated Successfully!")
+    if reload_agent:
+        trigger_agent_reload(agent_url)
+
 
 if __name__ == "__main__":
-    seed_knowledge_base()
+    parser = argparse.ArgumentParser(description="Seed the agent knowledge collections.")
+    parser.add_argument("--mode", choices=["incremental", "swap"], default="incremental",
+                        help="incremental: hash-keyed upserts (default); swap: build a versioned collection and rename it in")
+    parser.add_argument("--no-reload", action="store_true", help="Do not call the agent's /agent/reload hook")
+    parser.add_argument("--agent-url", default=AGENT_URL, help="Base URL of the running agent")
+    args = parser.parse_args()
+    seed_knowledge_base(mode=args.mode, reload_agent=not args.no_reload, agent_url=args.agent_url)
@@ -17,6 +17,7 @@ async def view_data():
     for user in users:
         print(f"ID: {user['_id']}, Username: {user['username']}, Role: {user['role']}")
         
+    # Only the hot `chats` collection; bucketed and archived exchanges are counted below
     print("\n=== CHATS COLLECTION ===")
     chats = await db.chats.find().to_list(length=10) # showing last 10
     if not chats:
@@ -27,5 +28,9 @@ async def view_data():
         print(f"AI: {chat.get('response', '')[:50]}...") # truncate response
         print("-" * 20)
 
+    buckets = await db.chat_buckets.count_documents({})
+    archive_chunks = await db.chat_archive.count_documents({})
+    print(f"\nChat buckets: {buckets}, archive chunks: {archive_chunks} (see chat_buckets.py / chat_archive.py stats)")
+
 if __name__ == "__main__":
     asyncio.run(view_data())
@@ -0,0 +1,249 @@
+"""
+Connection handling for the /ws/chat WebSocket.
+
+One socket authenticates once (JWT as the first frame, or ?token=) and then carries
+several concurrent conversations. Frames are JSON objects with a "type":
+
+  client -> server
+    {"type": "chat", "conversation_id": "c1", "message": "...", "deadline_ms": 20000}
+    {"type": "cancel", "conversation_id": "c1"}
+    {"type": "context", "context": {...}}        # dashboard page etc. for later messages
+    {"type": "ping"} / {"type": "pong"}
+
+  server -> client
+    {"type": "ready", "data": {...}}
+    {"type": "token" | "action" | "error" | "done", "conversation_id": "c1", "data": {...}}
+    {"type": "ping"} heartbeats, {"type": "pong"} replies
+
+Outgoing frames go through a bounded queue drained by one writer task, so a slow
+reader pauses token generation instead of growing memory; a reader that stays
+stuck past WS_SEND_TIMEOUT_SECONDS, or a silent client past WS_IDLE_TIMEOUT_SECONDS,
+is disconnected.
+"""
+import os
+import json
+import time
+import asyncio
+
+WS_HEARTBEAT_SECONDS = float(os.getenv("WS_HEARTBEAT_SECONDS", "20"))
+WS_IDLE_TIMEOUT_SECONDS = float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", "60"))
+WS_SEND_QUEUE = int(os.getenv("WS_SEND_QUEUE", "256"))
+WS_SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "10"))
+WS_MAX_CONVERSATIONS = int(os.getenv("WS_MAX_CONVERSATIONS", "4"))
+WS_AUTH_TIMEOUT_SECONDS = float(os.getenv("WS_AUTH_TIMEOUT_SECONDS", "10"))
+
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_IDLE = 4408
+CLOSE_SLOW_CONSUMER = 4429
+
+# Live connections on this worker, for /admin/ws
+connections = set()
+
+
+class SlowConsumer(Exception):
+    """The client stopped reading and the send queue stayed full."""
+
+
+# Optional frame fields and the JSON types they must have
+FRAME_FIELDS = {
+    "conversation_id": (str, int),
+    "message": (str,),
+    "user_name": (str,),
+    "deadline_ms": (int, float),
+    "context": (dict,),
+}
+
+
+def frame_error(frame):
+    """Error message for a frame whose fields have the wrong JSON type, else None."""
+    for field, types in FRAME_FIELDS.items():
+        value = frame.get(field)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, types)):
+            return f"Field '{field}' has the wrong type"
+    return None
+
+
+async def authenticate(websocket, decode_token):
+    """
+    Claims for the socket's token (query parameter or first {"type": "auth"} frame);
+    closes the socket and returns None if it is missing or invalid.
+    """
+    token = websocket.query_params.get("token")
+    if not token:
+        try:
+            frame = json.loads(await asyncio.wait_for(websocket.receive_text(), timeout=WS_AUTH_TIMEOUT_SECONDS))
+            if isinstance(frame, dict) and frame.get("type") == "auth":
+                token = frame.get("token")
+        except Exception:
+            token = None
+    claims = decode_token(token) if token else None
+    if claims is None:
+        await websocket.close(code=CLOSE_UNAUTHORIZED)
+    return claims
+
+
+class Conversation:
+    __slots__ = ("id", "turns", "task")
+
+    def __init__(self, conversation_id):
+        self.id = conversation_id
+        self.turns = None  # compact history (history_store.Turn tuple), seeded on first message
+        self.task = None
+
+
+class ChatConnection:
+    """
+    Per-socket session: the authenticated user, dashboard context, conversations
+    and the outgoing queue. `handler(connection, conversation, frame)` runs one
+    chat exchange and sends its frames with `send`.
+    """
+
+    def __init__(self, websocket, user):
+        self.websocket = websocket
+        self.user = user
+        self.context = {}
+        self.conversations = {}
+        self.opened_at = time.time()
+        self.last_seen = time.monotonic()
+        self.frames_in = 0
+        self.frames_out = 0
+        self._outbox = asyncio.Queue(maxsize=WS_SEND_QUEUE)
+        self._closing = False
+
+    async def send(self, frame):
+        """Queues a frame; waits while the queue is full (backpressure)."""
+        try:
+            await asyncio.wait_for(self._outbox.put(frame), timeout=WS_SEND_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            raise SlowConsumer()
+
+    async def send_event(self, conversation, event, data):
+        await self.send({"type": event, "conversation_id": conversation.id, "data": data})
+
+    async def close(self, code):
+        if self._closing:
+            return
+        self._closing = True
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def _writer(self):
+        while True:
+            frame = await self._outbox.get()
+            await self.websocket.send_text(json.dumps(frame, default=str))
+            self.frames_out += 1
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(WS_HEARTBEAT_SECONDS)
+            if time.monotonic() - self.last_seen > WS_IDLE_TIMEOUT_SECONDS:
+                print(f"   [WS] Closing idle connection for {self.user.get('username')}")
+                await self.close(CLOSE_IDLE)
+                return
+            try:
+                self._outbox.put_nowait({"type": "ping", "ts": time.time()})
+            except asyncio.QueueFull:
+                pass  # the queue is busy anyway; the client isn't idle on our side
+
+    def active_conversations(self):
+        return sum(1 for c in self.conversations.values() if c.task and not c.task.done())
+
+    async def _run_exchange(self, handler, conversation, frame):
+        try:
+            await handler(self, conversation, frame)
+        except asyncio.CancelledError:
+            raise
+        except SlowConsumer:
+            print(f"   [WS] Slow consumer, closing connection for {self.user.get('username')}")
+            await self.close(CLOSE_SLOW_CONSUMER)
+        except Exception as e:
+            print(f"   [X] WS chat error: {e}")
+            try:
+                await self.send_event(conversation, "error", {"message": "An unexpected error occurred."})
+            except SlowConsumer:
+                await self.close(CLOSE_SLOW_CONSUMER)
+
+    async def _dispatch(self, frame, handler):
+        kind = frame.get("type")
+        error = frame_error(frame)
+        if error:
+            await self.send({"type": "error", "data": {"message": error}})
+        elif kind == "ping":
+            await self.send({"type": "pong", "ts": frame.get("ts")})
+        elif kind == "pong":
+            pass
+        elif kind == "context":
+            self.context = frame.get("context") or {}
+        elif kind == "cancel":
+            conversation = self.conversations.get(str(frame.get("conversation_id") or "default"))
+            if conversation and conversation.task and not conversation.task.done():
+                conversation.task.cancel()
+                await self.send_event(conversation, "done", {"cancelled": True})
+        elif kind == "chat":
+            conversation_id = str(frame.get("conversation_id") or "default")
+            conversation = self.conversations.get(conversation_id)
+            if conversation is None:
+                if len(self.conversations) >= WS_MAX_CONVERSATIONS * 4:
+                    # forget finished conversations before opening more
+                    for cid in [cid for cid, c in self.conversations.items() if not c.task or c.task.done()]:
+                        del self.conversations[cid]
+                conversation = self.conversations[conversation_id] = Conversation(conversation_id)
+            if conversation.task and not conversation.task.done():
+                await self.send_event(conversation, "error", {"message": "This conversation is still answering."})
+            elif self.active_conversations() >= WS_MAX_CONVERSATIONS:
+                await self.send_event(conversation, "error", {"message": "Too many conversations in progress."})
+            elif not (frame.get("message") or "").strip():
+                await self.send_event(conversation, "error", {"message": "Message is empty"})
+            else:
+                conversation.task = asyncio.create_task(self._run_exchange(handler, conversation, frame))
+        else:
+            await self.send({"type": "error", "data": {"message": f"Unknown frame type: {kind}"}})
+
+    async def serve(self, handler):
+        """Reads frames until the client disconnects; cancels in-flight exchanges afterwards."""
+        connections.add(self)
+        writer = asyncio.create_task(self._writer())
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            await self.send({"type": "ready", "data": {
+                "username": self.user.get("username"),
+                "role": self.user.get("role"),
+                "heartbeat_seconds": WS_HEARTBEAT_SECONDS,
+                "max_conversations": WS_MAX_CONVERSATIONS,
+            }})
+            while not self._closing:
+                raw = await self.websocket.receive_text()
+                self.last_seen = time.monotonic()
+                self.frames_in += 1
+                try:
+                    frame = json.loads(raw)
+                except ValueError:
+                    await self.send({"type": "error", "data": {"message": "Frames must be JSON"}})
+                    continue
+                if isinstance(frame, dict):
+                    await self._dispatch(frame, handler)
+                else:
+                    await self.send({"type": "error", "data": {"message": "Frames must be JSON objects"}})
+        except SlowConsumer:
+            await self.close(CLOSE_SLOW_CONSUMER)
+        except Exception:
+            pass  # WebSocketDisconnect or a closed socket
+        finally:
+            connections.discard(self)
+            for conversation in self.conversations.values():
+                if conversation.task and not conversation.task.done():
+                    conversation.task.cancel()
+            heartbeat.cancel()
+            writer.cancel()
+
+
+def stats():
+    return {
+        "connections": len(connections),
+        "active_conversations": sum(c.active_conversations() for c in connections),
+        "queued_frames": sum(c._outbox.qsize() for c in connections),
+        "heartbeat_seconds": WS_HEARTBEAT_SECONDS,
+        "max_conversations": WS_MAX_CONVERSATIONS,
+    }